@@ -2,6 +2,7 @@ import webapp2
 import webapp2_extras.routes
 
 from .download                      import Download
+from .handlers.cashandler           import CASHandler
 from .handlers.collectionshandler   import CollectionsHandler
 from .handlers.confighandler        import Config, Version
 from .handlers.containerhandler     import ContainerHandler
@@ -89,6 +90,7 @@ endpoints = [
         route('/upload/<strategy:label|uid|uid-match|reaper>',  Upload,   h='upload',                m=['POST']),
         route('/clean-packfiles',                               Upload,   h='clean_packfile_tokens', m=['POST']),
         route('/engine',                                        Upload,   h='engine',                m=['POST']),
+        route('/cas/<algo:[0-9a-z]+>/<hex_hash:[0-9a-f]+>',     CASHandler, h='download',            m=['GET']),
 
 
         # Top-level endpoints
@@ -134,6 +136,7 @@ endpoints = [
             route('/stats',                JobsHandler, h='stats',      m=['GET']),
             route('/pending',              JobsHandler, h='pending',    m=['GET']),
             route('/reap',                 JobsHandler, h='reap_stale', m=['POST']),
+            route('/heartbeat',            JobsHandler, h='heartbeat',  m=['POST']),
             route('/add',                  JobsHandler, h='add',        m=['POST']),
             route('/<:[^/]+>',             JobHandler),
             route('/<:[^/]+>/config.json', JobHandler,  h='get_config'),
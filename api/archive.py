@@ -0,0 +1,202 @@
+"""
+Streaming archive writers used by batch downloads.
+
+ZipStream writes a zip64 archive front to back without knowing member sizes or
+checksums up front: every member is followed by a data descriptor and the central
+directory is written from the collected entries at the end, so the archive is never
+buffered on disk or in memory.
+
+Deflated members are compressed one chunk at a time in a small thread pool (zlib
+releases the GIL) that works ahead of the output cursor. Each chunk is compressed
+independently and terminated with a sync flush, so the compressed chunks concatenate
+into a single valid raw deflate stream in the original order.
+"""
+
+import collections
+import struct
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+ZIP_STORED = 'stored'
+ZIP_DEFLATED = 'deflated'
+ZIP_COMPRESSIONS = [ZIP_STORED, ZIP_DEFLATED]
+
+COMPRESS_THREADS = 4    # size of the pool shared by all archive streams of a process
+COMPRESS_AHEAD = 8      # number of chunks submitted ahead of the output cursor per stream
+COMPRESS_LEVEL = 6
+
+# Members with these extensions are already compressed and are always stored
+STORED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zip', '.7z', '.jpg', '.jpeg', '.png', '.mp4', '.mov')
+
+_METHODS = {ZIP_STORED: 0, ZIP_DEFLATED: 8}
+_VERSION = 45           # zip64 format extensions
+_FLAGS = 0x08 | 0x800   # data descriptor present, utf-8 names
+_ZIP64_LIMIT = 0xFFFFFFFF
+_EXTERNAL_ATTR = (0100644 & 0xFFFF) << 16
+_DEFLATE_END = '\x03\x00' # empty final fixed huffman block
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(COMPRESS_THREADS)
+    return _pool
+
+
+def ordered_imap(func, iterable, ahead=COMPRESS_AHEAD, discard=None):
+    """
+    Like itertools.imap, but func is applied in the shared worker pool to up to `ahead`
+    items beyond the one being consumed. Results are yielded in input order.
+
+    If the consumer stops early, `discard(result)` is called with the results computed
+    ahead that were not yielded, eg. to release the resources they hold.
+    """
+    pool = _get_pool()
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        while discard is not None and pending:
+            result = pending.popleft()
+            result.wait()
+            if result.successful():
+                discard(result.get())
+
+
+def deflate_chunk(chunk):
+    """Raw deflate a chunk into byte aligned, non-final blocks"""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _dos_datetime(timestamp):
+    t = time.gmtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_date, dos_time
+
+
+class ZipMember(object):
+    """A file to be written into a ZipStream, with its content given as an iterable of chunks"""
+
+    def __init__(self, arcpath, chunks, mtime=0, context=None):
+        if isinstance(arcpath, unicode):
+            arcpath = arcpath.encode('utf-8')
+        self.arcpath = arcpath
+        self.chunks = chunks
+        self.mtime = mtime
+        self.context = context
+        self.method = None
+        self.offset = 0
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+
+class ZipStream(object):
+    """
+    Zip64 archive writer producing the archive as a stream of strings.
+
+    Usage: for data in ZipStream(ZIP_DEFLATED).iter_bytes(members, on_member): ...
+    `on_member(member)` is called after a member has been fully yielded.
+    """
+
+    def __init__(self, compression=ZIP_STORED):
+        if compression not in ZIP_COMPRESSIONS:
+            raise ValueError('Unknown zip compression {}'.format(compression))
+        self.compression = compression
+
+    def _member_method(self, member):
+        if self.compression == ZIP_DEFLATED and not member.arcpath.lower().endswith(STORED_EXTENSIONS):
+            return _METHODS[ZIP_DEFLATED]
+        return _METHODS[ZIP_STORED]
+
+    def _items(self, members):
+        for member in members:
+            member.method = self._member_method(member)
+            yield ('start', member, None)
+            for chunk in member.chunks:
+                if chunk:
+                    yield ('data', member, chunk)
+            yield ('end', member, None)
+
+    @staticmethod
+    def _process(item):
+        kind, member, chunk = item
+        if kind == 'data':
+            if member.method == _METHODS[ZIP_DEFLATED]:
+                return kind, member, (chunk, deflate_chunk(chunk))
+            return kind, member, (chunk, chunk)
+        return item
+
+    def iter_bytes(self, members, on_member=None):
+        offset = 0
+        entries = []
+        for kind, member, payload in ordered_imap(self._process, self._items(members)):
+            if kind == 'start':
+                member.offset = offset
+                data = self._local_header(member)
+            elif kind == 'data':
+                raw, data = payload
+                member.crc = zlib.crc32(raw, member.crc)
+                member.file_size += len(raw)
+                member.compress_size += len(data)
+            else:
+                data = ''
+                if member.method == _METHODS[ZIP_DEFLATED]:
+                    data = _DEFLATE_END
+                    member.compress_size += len(data)
+                data += self._data_descriptor(member)
+                member.chunks = None
+                entries.append(member)
+            offset += len(data)
+            yield data
+            if kind == 'end' and on_member is not None:
+                on_member(member)
+        yield self._central_directory(entries, offset)
+
+    def _local_header(self, member):
+        dos_date, dos_time = _dos_datetime(member.mtime)
+        # sizes are not known yet: they go in the data descriptor and the zip64 extra is zeroed
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        return struct.pack('<IHHHHHIIIHH',
+            0x04034b50, _VERSION, _FLAGS, member.method, dos_time, dos_date,
+            0, _ZIP64_LIMIT, _ZIP64_LIMIT, len(member.arcpath), len(extra)
+        ) + member.arcpath + extra
+
+    @staticmethod
+    def _data_descriptor(member):
+        return struct.pack('<IIQQ', 0x08074b50, member.crc & 0xFFFFFFFF, member.compress_size, member.file_size)
+
+    def _central_directory(self, entries, cd_offset):
+        records = []
+        for member in entries:
+            dos_date, dos_time = _dos_datetime(member.mtime)
+            extra = struct.pack('<HHQQQ', 0x0001, 24, member.file_size, member.compress_size, member.offset)
+            records.append(struct.pack('<IHHHHHHIIIHHHHHII',
+                0x02014b50, 3 << 8 | _VERSION, _VERSION, _FLAGS, member.method, dos_time, dos_date,
+                member.crc & 0xFFFFFFFF, _ZIP64_LIMIT, _ZIP64_LIMIT, len(member.arcpath), len(extra), 0,
+                0, 0, _EXTERNAL_ATTR, _ZIP64_LIMIT
+            ) + member.arcpath + extra)
+        cd = ''.join(records)
+        eocd64_offset = cd_offset + len(cd)
+        eocd64 = struct.pack('<IQHHIIQQQQ',
+            0x06064b50, 44, 3 << 8 | _VERSION, _VERSION, 0, 0,
+            len(entries), len(entries), len(cd), cd_offset)
+        locator = struct.pack('<IIQI', 0x07064b50, 0, eocd64_offset, 1)
+        eocd = struct.pack('<IHHHHIIH',
+            0x06054b50, 0, 0, min(len(entries), 0xFFFF), min(len(entries), 0xFFFF),
+            min(len(cd), _ZIP64_LIMIT), min(cd_offset, _ZIP64_LIMIT), 0)
+        return cd + eocd64 + locator + eocd
@@ -30,6 +30,8 @@ DEFAULT_CONFIG = {
         'log_level': 'info',
         'access_log_enabled': False,
         'drone_secret': None,
+        'download_offload': 'none',
+        'download_offload_prefix': '/_cas',
     },
     'site': {
         'id': 'local',
@@ -44,7 +46,9 @@ DEFAULT_CONFIG = {
     'queue': {
         'max_retries': 3,
         'retry_on_fail': False,
-        'prefetch': False
+        'prefetch': False,
+        'fair_share': 'user',
+        'batch_priority': -1
     },
     'auth': {
         'google': {
@@ -165,6 +169,7 @@ expected_input_schemas = set([
     'group-new.json',
     'group-update.json',
     'info_update.json',
+    'job-heartbeat.json',
     'job-logs.json',
     'job-new.json',
     'note.json',
@@ -242,9 +247,14 @@ def initialize_db():
     db.analyses.create_index([('parent.type', 1), ('parent.id', 1)])
     db.jobs.create_index([('inputs.id', 1), ('inputs.type', 1)])
     db.jobs.create_index([('state', 1), ('now', 1), ('modified', 1)])
+    db.jobs.create_index([('state', 1), ('priority', -1), ('vtime', 1), ('modified', 1)])
+    db.jobs.create_index([('state', 1), ('tags', 1), ('priority', -1), ('vtime', 1), ('modified', 1)])
+    db.job_log_buckets.create_index([('job', 1), ('seq', 1)], unique=True)
     db.gears.create_index('name')
     db.batch.create_index('jobs')
     db.project_rules.create_index('project_id')
+    db.download_targets.create_index([('ticket', 1), ('seq', 1)])
+    db.file_rollups.create_index([('cont', 1), ('level', 1), ('type', 1)], unique=True)
 
     if __config['core']['access_log_enabled']:
         log_db.access_log.create_index('context.ticket_id')
@@ -253,6 +263,7 @@ def initialize_db():
     create_or_recreate_ttl_index('authtokens', 'timestamp', 2592000)
     create_or_recreate_ttl_index('uploads', 'timestamp', 60)
     create_or_recreate_ttl_index('downloads', 'timestamp', 60)
+    create_or_recreate_ttl_index('download_targets', 'timestamp', 86400) # outlives the ticket so long running streams can finish
     create_or_recreate_ttl_index('job_tickets', 'timestamp', 3600) # IMPORTANT: this controls job orphan logic. Ref queue.py
 
     now = datetime.datetime.utcnow()
@@ -5,6 +5,7 @@ import copy
 
 from . import containerutil
 from . import hierarchy
+from . import rollups
 from .. import config
 
 from ..util import deep_update
@@ -445,8 +446,7 @@ class AnalysisStorage(ContainerStorage):
         parent_id = bson.ObjectId(parent_id)
         analyses = self.get_all_el({'parent.type': parent_type, 'parent.id': parent_id}, None, None)
         if inflate_job_info:
-            for analysis in analyses:
-                self.inflate_job_info(analysis)
+            self.inflate_job_infos(analyses)
         return analyses
 
 
@@ -502,6 +502,7 @@ class AnalysisStorage(ContainerStorage):
         result = super(AnalysisStorage, self).create_el(analysis)
         if not result.acknowledged:
             raise APIStorageException('Analysis not created for container {} {}'.format(parent_type, parent_id))
+        rollups.update_files('analyses', analysis, [], analysis.get('files'))
 
         if job is not None:
             # Create job
@@ -532,22 +533,31 @@ class AnalysisStorage(ContainerStorage):
         Update analysis if new job is found
         """
 
-        if analysis.get('job') is None:
-            return analysis
+        self.inflate_job_infos([analysis])
+        return analysis
+
+    def inflate_job_infos(self, analyses):
+        """
+        Inflate the jobs of several analyses, see inflate_job_info.
+        Jobs and their retries are looked up in bulk for all analyses.
+        """
+
+        analyses = [analysis for analysis in analyses if analysis.get('job') is not None]
         try:
-            job = Job.get(analysis['job'])
-        except:
-            raise Exception('No job with id {} found.'.format(analysis['job']))
+            jobs = Job.get_many([analysis['job'] for analysis in analyses], ignore_missing=True)
+        except bson.errors.InvalidId:
+            jobs = [None] * len(analyses)
+        for analysis, job in zip(analyses, jobs):
+            if job is None:
+                raise Exception('No job with id {} found.'.format(analysis['job']))
 
         # If the job currently tied to the analysis failed, try to find one that didn't
-        while job.state == 'failed' and job.id_ is not None:
-            next_job = config.db.jobs.find_one({'previous_job_id': job.id_})
-            if next_job is None:
-                break
-            job = Job.load(next_job)
-        if job.id_ != str(analysis['job']):
-            # Update analysis if job has changed
-            self.update_el(analysis['_id'], {'job': job.id_})
-
-        analysis['job'] = job
-        return analysis
+        jobs = Job.follow_retries(jobs)
+
+        for analysis, job in zip(analyses, jobs):
+            if job.id_ != str(analysis['job']):
+                # Update analysis if job has changed
+                self.update_el(analysis['_id'], {'job': job.id_})
+
+            analysis['job'] = job
+        return analyses
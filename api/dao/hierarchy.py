@@ -13,6 +13,7 @@ from .basecontainerstorage import ContainerStorage
 from ..auth import has_access
 from ..web.errors import APIStorageException, APINotFoundException, APIPermissionException
 from . import containerutil
+from . import rollups
 
 log = config.log
 
@@ -251,6 +252,7 @@ def upsert_fileinfo(cont_name, _id, fileinfo):
     else:
         container_after = update_fileinfo(cont_name, _id, fileinfo)
 
+    rollups.update_files(cont_name, container_after, container_before.get('files'), container_after.get('files'))
     return container_before, container_after
 
 def update_fileinfo(cont_name, _id, fileinfo):
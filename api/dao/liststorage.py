@@ -1,10 +1,12 @@
 import bson.errors
 import bson.objectid
+import copy
 import datetime
 import pymongo
 
 from ..web.errors import APIStorageException, APIConflictException, APINotFoundException
 from . import consistencychecker
+from . import rollups
 from .. import config
 from .. import util
 from ..jobs import rules
@@ -148,6 +150,7 @@ class FileStorage(ListStorage):
         container_after = self.dbc.find_one_and_update(query, update, return_document=pymongo.collection.ReturnDocument.AFTER)
         if not container_after:
             raise APINotFoundException('Could not find and modify {} {}. file not updated'.format(_id, self.cont_name))
+        rollups.update_files(self.cont_name, container_after, container_before.get('files'), container_after.get('files'))
 
         jobs_spawned = rules.create_jobs(config.db, container_before, container_after, self.cont_name)
 
@@ -157,11 +160,14 @@ class FileStorage(ListStorage):
         }
 
     def _delete_el(self, _id, query_params):
-        files = self.get_container(_id).get('files', [])
+        container = self.get_container(_id)
+        files = container.get('files', [])
+        files_before = copy.deepcopy(files)
         for f in files:
             if f['name'] == query_params['name']:
                 f['deleted'] = datetime.datetime.utcnow()
         result = self.dbc.update_one({'_id': _id}, {'$set': {'files': files, 'modified': datetime.datetime.utcnow()}})
+        rollups.update_files(self.cont_name, container, files_before, files)
         if self.cont_name in ['sessions', 'acquisitions']:
             if self.cont_name == 'sessions':
                 session_id = _id
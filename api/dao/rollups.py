@@ -0,0 +1,221 @@
+"""
+Per-container rollups of file counts and sizes by file type.
+
+The `file_rollups` collection holds one document per (container, level, file type):
+
+    {'cont': <container id>, 'level': 'acquisitions', 'type': 'dicom', 'count': 12, 'size': 123456}
+
+A container has a document for its own files under its own level and, for projects and
+sessions, documents summing up the files of their (non-deleted) descendants under the
+descendant levels. Eg. a project's 'acquisitions' documents cover all acquisitions in
+the project. Analyses only roll up their own output files.
+
+Rollups are kept up to date incrementally with $inc deltas when files are added,
+replaced or deleted and when containers are deleted, restored or moved. `rebuild`
+recomputes everything from the containers and is used for backfilling and
+reconciliation.
+"""
+
+import collections
+
+import pymongo
+import pymongo.errors
+
+from .. import config
+from . import containerutil
+
+log = config.log
+
+# Levels whose files are rolled up for a container of each level, including its own
+SUBTREE_LEVELS = {
+    'projects': ['projects', 'sessions', 'acquisitions'],
+    'sessions': ['sessions', 'acquisitions'],
+    'acquisitions': ['acquisitions'],
+    'analyses': ['analyses'],
+}
+
+
+def file_stats(files):
+    """Return {type: [count, size]} for the non-deleted files in a list of fileinfos"""
+    stats = collections.defaultdict(lambda: [0, 0])
+    for f in files or []:
+        if 'deleted' in f:
+            continue
+        stats[f.get('type')][0] += 1
+        stats[f.get('type')][1] += f.get('size') or 0
+    return stats
+
+
+def _diff(stats_before, stats_after):
+    delta = {}
+    for type_ in set(stats_before) | set(stats_after):
+        count = stats_after.get(type_, [0, 0])[0] - stats_before.get(type_, [0, 0])[0]
+        size = stats_after.get(type_, [0, 0])[1] - stats_before.get(type_, [0, 0])[1]
+        if count or size:
+            delta[type_] = [count, size]
+    return delta
+
+
+def get_ancestors(cont_name, container, include_deleted=False):
+    """
+    Return the ids of the ancestors whose rollups include the container's files.
+
+    Rollups only include the files of non-deleted descendants, so the chain stops at the
+    first deleted container unless include_deleted is set for the container itself
+    (used when the container is being deleted or was just restored).
+    """
+    if cont_name not in ('sessions', 'acquisitions'):
+        return []
+    if 'deleted' in container and not include_deleted:
+        return []
+    if cont_name == 'sessions':
+        return [container['project']]
+    session = config.db.sessions.find_one({'_id': container['session']}, ['project', 'deleted'])
+    if session is None:
+        return []
+    if 'deleted' in session:
+        return [session['_id']]
+    return [session['_id'], session['project']]
+
+
+def _inc(cont_ids, level, delta):
+    requests = [
+        pymongo.UpdateOne(
+            {'cont': cont_id, 'level': level, 'type': type_},
+            {'$inc': {'count': count, 'size': size}},
+            upsert=True)
+        for cont_id in cont_ids
+        for type_, (count, size) in delta.iteritems()
+    ]
+    if not requests:
+        return
+    try:
+        config.db.file_rollups.bulk_write(requests)
+    except pymongo.errors.BulkWriteError as e:
+        # lost a race upserting the same new document, retry from the failed request on
+        error = e.details['writeErrors'][0]
+        if error['code'] != 11000:
+            raise
+        config.db.file_rollups.bulk_write(requests[error['index']:])
+
+
+def update_files(cont_name, container, files_before, files_after):
+    """
+    Apply the change of a container's file list to its rollups and its ancestors'.
+
+    `container` is the container document after the change (only the hierarchy fields
+    and the deleted tag are used).
+    """
+    cont_name = containerutil.pluralize(cont_name)
+    if cont_name not in SUBTREE_LEVELS or container is None:
+        return
+    delta = _diff(file_stats(files_before), file_stats(files_after))
+    if delta:
+        _inc([container['_id']] + get_ancestors(cont_name, container), cont_name, delta)
+
+
+def _propagate_subtree(cont_name, container, sign):
+    ancestors = get_ancestors(cont_name, container, include_deleted=True)
+    if not ancestors:
+        return
+    delta = collections.defaultdict(dict)
+    for doc in config.db.file_rollups.find({'cont': container['_id']}):
+        if doc['count'] or doc['size']:
+            delta[doc['level']][doc['type']] = [sign * doc['count'], sign * doc['size']]
+    for level, level_delta in delta.iteritems():
+        _inc(ancestors, level, level_delta)
+
+
+def remove_subtree(cont_name, container):
+    """
+    Subtract a container's rollups from its ancestors, eg. before it is deleted or moved.
+    `container` is the container document before the change.
+    """
+    _propagate_subtree(containerutil.pluralize(cont_name), container, -1)
+
+
+def add_subtree(cont_name, container):
+    """Add a container's rollups to its ancestors, eg. after it was restored or moved"""
+    _propagate_subtree(containerutil.pluralize(cont_name), container, 1)
+
+
+def get_summary(nodes):
+    """
+    Return {type: {'count': count, 'size': size}} for the files under the given nodes,
+    where nodes are (cont_name, container id) tuples.
+    """
+    query = {'$or': [
+        {'cont': _id, 'level': {'$in': SUBTREE_LEVELS[cont_name]}}
+        for cont_name, _id in nodes
+    ]}
+    summary = {}
+    if not query['$or']:
+        return summary
+    for doc in config.db.file_rollups.find(query, {'_id': 0, 'type': 1, 'count': 1, 'size': 1}):
+        if doc['count'] <= 0:
+            continue
+        type_summary = summary.setdefault(doc['type'], {'count': 0, 'size': 0})
+        type_summary['count'] += doc['count']
+        type_summary['size'] += doc['size']
+    return summary
+
+
+def compute_all():
+    """Compute the expected rollups of all containers: {(cont, level, type): [count, size]}"""
+    expected = collections.defaultdict(lambda: [0, 0])
+
+    def add(cont_ids, level, files):
+        for type_, (count, size) in file_stats(files).iteritems():
+            for cont_id in cont_ids:
+                expected[(cont_id, level, type_)][0] += count
+                expected[(cont_id, level, type_)][1] += size
+
+    projection = {'info': 0, 'files.info': 0, 'subject': 0}
+
+    # session id -> ancestors of its acquisitions
+    session_ancestors = {}
+    for session in config.db.sessions.find({}, projection):
+        add([session['_id']] + get_ancestors('sessions', session), 'sessions', session.get('files'))
+        session_ancestors[session['_id']] = [session['_id']] if 'deleted' in session else [session['_id'], session['project']]
+
+    for acquisition in config.db.acquisitions.find({}, projection):
+        ancestors = [] if 'deleted' in acquisition else session_ancestors.get(acquisition['session'], [])
+        add([acquisition['_id']] + ancestors, 'acquisitions', acquisition.get('files'))
+
+    for cont_name in ('projects', 'analyses'):
+        for container in config.db[cont_name].find({}, projection):
+            add([container['_id']], cont_name, container.get('files'))
+
+    return expected
+
+
+def rebuild(dry_run=False):
+    """
+    Recompute all rollups, fix the documents that differ from the expected values and
+    remove empty ones. Returns the number of documents that were (or with dry_run, would
+    be) fixed or removed.
+    """
+    expected = compute_all()
+    requests = []
+    for doc in config.db.file_rollups.find({}):
+        key = (doc['cont'], doc['level'], doc['type'])
+        count, size = expected.pop(key, [0, 0])
+        if not (count or size or doc['count'] or doc['size']):
+            # left behind by files changing type or being removed
+            requests.append(pymongo.DeleteOne({'_id': doc['_id']}))
+        elif doc['count'] != count or doc['size'] != size:
+            log.info('Fixing rollup %s: %s/%s -> %s/%s', key, doc['count'], doc['size'], count, size)
+            if count or size:
+                requests.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {'count': count, 'size': size}}))
+            else:
+                requests.append(pymongo.DeleteOne({'_id': doc['_id']}))
+    for (cont_id, level, type_), (count, size) in expected.iteritems():
+        if count or size:
+            requests.append(pymongo.UpdateOne(
+                {'cont': cont_id, 'level': level, 'type': type_},
+                {'$set': {'count': count, 'size': size}},
+                upsert=True))
+    if requests and not dry_run:
+        for i in xrange(0, len(requests), 1000):
+            config.db.file_rollups.bulk_write(requests[i:i + 1000])
+    return len(requests)
@@ -1,20 +1,33 @@
 import bson
+import calendar
+import collections
+import itertools
 import pytz
+import time
+import uuid
 import os.path
 import tarfile
 import datetime
-import cStringIO
 
 from .web import base
 from .web.request import AccessType
+from . import archive
 from . import config
+from . import files
+from . import filestream
 from . import util
 from . import validators
 import os
+from .dao import rollups
 from .dao.containerutil import pluralize
 log = config.log
 
 BYTES_IN_MEGABYTE = float(1<<20)
+MANIFEST_CHUNK_SIZE = 1000 # number of targets stored per download_targets document
+MISSING_REPORT_LIMIT = 100 # number of missing file paths listed in a ticket
+TICKET_REFRESH_INTERVAL = 30 # seconds between ticket timestamp refreshes while streaming an archive
+RESUME_WINDOW = 600 # seconds an interrupted tar download can be resumed with a range request
+READ_AHEAD = 8 # number of tar members opened and read ahead of the one being streamed
 
 def _filter_check(property_filter, property_values):
     minus = set(property_filter.get('-', []) + property_filter.get('minus', []))
@@ -30,9 +43,253 @@ def _filter_check(property_filter, property_values):
     return True
 
 
+class TargetManifest(object):
+    """
+    Ordered list of the files in a batch download ticket.
+
+    Targets are buffered and written in chunks to the `download_targets` collection,
+    keyed by ticket id and sequence number, so that the ticket document only holds a
+    summary and neither side needs to hold the full target list in memory.
+
+    The existence of buffered targets in the CAS is checked in bulk before each chunk
+    is written. Missing files are skipped and reported in the ticket summary.
+
+    With `dedup` enabled, repeated occurrences of a hash are stored with a `link` to
+    the arcpath of the first occurrence instead of counting towards the size, so the
+    archive can emit them as hardlinks.
+
+    For tar archives the whole layout is fixed here: every target stores its mtime
+    and the byte offset of its header, every chunk the offset of its first target,
+    and the ticket the size of the archive. Streaming the same ticket always produces
+    the same bytes, so the archive can be served in byte ranges.
+    """
+
+    def __init__(self, archive_format='tar', compression=None, dedup=False):
+        self.ticket_id = str(uuid.uuid4())
+        self.archive_format = archive_format
+        self.compression = compression
+        self.dedup = dedup
+        self.created = datetime.datetime.utcnow()
+        self.file_cnt = 0
+        self.size = 0
+        self.tar_size = 0 # tar archive size without the end of archive trailer
+        self.link_cnt = 0
+        self.chunk_cnt = 0
+        self.missing_cnt = 0
+        self.missing = []
+        self._buffer = []
+        self._first_arcpaths = {}
+
+    def append(self, hash_, arcpath, cont_name, cont_id, size, modified=None):
+        self._buffer.append({
+            'hash': hash_,
+            'arcpath': arcpath,
+            'cont_name': cont_name,
+            'cont_id': str(cont_id),
+            'size': size,
+            'mtime': calendar.timegm((modified or self.created).utctimetuple()),
+        })
+        if len(self._buffer) >= MANIFEST_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        existing = files.find_existing_hashes(t['hash'] for t in self._buffer)
+        offset = self.tar_size
+        targets = []
+        for target in self._buffer:
+            if target['hash'] in existing:
+                targets.append(target)
+                self.file_cnt += 1
+                if self.dedup and target['hash'] in self._first_arcpaths:
+                    target['link'] = self._first_arcpaths[target['hash']]
+                    self.link_cnt += 1
+                else:
+                    self._first_arcpaths[target['hash']] = target['arcpath']
+                    self.size += target['size']
+                if self.archive_format == 'tar':
+                    target['offset'] = self.tar_size
+                    self.tar_size += tar_member_size(target)
+            else: # silently skip missing files
+                log.warn("Expected {} to exist but it is missing. File will be skipped in download.".format(util.path_from_hash(target['hash'])))
+                self.missing_cnt += 1
+                if len(self.missing) < MISSING_REPORT_LIMIT:
+                    self.missing.append(target['arcpath'])
+        self._buffer = []
+        if not targets:
+            return
+        config.db.download_targets.insert_one({
+            'ticket': self.ticket_id,
+            'seq': self.chunk_cnt,
+            'offset': offset,
+            'targets': targets,
+            'timestamp': datetime.datetime.utcnow(),
+        })
+        self.chunk_cnt += 1
+
+    def create_ticket(self, ip, origin, filename):
+        """Flush any buffered targets, then insert and return the summary ticket"""
+        self.flush()
+        ticket = util.download_ticket(ip, origin, 'batch', None, filename, self.size)
+        ticket['format'] = self.archive_format
+        ticket['compression'] = self.compression
+        ticket['dedup'] = self.dedup
+        if self.archive_format == 'tar':
+            ticket['tar_trailer_offset'] = self.tar_size
+            ticket['archive_size'] = self.tar_size + len(tar_trailer(self.tar_size))
+        ticket['_id'] = self.ticket_id
+        ticket['file_cnt'] = self.file_cnt
+        ticket['target_chunks'] = self.chunk_cnt
+        ticket['missing_cnt'] = self.missing_cnt
+        ticket['missing'] = self.missing
+        config.db.downloads.insert_one(ticket)
+        return ticket
+
+
+def iter_targets(ticket, offset=0):
+    """
+    Yield the targets of a batch download ticket in order, one chunk at a time.
+    With an offset, start at the chunk holding the tar member at that archive offset.
+    """
+    start = 0
+    if offset:
+        chunk = config.db.download_targets.find_one(
+            {'ticket': ticket['_id'], 'offset': {'$lte': offset}}, ['seq'], sort=[('seq', -1)])
+        start = chunk['seq'] if chunk else 0
+    for seq in xrange(start, ticket.get('target_chunks', 0)):
+        chunk = config.db.download_targets.find_one({'ticket': ticket['_id'], 'seq': seq})
+        if chunk is None:
+            raise Exception('Download ticket {} is missing target chunk {}'.format(ticket['_id'], seq))
+        for target in chunk['targets']:
+            yield target
+
+
+def tar_header(target):
+    """Return the tar header block(s) of a manifest target"""
+    tarinfo = tarfile.TarInfo(name=target['arcpath'])
+    tarinfo.mtime = target['mtime']
+    tarinfo.mode = 0644
+    if target.get('link'):
+        # repeated content, point at the first occurrence in this archive
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = target['link']
+    else:
+        tarinfo.size = target['size']
+    return tarinfo.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'strict')
+
+
+def _tar_padding(size):
+    return -size % tarfile.BLOCKSIZE
+
+
+def tar_member_size(target):
+    """Return the number of bytes a manifest target takes up in a tar archive"""
+    size = len(tar_header(target))
+    if not target.get('link'):
+        size += target['size'] + _tar_padding(target['size'])
+    return size
+
+
+def tar_trailer(offset):
+    """Return the end of archive blocks for a tar archive whose members end at offset"""
+    # two zero blocks, padded to a full record (same as tarfile.TarFile.close)
+    size = offset + 2 * tarfile.BLOCKSIZE
+    return (2 * tarfile.BLOCKSIZE + -size % tarfile.RECORDSIZE) * '\0'
+
+
+def _clip(start, length, first, last):
+    """Return (skip, length) of the part of the segment [start, start + length) within first..last"""
+    skip = max(first - start, 0)
+    return skip, max(min(start + length, last + 1) - start - skip, 0)
+
+
+def tar_stream(targets, data_path, first, last, on_member=None, read_ahead=READ_AHEAD):
+    """
+    Yield bytes first..last (inclusive) of the members of a tar archive of manifest
+    targets, starting with the target at or before `first`. The end of archive trailer
+    is not included. `on_member(target)` is called after a target has been yielded.
+
+    The files of the next `read_ahead` targets are opened and their first chunk is read
+    in the archive worker pool while the current one streams, so storage latency
+    overlaps with sending. Memory use is bounded by read_ahead chunks.
+    """
+    def in_range(targets):
+        for target in targets:
+            if target['offset'] > last:
+                break
+            yield target
+
+    def prepare(target):
+        header = tar_header(target)
+        f, chunk = None, ''
+        if not target.get('link'):
+            skip, length = _clip(target['offset'] + len(header), target['size'], first, last)
+            if length:
+                f = open(os.path.join(data_path, util.path_from_hash(target['hash'])), 'rb')
+                f.seek(skip)
+                chunk = f.read(min(filestream.CHUNK_SIZE, length))
+        return target, header, f, chunk
+
+    def discard(prepared):
+        _, _, f, _ = prepared
+        if f is not None:
+            f.close()
+
+    if read_ahead:
+        prepared = archive.ordered_imap(prepare, in_range(targets), read_ahead, discard)
+    else:
+        prepared = itertools.imap(prepare, in_range(targets))
+
+    f = None
+    try:
+        for target, header, f, chunk in prepared:
+            offset = target['offset']
+            skip, length = _clip(offset, len(header), first, last)
+            if length:
+                yield header[skip:skip + length]
+            offset += len(header)
+            if not target.get('link'):
+                if f is not None:
+                    with f:
+                        _, length = _clip(offset, target['size'], first, last)
+                        yield chunk
+                        for chunk in filestream.read_chunks(f, length - len(chunk)):
+                            yield chunk
+                offset += target['size']
+                skip, length = _clip(offset, _tar_padding(target['size']), first, last)
+                if length:
+                    yield length * '\0'
+            if on_member is not None:
+                on_member(target)
+    finally:
+        # Close the files opened ahead if the client disconnected mid-stream
+        if f is not None:
+            f.close()
+        if read_ahead:
+            prepared.close()
+
+
 class Download(base.RequestHandler):
 
-    def _append_targets(self, targets, cont_name, container, prefix, total_size, total_cnt, data_path, filters):
+    def _get_archive_options(self):
+        """Return the archive format, compression and filename extension requested in the preflight"""
+        archive_format = self.get_param('format', 'tar')
+        if self.is_true('dedup') and archive_format != 'tar':
+            self.abort(400, 'Deduplication is only supported for tar archives')
+        if archive_format == 'tar':
+            if self.get_param('compression'):
+                self.abort(400, 'Compression is only supported for zip archives')
+            return 'tar', None, '.tar'
+        elif archive_format == 'zip':
+            compression = self.get_param('compression', archive.ZIP_STORED)
+            if compression not in archive.ZIP_COMPRESSIONS:
+                self.abort(400, 'Unknown zip compression {}'.format(compression))
+            return 'zip', compression, '.zip'
+        else:
+            self.abort(400, 'Unknown archive format {}'.format(archive_format))
+
+    def _append_targets(self, manifest, cont_name, container, prefix, filters):
         inputs = [('input', f) for f in container.get('inputs', [])]
         outputs = [('output', f) for f in container.get('files', [])]
         for file_group, f in inputs + outputs:
@@ -48,27 +305,20 @@ class Download(base.RequestHandler):
                         break
                 if filtered:
                     continue
-            filepath = os.path.join(data_path, util.path_from_hash(f['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                if cont_name == 'analyses':
-                    targets.append((filepath, '{}/{}/{}'.format(prefix, file_group, f['name']), cont_name, str(container.get('_id')), f['size']))
-                else:
-                    targets.append((filepath, '{}/{}'.format(prefix, f['name']), cont_name, str(container.get('_id')), f['size']))
-                total_size += f['size']
-                total_cnt += 1
+            if cont_name == 'analyses':
+                manifest.append(f['hash'], '{}/{}/{}'.format(prefix, file_group, f['name']), cont_name, container.get('_id'), f['size'], f.get('modified'))
             else:
-                log.warn("Expected {} to exist but it is missing. File will be skipped in download.".format(filepath))
-        return total_size, total_cnt
+                manifest.append(f['hash'], '{}/{}'.format(prefix, f['name']), cont_name, container.get('_id'), f['size'], f.get('modified'))
 
     def _bulk_preflight_archivestream(self, file_refs):
-        data_path = config.get_item('persistent', 'data_path')
         arc_prefix =  self.get_param('prefix', 'scitran')
-        file_cnt = 0
-        total_size = 0
-        targets = []
+        archive_format, compression, extension = self._get_archive_options()
+        manifest = TargetManifest(archive_format, compression, dedup=self.is_true('dedup'))
 
+        # Group the requested file names by container, keeping the request order
+        refs = []
+        requested = collections.defaultdict(lambda: collections.defaultdict(set))
         for fref in file_refs:
-
             cont_id     = fref.get('container_id', '')
             filename    = fref.get('filename', '')
             cont_name   = fref.get('container_name','')
@@ -77,47 +327,47 @@ class Download(base.RequestHandler):
                 self.abort(400, 'Bulk download only supports files in projects, sessions, analyses and acquisitions')
             cont_name   = pluralize(fref.get('container_name',''))
 
+            refs.append((cont_name, cont_id, filename))
+            if bson.ObjectId.is_valid(cont_id):
+                requested[cont_name][bson.ObjectId(cont_id)].add(filename)
 
-            file_obj = None
-            try:
-                # Try to find the file reference in the database (filtering on user permissions)
-                bid = bson.ObjectId(cont_id)
-                query = {'_id': bid}
+        # Fetch each container once (filtering on user permissions), keeping only the requested files
+        found = {}
+        for cont_name, cont_files in requested.iteritems():
+            cont_ids = list(cont_files)
+            for i in xrange(0, len(cont_ids), MANIFEST_CHUNK_SIZE):
+                query = {'_id': {'$in': cont_ids[i:i + MANIFEST_CHUNK_SIZE]}}
                 if not self.superuser_request:
                     query['permissions._id'] = self.uid
-                file_obj = config.db[cont_name].find_one(
-                    query,
-                    {'files': { '$elemMatch': {
-                        'name': filename
-                    }}
-                })['files'][0]
-            except Exception: # pylint: disable=broad-except
-                # self.abort(404, 'File {} on Container {} {} not found'.format(filename, cont_name, cont_id))
+                projection = {'files.name': 1, 'files.hash': 1, 'files.size': 1, 'files.modified': 1}
+                for container in config.db[cont_name].find(query, projection):
+                    for file_obj in container.get('files', []):
+                        key = (cont_name, str(container['_id']), file_obj['name'])
+                        if file_obj['name'] in cont_files[container['_id']] and key not in found:
+                            found[key] = file_obj
+
+        for cont_name, cont_id, filename in refs:
+            file_obj = found.get((cont_name, cont_id, filename))
+            if file_obj is None:
                 # silently skip missing files/files user does not have access to
                 log.warn("Expected file {} on Container {} {} to exist but it is missing. File will be skipped in download.".format(filename, cont_name, cont_id))
                 continue
 
-            filepath = os.path.join(data_path, util.path_from_hash(file_obj['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                targets.append((filepath, cont_name+'/'+cont_id+'/'+file_obj['name'], cont_name, cont_id, file_obj['size']))
-                total_size += file_obj['size']
-                file_cnt += 1
-
-        if len(targets) > 0:
-            filename = arc_prefix + '_ '+datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-            ticket = util.download_ticket(self.request.client_addr, self.origin, 'batch', targets, filename, total_size)
-            config.db.downloads.insert_one(ticket)
-            return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
+            manifest.append(file_obj['hash'], cont_name+'/'+cont_id+'/'+file_obj['name'], cont_name, cont_id, file_obj['size'], file_obj.get('modified'))
+
+        manifest.flush()
+        if manifest.file_cnt > 0:
+            filename = arc_prefix + '_ '+datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + extension
+            ticket = manifest.create_ticket(self.request.client_addr, self.origin, filename)
+            return {'ticket': ticket['_id'], 'file_cnt': manifest.file_cnt, 'size': manifest.size, 'missing_cnt': manifest.missing_cnt}
         else:
             self.abort(404, 'No files requested could be found')
 
 
     def _preflight_archivestream(self, req_spec, collection=None):
-        data_path = config.get_item('persistent', 'data_path')
         arc_prefix = self.get_param('prefix', 'scitran')
-        file_cnt = 0
-        total_size = 0
-        targets = []
+        archive_format, compression, extension = self._get_archive_options()
+        manifest = TargetManifest(archive_format, compression, dedup=self.is_true('dedup'))
         filename = None
 
         ids_of_paths = {}
@@ -138,7 +388,7 @@ class Download(base.RequestHandler):
                     continue
 
                 prefix = '/'.join([arc_prefix, project['group'], project['label']])
-                total_size, file_cnt = self._append_targets(targets, 'projects', project, prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                self._append_targets(manifest, 'projects', project, prefix, req_spec.get('filters'))
 
                 sessions = config.db.sessions.find({'project': item_id, 'deleted': {'$exists': False}}, ['label', 'files', 'uid', 'timestamp', 'timezone', 'subject'])
                 session_dict = {session['_id']: session for session in sessions}
@@ -159,19 +409,19 @@ class Download(base.RequestHandler):
                 for code, subject in subject_dict.iteritems():
                     subject_prefix = self._path_from_container(prefix, subject, ids_of_paths, code)
                     subject_prefixes[code] = subject_prefix
-                    total_size, file_cnt = self._append_targets(targets, 'subjects', subject, subject_prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                    self._append_targets(manifest, 'subjects', subject, subject_prefix, req_spec.get('filters'))
 
                 for session in session_dict.itervalues():
                     subject_code = session['subject'].get('code', 'unknown_subject')
                     subject = subject_dict[subject_code]
                     session_prefix = self._path_from_container(subject_prefixes[subject_code], session, ids_of_paths, session["_id"])
                     session_prefixes[session['_id']] = session_prefix
-                    total_size, file_cnt = self._append_targets(targets, 'sessions', session, session_prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                    self._append_targets(manifest, 'sessions', session, session_prefix, req_spec.get('filters'))
 
                 for acq in acquisitions:
                     session = session_dict[acq['session']]
                     acq_prefix = self._path_from_container(session_prefixes[session['_id']], acq, ids_of_paths, acq['_id'])
-                    total_size, file_cnt = self._append_targets(targets, 'acquisitions', acq, acq_prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                    self._append_targets(manifest, 'acquisitions', acq, acq_prefix, req_spec.get('filters'))
 
 
             elif item['level'] == 'session':
@@ -186,7 +436,7 @@ class Download(base.RequestHandler):
                 if not subject.get('code'):
                     subject['code'] = 'unknown_subject'
                 prefix = self._path_from_container(self._path_from_container(project['group'] + '/' + project['label'], subject, ids_of_paths, subject["code"]), session, ids_of_paths, session['_id'])
-                total_size, file_cnt = self._append_targets(targets, 'sessions', session, prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                self._append_targets(manifest, 'sessions', session, prefix, req_spec.get('filters'))
 
                 # If the param `collection` holding a collection id is not None, filter out acquisitions that are not in the collection
                 a_query = {'session': item_id, 'deleted': {'$exists': False}}
@@ -196,7 +446,7 @@ class Download(base.RequestHandler):
 
                 for acq in acquisitions:
                     acq_prefix = self._path_from_container(prefix, acq, ids_of_paths, acq['_id'])
-                    total_size, file_cnt = self._append_targets(targets, 'acquisitions', acq, acq_prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                    self._append_targets(manifest, 'acquisitions', acq, acq_prefix, req_spec.get('filters'))
 
             elif item['level'] == 'acquisition':
                 acq = config.db.acquisitions.find_one(base_query, ['session', 'label', 'files', 'uid', 'timestamp', 'timezone'])
@@ -212,7 +462,7 @@ class Download(base.RequestHandler):
 
                 project = config.db.projects.find_one({'_id': session['project']}, ['group', 'label'])
                 prefix = self._path_from_container(self._path_from_container(self._path_from_container(project['group'] + '/' + project['label'], subject, ids_of_paths, subject['code']), session, ids_of_paths, session["_id"]), acq, ids_of_paths, acq['_id'])
-                total_size, file_cnt = self._append_targets(targets, 'acquisitions', acq, prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                self._append_targets(manifest, 'acquisitions', acq, prefix, req_spec.get('filters'))
 
             elif item['level'] == 'analysis':
                 analysis = config.db.analyses.find_one(base_query, ['parent', 'label', 'inputs', 'files', 'uid', 'timestamp'])
@@ -221,15 +471,15 @@ class Download(base.RequestHandler):
                     log.warn("Expected anaylysis {} to exist but it is missing. Node will be skipped".format(item_id))
                     continue
                 prefix = self._path_from_container("", analysis, ids_of_paths, util.sanitize_string_to_filename(analysis['label']))
-                filename = 'analysis_' + util.sanitize_string_to_filename(analysis['label']) + '.tar'
-                total_size, file_cnt = self._append_targets(targets, 'analyses', analysis, prefix, total_size, file_cnt, data_path, req_spec.get('filters'))
+                filename = 'analysis_' + util.sanitize_string_to_filename(analysis['label']) + extension
+                self._append_targets(manifest, 'analyses', analysis, prefix, req_spec.get('filters'))
 
-        if len(targets) > 0:
+        manifest.flush()
+        if manifest.file_cnt > 0:
             if not filename:
-                filename = arc_prefix + '_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-            ticket = util.download_ticket(self.request.client_addr, self.origin, 'batch', targets, filename, total_size)
-            config.db.downloads.insert_one(ticket)
-            return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size, 'filename': filename}
+                filename = arc_prefix + '_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + extension
+            ticket = manifest.create_ticket(self.request.client_addr, self.origin, filename)
+            return {'ticket': ticket['_id'], 'file_cnt': manifest.file_cnt, 'size': manifest.size, 'filename': filename, 'missing_cnt': manifest.missing_cnt}
         else:
             self.abort(404, 'No requested containers could be found')
 
@@ -276,35 +526,102 @@ class Download(base.RequestHandler):
         ids_of_paths[_id] = path
         return path
 
-    def archivestream(self, ticket):
-        BLOCKSIZE = 512
-        CHUNKSIZE = 2**20  # stream files in 1MB chunks
-        stream = cStringIO.StringIO()
-        with tarfile.open(mode='w|', fileobj=stream) as archive:
-            for filepath, arcpath, cont_name, cont_id, _ in ticket['target']:
-                yield archive.gettarinfo(filepath, arcpath).tobuf()
-                with open(filepath, 'rb') as fd:
-                    chunk = ''
-                    for chunk in iter(lambda: fd.read(CHUNKSIZE), ''): # pylint: disable=cell-var-from-loop
-                        yield chunk
-                    if len(chunk) % BLOCKSIZE != 0:
-                        yield (BLOCKSIZE - (len(chunk) % BLOCKSIZE)) * b'\0'
-                self.log_user_access(AccessType.download_file, cont_name=cont_name, cont_id=cont_id, filename=os.path.basename(arcpath), multifile=True, origin_override=ticket['origin']) # log download
-        yield stream.getvalue() # get tar stream trailer
-        stream.close()
-
-    def symlinkarchivestream(self, ticket, data_path):
-        for filepath, arcpath, cont_name, cont_id, _ in ticket['target']:
+    def _refresh_ticket(self, ticket):
+        """
+        Keep a ticket and its targets alive while its archive is streamed and for
+        RESUME_WINDOW seconds after that, so an interrupted download can be resumed.
+        """
+        now = datetime.datetime.utcnow()
+        config.db.downloads.update_one({'_id': ticket['_id']}, {'$set': {'timestamp': now + datetime.timedelta(seconds=RESUME_WINDOW)}})
+        config.db.download_targets.update_many({'ticket': ticket['_id']}, {'$set': {'timestamp': now}})
+
+    def archivestream(self, ticket, data_path, first=0, last=None):
+        """
+        Yield bytes first..last (inclusive) of the tar archive of a ticket, the whole
+        archive by default. The layout is fixed by the manifest, see TargetManifest.
+        """
+        if last is None:
+            last = ticket['archive_size'] - 1
+
+        def targets():
+            refreshed = time.time()
+            for target in iter_targets(ticket, first):
+                if time.time() - refreshed > TICKET_REFRESH_INTERVAL:
+                    self._refresh_ticket(ticket)
+                    refreshed = time.time()
+                yield target
+
+        def log_member(target):
+            if target['offset'] >= first:
+                self.log_user_access(AccessType.download_file, cont_name=target['cont_name'], cont_id=target['cont_id'], filename=os.path.basename(target['arcpath']), multifile=True, origin_override=ticket['origin']) # log download
+
+        for data in tar_stream(targets(), data_path, first, last, log_member):
+            yield data
+
+        trailer_offset = ticket['tar_trailer_offset']
+        trailer = tar_trailer(trailer_offset)
+        skip, length = _clip(trailer_offset, len(trailer), first, last)
+        if length:
+            yield trailer[skip:skip + length]
+
+    def zipstream(self, ticket, data_path):
+        def members():
+            for target in iter_targets(ticket):
+                filepath = os.path.join(data_path, util.path_from_hash(target['hash']))
+                yield archive.ZipMember(target['arcpath'], filestream.file_chunks(filepath), target['mtime'], target)
+
+        def log_member(member):
+            target = member.context
+            self.log_user_access(AccessType.download_file, cont_name=target['cont_name'], cont_id=target['cont_id'], filename=os.path.basename(target['arcpath']), multifile=True, origin_override=ticket['origin']) # log download
+
+        zipstream = archive.ZipStream(ticket.get('compression') or archive.ZIP_STORED)
+        return zipstream.iter_bytes(members(), log_member)
+
+    def symlinkarchivestream(self, ticket):
+        offset = 0
+        for target in iter_targets(ticket):
+            arcpath = target['arcpath']
             t = tarfile.TarInfo(name=arcpath)
             t.type = tarfile.SYMTYPE
-            t.linkname = os.path.relpath(filepath, data_path)
-            yield t.tobuf()
-            self.log_user_access(AccessType.download_file, cont_name=cont_name, cont_id=cont_id, filename=os.path.basename(arcpath), multifile=True, origin_override=ticket['origin']) # log download
-        stream = cStringIO.StringIO()
-        with tarfile.open(mode='w|', fileobj=stream) as _:
-            pass
-        yield stream.getvalue() # get tar stream trailer
-        stream.close()
+            t.linkname = util.path_from_hash(target['hash'])
+            header = t.tobuf()
+            offset += len(header)
+            yield header
+            self.log_user_access(AccessType.download_file, cont_name=target['cont_name'], cont_id=target['cont_id'], filename=os.path.basename(arcpath), multifile=True, origin_override=ticket['origin']) # log download
+        yield tar_trailer(offset)
+
+    def _set_tar_body(self, ticket, data_path):
+        """
+        Stream the tar archive of a ticket, or the single byte range requested in a Range
+        header (eg. to resume an interrupted download). The ticket id is the entity tag.
+        """
+        size = ticket['archive_size']
+        etag = '"{}"'.format(ticket['_id'])
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        self.response.headers['ETag'] = etag
+        self._refresh_ticket(ticket)
+
+        try:
+            range_header = self.request.headers.get('Range')
+            if not range_header:
+                raise util.RangeHeaderParseError('No range requested')
+            if not filestream.if_range_matches(self.request, etag):
+                raise util.RangeHeaderParseError('Entity tag changed')
+            ranges = util.parse_range_header(range_header)
+            if len(ranges) != 1:
+                raise util.RangeHeaderParseError('Multiple ranges are not supported for archives')
+        except util.RangeHeaderParseError:
+            self.response.app_iter = self.archivestream(ticket, data_path)
+            self.response.headers['Content-Length'] = str(size)
+            return
+
+        if ranges[0][0] > size - 1:
+            self.abort(416, 'Invalid range')
+        first, last = filestream.resolve_ranges(ranges, size)[0]
+        self.response.status = 206
+        self.response.app_iter = self.archivestream(ticket, data_path, first, last)
+        self.response.headers['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+        self.response.headers['Content-Length'] = str(last - first + 1)
 
     def download(self):
         """Download files or create a download ticket"""
@@ -315,10 +632,15 @@ class Download(base.RequestHandler):
                 self.abort(404, 'no such ticket')
             if ticket['ip'] != self.request.client_addr:
                 self.abort(400, 'ticket not for this source IP')
+            archive_format = ticket.get('format', 'tar')
             if self.get_param('symlinks'):
-                self.response.app_iter = self.symlinkarchivestream(ticket, config.get_item('persistent', 'data_path'))
+                if archive_format != 'tar':
+                    self.abort(400, 'Symlink downloads are only supported for tar archives')
+                self.response.app_iter = self.symlinkarchivestream(ticket)
+            elif archive_format == 'zip':
+                self.response.app_iter = self.zipstream(ticket, config.get_item('persistent', 'data_path'))
             else:
-                self.response.app_iter = self.archivestream(ticket)
+                self._set_tar_body(ticket, config.get_item('persistent', 'data_path'))
             self.response.headers['Content-Type'] = 'application/octet-stream'
             self.response.headers['Content-Disposition'] = 'attachment; filename=' + ticket['filename'].encode('ascii', errors='ignore')
         else:
@@ -335,87 +657,18 @@ class Download(base.RequestHandler):
 
     def summary(self):
         """Return a summary of what has been/will be downloaded based on a given query"""
-        res = {}
-        req = self.request.json_body
-        cont_query = {
-            'projects': {'_id': {'$in':[]}},
-            'sessions': {'_id': {'$in':[]}},
-            'acquisitions': {'_id': {'$in':[]}},
-            'analyses' : {'_id': {'$in':[]}}
-        }
-        for node in req:
-            node['_id'] = bson.ObjectId(node['_id'])
-            level = node['level']
-
-            containers = {'projects':0, 'sessions':0, 'acquisitions':0, 'analyses':0}
-
-            if level == 'project':
-                # Grab sessions and their ids
-                sessions = config.db.sessions.find({'project': node['_id'], 'deleted': {'$exists': False}}, {'_id': 1})
-                session_ids = [s['_id'] for s in sessions]
-                acquisitions = config.db.acquisitions.find({'session': {'$in': session_ids}, 'deleted': {'$exists': False}}, {'_id': 1})
-                acquisition_ids = [a['_id'] for a in acquisitions]
-
-                containers['projects']=1
-                containers['sessions']=1
-                containers['acquisitions']=1
-
-                # for each type of container below it will have a slightly modified match query
-                cont_query.get('projects',{}).get('_id',{}).get('$in').append(node['_id'])
-                cont_query['sessions']['_id']['$in'] = cont_query['sessions']['_id']['$in'] + session_ids
-                cont_query['acquisitions']['_id']['$in'] = cont_query['acquisitions']['_id']['$in'] + acquisition_ids
-
-            elif level == 'session':
-                acquisitions = config.db.acquisitions.find({'session': node['_id'], 'deleted': {'$exists': False}}, {'_id': 1})
-                acquisition_ids = [a['_id'] for a in acquisitions]
+        levels = {'project': 'projects', 'session': 'sessions', 'acquisition': 'acquisitions', 'analysis': 'analyses'}
+        nodes = []
+        for node in self.request.json_body:
+            if node['level'] not in levels:
+                self.abort(400, "{} not a recognized level".format(node['level']))
+            nodes.append((levels[node['level']], bson.ObjectId(node['_id'])))
 
-
-                # for each type of container below it will have a slightly modified match query
-                cont_query.get('sessions',{}).get('_id',{}).get('$in').append(node['_id'])
-                cont_query['acquisitions']['_id']['$in'] = cont_query['acquisitions']['_id']['$in'] + acquisition_ids
-
-                containers['sessions']=1
-                containers['acquisitions']=1
-
-            elif level == 'acquisition':
-
-                cont_query.get('acquisitions',{}).get('_id',{}).get('$in').append(node['_id'])
-                containers['acquisitions']=1
-
-            elif level == 'analysis':
-                cont_query.get('analyses',{}).get('_id',{}).get('$in').append(node['_id'])
-                containers['analyses'] = 1
-
-            else:
-                self.abort(400, "{} not a recognized level".format(level))
-
-            containers = [cont for cont in containers if containers[cont] == 1]
-
-        for cont_name in containers:
-            # Aggregate file types
-            pipeline = [
-                {'$match': cont_query[cont_name]},
-                {'$unwind': '$files'},
-                {'$project': {'_id': '$_id', 'type': '$files.type','mbs': {'$divide': ['$files.size', BYTES_IN_MEGABYTE]}}},
-                {'$group': {
-                    '_id': '$type',
-                    'count': {'$sum' : 1},
-                    'mb_total': {'$sum':'$mbs'}
-                }}
-            ]
-
-            try:
-                result = config.db.command('aggregate', cont_name, pipeline=pipeline)
-            except Exception as e: # pylint: disable=broad-except
-                log.warning(e)
-                self.abort(500, "Failure to load summary")
-
-            if result.get("ok"):
-                for doc in result.get("result"):
-                    type_ = doc['_id']
-                    if res.get(type_):
-                        res[type_]['count'] += doc.get('count',0)
-                        res[type_]['mb_total'] += doc.get('mb_total',0)
-                    else:
-                        res[type_] = doc
+        res = {}
+        for type_, type_summary in rollups.get_summary(nodes).iteritems():
+            res[type_] = {
+                '_id': type_,
+                'count': type_summary['count'],
+                'mb_total': type_summary['size'] / BYTES_IN_MEGABYTE,
+            }
         return res
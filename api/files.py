@@ -1,9 +1,12 @@
 import os
 import cgi
 import json
+import time
 import shutil
 import hashlib
+import threading
 import collections
+from multiprocessing.pool import ThreadPool
 
 from backports import tempfile
 
@@ -12,6 +15,15 @@ from . import config
 
 DEFAULT_HASH_ALG='sha384'
 
+CAS_CHECK_THREADS = 8           # size of the thread pool stat-ing the CAS tree
+CAS_CHECK_CACHE_TTL = 60        # seconds an existence check result is reused
+CAS_CHECK_CACHE_MAX_SIZE = 100000
+CAS_LISTDIR_MIN_HASHES = 64     # candidates in a CAS directory from which it's listed instead of stat-ing them
+
+_cas_check_pool = None
+_cas_check_lock = threading.Lock()
+_cas_check_cache = {}
+
 def move_file(path, target_path):
     target_dir = os.path.dirname(target_path)
     if not os.path.exists(target_dir):
@@ -49,6 +61,59 @@ def hash_file_formatted(path, hash_alg=None, buffer_size=65536):
 
     return util.format_hash(hash_alg, hasher.hexdigest())
 
+def _get_cas_check_pool():
+    global _cas_check_pool # pylint: disable=global-statement
+    with _cas_check_lock:
+        if _cas_check_pool is None:
+            _cas_check_pool = ThreadPool(CAS_CHECK_THREADS)
+    return _cas_check_pool
+
+def _check_cas_dir(args):
+    """
+    Return the subset of hashes that exist in a single CAS directory.
+    Directories with many candidates are listed once instead of stat-ing every file, as
+    listing a large directory (eg. over NFS) costs more than a few stats.
+    """
+    dirpath, hashes = args
+    if len(hashes) < CAS_LISTDIR_MIN_HASHES:
+        return set(h for h in hashes if os.path.exists(os.path.join(dirpath, h)))
+    try:
+        return set(hashes).intersection(os.listdir(dirpath))
+    except OSError:
+        return set()
+
+def find_existing_hashes(hashes):
+    """
+    Given an iterable of file hashes, return the set of those present in the CAS.
+
+    Checks are grouped by CAS directory and run on a bounded thread pool.
+    Results are cached by hash for CAS_CHECK_CACHE_TTL seconds.
+    """
+
+    data_path = config.get_item('persistent', 'data_path')
+    now = time.time()
+    existing = set()
+    by_dir = collections.defaultdict(list)
+    for hash_ in set(hashes):
+        cached = _cas_check_cache.get(hash_)
+        if cached is not None and now - cached[1] < CAS_CHECK_CACHE_TTL:
+            if cached[0]:
+                existing.add(hash_)
+            continue
+        dirpath = os.path.dirname(os.path.join(data_path, util.path_from_hash(hash_)))
+        by_dir[dirpath].append(hash_)
+
+    if by_dir:
+        found = set().union(*_get_cas_check_pool().map(_check_cas_dir, by_dir.items()))
+        if len(_cas_check_cache) > CAS_CHECK_CACHE_MAX_SIZE:
+            _cas_check_cache.clear()
+        for hashes_in_dir in by_dir.itervalues():
+            for hash_ in hashes_in_dir:
+                _cas_check_cache[hash_] = (hash_ in found, now)
+        existing.update(found)
+
+    return existing
+
 class HashingFile(file):
     def __init__(self, file_path, hash_alg):
         super(HashingFile, self).__init__(file_path, "wb")
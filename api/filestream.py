@@ -0,0 +1,179 @@
+"""
+Delivery of stored files to the client.
+
+Whole-file responses can be handed to the web server instead of being read by a
+worker thread, depending on the `core.download_offload` setting:
+
+    none        read the file in chunks from Python (default, always available)
+    sendfile    return the server's wsgi.file_wrapper, which lets eg. uwsgi use
+                sendfile and its offload threads
+    x-accel     empty body with an X-Accel-Redirect header pointing into an nginx
+                internal location that maps to the data path
+    x-sendfile  empty body with an X-Sendfile header (apache mod_xsendfile, uwsgi
+                header routing)
+
+Archive members and byte ranges are always streamed from Python.
+
+Stored files are content addressed, so their hash doubles as a strong entity tag:
+file and zip member responses carry an ETag and honour If-None-Match and If-Range.
+"""
+
+import hashlib
+import os
+
+from . import config
+from . import util
+
+CHUNK_SIZE = 2**20 # stream files in 1MB chunks
+
+OFFLOAD_MODES = ['none', 'sendfile', 'x-accel', 'x-sendfile']
+
+
+def read_chunks(f, length=None, chunk_size=CHUNK_SIZE):
+    while length is None or length > 0:
+        chunk = f.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+def file_chunks(filepath, offset=0, length=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield `length` bytes of a file starting at `offset` (the rest of the file if `length`
+    is None) in chunks of at most `chunk_size` bytes.
+    """
+    with open(filepath, 'rb') as f:
+        if offset:
+            f.seek(offset)
+        for chunk in read_chunks(f, length, chunk_size):
+            yield chunk
+
+
+def resolve_ranges(ranges, size):
+    """
+    Convert ranges as returned by util.parse_range_header into absolute (first, last)
+    byte positions (inclusive) within a file of the given size.
+    """
+    resolved = []
+    for first, last in ranges:
+        if first < 0: # suffix range, ie. the last -first bytes
+            first, last = max(size + first, 0), size - 1
+        elif last is None or last > size - 1:
+            last = size - 1
+        resolved.append((first, last))
+    return resolved
+
+
+def set_range_body(response, filepath, ranges, size, content_type, boundary):
+    """
+    Set byte ranges of a stored file as the response body.
+
+    The ranges are streamed from the file in chunks; with more than one range the
+    body is a multipart/byteranges document whose part headers are generated as the
+    parts are reached. Content-Length is computed up front. Status and Content-Type
+    of the response are left to the caller.
+    """
+    ranges = resolve_ranges(ranges, size)
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response.app_iter = file_chunks(filepath, first, last - first + 1)
+        response.headers['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+        response.headers['Content-Length'] = str(last - first + 1)
+        return
+
+    part_headers = [
+        '--%s\nContent-Type: %s\nContent-Range: bytes %s-%s/%s\n\n' % (boundary, content_type, first, last, size)
+        for first, last in ranges
+    ]
+
+    def multipart():
+        with open(filepath, 'rb') as f:
+            for part_header, (first, last) in zip(part_headers, ranges):
+                yield part_header
+                f.seek(first)
+                for chunk in read_chunks(f, last - first + 1):
+                    yield chunk
+                yield '\n'
+
+    response.app_iter = multipart()
+    response.headers['Content-Length'] = str(sum(len(h) + last - first + 2 for h, (first, last) in zip(part_headers, ranges)))
+
+
+def make_etag(hash_, member_path=None):
+    """Return the (quoted, strong) entity tag of a stored file or of a member of a stored zip file"""
+    if member_path is None:
+        return '"{}"'.format(hash_)
+    if isinstance(member_path, unicode):
+        member_path = member_path.encode('utf-8')
+    return '"{}-{}"'.format(hash_, hashlib.sha1(member_path).hexdigest())
+
+
+def _etag_list(header):
+    # weak comparison: W/"x" matches "x"
+    return [tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip() for tag in header.split(',')]
+
+
+def check_not_modified(request, response, etag):
+    """
+    Set the ETag of the response and return True if the request's If-None-Match header
+    matches it, in which case the response is turned into an empty 304 Not Modified.
+    """
+    response.headers['ETag'] = etag
+    header = request.headers.get('If-None-Match')
+    if not header or (header.strip() != '*' and etag not in _etag_list(header)):
+        return False
+    response.status = 304
+    response.app_iter = []
+    response.headers.pop('Content-Type', None)
+    response.headers.pop('Content-Length', None)
+    return True
+
+
+def if_range_matches(request, etag):
+    """
+    Return True if a range request may be served as such: the request has no If-Range
+    header or it is the current entity tag (strong comparison). Otherwise the whole
+    file should be sent.
+    """
+    header = request.headers.get('If-Range')
+    return not header or header.strip() == etag
+
+
+def get_offload_mode():
+    mode = config.get_item('core', 'download_offload') or 'none'
+    if mode not in OFFLOAD_MODES:
+        config.log.warning('Unknown download offload mode %s, streaming from python', mode)
+        mode = 'none'
+    return mode
+
+
+def set_file_body(response, environ, filepath, hash_, size):
+    """
+    Set a whole stored file as the response body, using the configured offload mode.
+
+    Must be called before headers depending on the body (eg. Content-Length) would be
+    overwritten; sets Content-Length itself.
+    """
+    mode = get_offload_mode()
+
+    if mode == 'sendfile' and environ.get('wsgi.file_wrapper') is not None:
+        response.app_iter = environ['wsgi.file_wrapper'](open(filepath, 'rb'), CHUNK_SIZE)
+        response.headers['Content-Length'] = str(size)
+
+    elif mode == 'x-accel':
+        prefix = config.get_item('core', 'download_offload_prefix').rstrip('/')
+        response.app_iter = []
+        response.headers['X-Accel-Redirect'] = prefix + '/' + util.path_from_hash(hash_)
+        response.headers['Content-Length'] = '0'
+
+    elif mode == 'x-sendfile':
+        response.app_iter = []
+        response.headers['X-Sendfile'] = os.path.abspath(filepath)
+        response.headers['Content-Length'] = '0'
+
+    else:
+        response.app_iter = file_chunks(filepath)
+        response.headers['Content-Length'] = str(size)
@@ -0,0 +1,90 @@
+"""
+Read access to stored files by content hash, for engines and drones.
+"""
+import collections
+import os
+
+import bson
+import bson.errors
+
+from .. import config
+from .. import filestream
+from .. import util
+from ..dao.containerutil import pluralize
+from ..types import Origin
+from ..web import base
+from ..web.request import AccessType
+
+# Content never changes for a given hash, so it can be cached for as long as caches allow
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class CASHandler(base.RequestHandler):
+
+    """Provide the /cas/<algo>/<hash> API route."""
+
+    def _find_job_input(self, job_id, hash_):
+        """
+        Return the (container type, container id, file name) of an input of the job with
+        the given hash, or of the job's gear image, None if the job has no such input.
+        """
+        try:
+            job = config.db.jobs.find_one({'_id': bson.ObjectId(job_id)}, ['inputs', 'gear_id'])
+        except bson.errors.InvalidId:
+            return None
+        if job is None:
+            return None
+
+        names_by_cont = collections.defaultdict(lambda: collections.defaultdict(set))
+        for input_ in job.get('inputs', []):
+            names_by_cont[pluralize(input_['type'])][input_['id']].add(input_['name'])
+
+        for cont_name, names_by_id in names_by_cont.iteritems():
+            cont_ids = [bson.ObjectId(cont_id) for cont_id in names_by_id if bson.ObjectId.is_valid(cont_id)]
+            query = {'_id': {'$in': cont_ids}, 'files.hash': hash_}
+            for container in config.db[cont_name].find(query, {'files.name': 1, 'files.hash': 1}):
+                for f in container.get('files', []):
+                    if f['hash'] == hash_ and f['name'] in names_by_id[str(container['_id'])]:
+                        return cont_name, str(container['_id']), f['name']
+
+        try:
+            gear = config.db.gears.find_one({'_id': bson.ObjectId(job['gear_id'])}, ['exchange'])
+        except bson.errors.InvalidId:
+            gear = None
+        if gear and 'v0-' + gear['exchange']['rootfs-hash'].replace(':', '-') == hash_:
+            return 'gears', job['gear_id'], 'gear.tar'
+        return None
+
+    def download(self, algo, hex_hash):
+        """
+        Download a stored file by hash.
+
+        Drones may read any stored file. Job API keys may only read the inputs (and the
+        gear image) of their job. Responses are marked as immutable so they can be cached
+        by a proxy close to the engines.
+        """
+        hash_ = util.format_hash(algo, hex_hash)
+        origin = self.origin or {}
+        job = origin.get('via', {})
+
+        job_input = None
+        if job.get('type') == str(Origin.job):
+            job_input = self._find_job_input(job['id'], hash_)
+            if job_input is None:
+                self.abort(403, 'File {} is not an input of job {}'.format(hash_, job['id']))
+        elif origin.get('type') != str(Origin.device) or not self.superuser_request:
+            self.abort(403, 'Content addressed downloads require a drone or a job API key')
+
+        filepath = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(hash_))
+        if not os.path.isfile(filepath):
+            self.abort(404, 'No file with hash {}'.format(hash_))
+
+        self.response.headers['Cache-Control'] = CACHE_CONTROL
+        if filestream.check_not_modified(self.request, self.response, filestream.make_etag(hash_)):
+            return
+        filestream.set_file_body(self.response, self.request.environ, filepath, hash_, os.path.getsize(filepath))
+        self.response.headers['Content-Type'] = 'application/octet-stream'
+
+        if job_input is not None and job_input[0] != 'gears':
+            cont_name, cont_id, filename = job_input
+            self.log_user_access(AccessType.download_file, cont_name=cont_name, cont_id=cont_id, filename=filename)
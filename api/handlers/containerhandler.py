@@ -6,7 +6,7 @@ from .. import config
 from .. import util
 from .. import validators
 from ..auth import containerauth, always_ok
-from ..dao import containerstorage, containerutil, noop
+from ..dao import containerstorage, containerutil, noop, rollups
 from ..dao.containerstorage import AnalysisStorage
 from ..jobs.gears import get_gear
 from ..jobs.jobs import Job
@@ -500,6 +500,11 @@ class ContainerHandler(base.RequestHandler):
             self.abort(400, e.message)
 
         if result.modified_count == 1:
+            if target_parent_container and cont_name in ['sessions', 'acquisitions'] and \
+                    payload[parent_id_property] != container.get(parent_id_property):
+                # Moved to a different parent, move the file rollups along
+                rollups.remove_subtree(cont_name, container)
+                rollups.add_subtree(cont_name, config.db[cont_name].find_one({'_id': container['_id']}))
             return {'modified': result.modified_count}
         else:
             self.abort(404, 'Element not updated in container {} {}'.format(self.storage.cont_name, _id))
@@ -566,6 +571,7 @@ class ContainerHandler(base.RequestHandler):
             query = {'deleted': {'$exists': False}}
             update = {'$set': {'deleted': deleted_at}}
             containerutil.propagate_changes(cont_name, bson.ObjectId(_id), query, update, include_refs=True)
+            rollups.remove_subtree(cont_name, container)
             return {'deleted': 1}
         else:
             self.abort(404, 'Element not removed from container {} {}'.format(self.storage.cont_name, _id))
@@ -9,9 +9,11 @@ import zipfile
 
 from ..web import base
 from .. import config
+from .. import filestream
 from .. import upload
 from .. import util
 from .. import validators
+from .. import zipindex
 from ..auth import listauth, always_ok
 from ..dao import noop
 from ..dao import liststorage
@@ -359,26 +361,6 @@ class FileListHandler(ListHandler):
             self.abort(400, 'ticket not for this resource or source IP')
         return ticket
 
-    @staticmethod
-    def build_zip_info(filepath):
-        """
-        Builds a json response containing member and comment info for a zipfile
-        """
-        with zipfile.ZipFile(filepath) as zf:
-            info = {}
-            info['comment'] = zf.comment
-            info['members'] = []
-            for zi in zf.infolist():
-                m = {}
-                m['path']      = zi.filename
-                m['size']      = zi.file_size
-                m['timestamp'] = datetime.datetime(*zi.date_time)
-                m['comment']   = zi.comment
-
-                info['members'].append(m)
-
-            return info
-
     def get(self, cont_name, list_name, **kwargs):
         _id = kwargs.pop('cid')
         permchecker, storage, _, _, keycheck = self._initialize_request(cont_name, list_name, _id)
@@ -416,7 +398,7 @@ class FileListHandler(ListHandler):
         # Request for info about zipfile
         elif self.is_true('info'):
             try:
-                info = self.build_zip_info(filepath)
+                info = zipindex.get_zip_info(fileinfo['hash'], filepath)
             except zipfile.BadZipfile:
                 self.abort(400, 'not a zip file')
             return info
@@ -425,9 +407,12 @@ class FileListHandler(ListHandler):
         elif self.get_param('member') is not None:
             zip_member = self.get_param('member')
             try:
-                with zipfile.ZipFile(filepath) as zf:
-                    self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
-                    self.response.write(zf.open(zip_member).read())
+                member = zipindex.get_member(fileinfo['hash'], filepath, zip_member)
+                if filestream.check_not_modified(self.request, self.response, filestream.make_etag(fileinfo['hash'], zip_member)):
+                    return
+                self.response.app_iter = zipindex.member_chunks(filepath, member)
+                self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
+                self.response.headers['Content-Length'] = str(member['size'])
             except zipfile.BadZipfile:
                 self.abort(400, 'not a zip file')
             except KeyError:
@@ -442,10 +427,15 @@ class FileListHandler(ListHandler):
 
         # Authenticated or ticketed download request
         else:
+            etag = filestream.make_etag(fileinfo['hash'])
+            if filestream.check_not_modified(self.request, self.response, etag):
+                return
             range_header = self.request.headers.get('Range', '')
             try:
                 if not self.is_true('view'):
                     raise util.RangeHeaderParseError('Feature flag not set')
+                if not filestream.if_range_matches(self.request, etag):
+                    raise util.RangeHeaderParseError('Entity tag changed')
 
                 ranges = util.parse_range_header(range_header)
                 for first, last in ranges:
@@ -456,8 +446,7 @@ class FileListHandler(ListHandler):
                         raise util.RangeHeaderParseError('Invalid range')
 
             except util.RangeHeaderParseError:
-                self.response.app_iter = open(filepath, 'rb')
-                self.response.headers['Content-Length'] = str(fileinfo['size'])  # must be set after setting app_iter
+                filestream.set_file_body(self.response, self.request.environ, filepath, fileinfo['hash'], fileinfo['size'])
 
                 if self.is_true('view'):
                     self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
@@ -466,43 +455,12 @@ class FileListHandler(ListHandler):
                     self.response.headers['Content-Disposition'] = 'attachment; filename="' + filename + '"'
             else:
                 self.response.status = 206
+                mimetype = str(fileinfo.get('mimetype', 'application/octet-stream'))
                 if len(ranges) > 1:
                     self.response.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % self.request.id
                 else:
-                    self.response.headers['Content-Type'] = str(
-                        fileinfo.get('mimetype', 'application/octet-stream'))
-                    self.response.headers['Content-Range'] = 'bytes %s-%s/%s' % (str(ranges[0][0]),
-                                                                                 str(ranges[0][1]),
-                                                                                 str(fileinfo['size']))
-                with open(filepath, 'rb') as f:
-                    for first, last in ranges:
-                        mode = os.SEEK_SET
-                        if first < 0:
-                            mode = os.SEEK_END
-                            length = abs(first)
-                        elif last is None:
-                            length = fileinfo['size'] - first
-                        else:
-                            if last > fileinfo['size']:
-                                length = fileinfo['size'] - first
-                            else:
-                                length = last - first + 1
-
-                        f.seek(first, mode)
-                        data = f.read(length)
-
-                        if len(ranges) > 1:
-                            self.response.write('--%s\n' % self.request.id)
-                            self.response.write('Content-Type: %s\n' % str(
-                                fileinfo.get('mimetype', 'application/octet-stream')))
-                            self.response.write('Content-Range: %s' % 'bytes %s-%s/%s\n' % (str(first),
-                                                                                            str(last),
-                                                                                            str(fileinfo['size'])))
-                            self.response.write('\n')
-                            self.response.write(data)
-                            self.response.write('\n')
-                        else:
-                            self.response.write(data)
+                    self.response.headers['Content-Type'] = mimetype
+                filestream.set_range_body(self.response, filepath, ranges, fileinfo['size'], mimetype, self.request.id)
 
             # log download if we haven't already for this ticket
             if ticket:
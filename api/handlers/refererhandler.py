@@ -13,17 +13,19 @@ import datetime
 from abc import ABCMeta, abstractproperty
 
 from .. import config
+from .. import filestream
 from .. import upload
 from .. import util
 from .. import validators
+from .. import zipindex
 from ..auth import containerauth, always_ok
 from ..dao import containerstorage, noop
 from ..dao.basecontainerstorage import ContainerStorage
 from ..dao.containerutil import singularize
+from ..download import TargetManifest
 from ..web import base
 from ..web.errors import APIStorageException, InputValidationException
 from ..web.request import log_access, AccessType
-from .listhandler import FileListHandler
 
 
 log = config.log
@@ -346,13 +348,15 @@ class AnalysesHandler(RefererHandler):
                 total_size = fileinfo[0]['size']
                 file_cnt = 1
                 ticket = util.download_ticket(self.request.client_addr, self.origin, 'file', cid, filename, total_size)
+                config.db.downloads.insert_one(ticket)
             else:
-                targets, total_size, file_cnt = self._prepare_batch(filegroup, fileinfo, analysis)
+                manifest = self._prepare_batch(filegroup, fileinfo, analysis)
+                total_size, file_cnt = manifest.size, manifest.file_cnt
                 label = util.sanitize_string_to_filename(analysis.get('label', 'No Label'))
                 filename = 'analysis_' + label + '.tar'
-                ticket = util.download_ticket(self.request.client_addr, self.origin, 'batch', targets, filename, total_size)
+                ticket = manifest.create_ticket(self.request.client_addr, self.origin, filename)
             return {
-                'ticket': config.db.downloads.insert_one(ticket).inserted_id,
+                'ticket': ticket['_id'],
                 'size': total_size,
                 'file_cnt': file_cnt,
                 'filename': filename
@@ -376,7 +380,7 @@ class AnalysesHandler(RefererHandler):
                 # Request for info about zipfile
                 if self.is_true('info'):
                     try:
-                        info = FileListHandler.build_zip_info(filepath)
+                        info = zipindex.get_zip_info(fileinfo['hash'], filepath)
                     except zipfile.BadZipfile:
                         self.abort(400, 'not a zip file')
                     return info
@@ -385,9 +389,12 @@ class AnalysesHandler(RefererHandler):
                 elif self.get_param('member') is not None:
                     zip_member = self.get_param('member')
                     try:
-                        with zipfile.ZipFile(filepath) as zf:
-                            self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
-                            self.response.write(zf.open(zip_member).read())
+                        member = zipindex.get_member(fileinfo['hash'], filepath, zip_member)
+                        if filestream.check_not_modified(self.request, self.response, filestream.make_etag(fileinfo['hash'], zip_member)):
+                            return
+                        self.response.app_iter = zipindex.member_chunks(filepath, member)
+                        self.response.headers['Content-Type'] = util.guess_mimetype(zip_member)
+                        self.response.headers['Content-Length'] = str(member['size'])
                     except zipfile.BadZipfile:
                         self.abort(400, 'not a zip file')
                     except KeyError:
@@ -402,8 +409,9 @@ class AnalysesHandler(RefererHandler):
 
                 # Request to download the file itself
                 else:
-                    self.response.app_iter = open(filepath, 'rb')
-                    self.response.headers['Content-Length'] = str(fileinfo['size']) # must be set after setting app_iter
+                    if filestream.check_not_modified(self.request, self.response, filestream.make_etag(fileinfo['hash'])):
+                        return
+                    filestream.set_file_body(self.response, self.request.environ, filepath, fileinfo['hash'], fileinfo['size'])
                     if self.is_true('view'):
                         self.response.headers['Content-Type'] = str(fileinfo.get('mimetype', 'application/octet-stream'))
                     else:
@@ -442,19 +450,14 @@ class AnalysesHandler(RefererHandler):
     def _prepare_batch(self, filegroup, fileinfo, analysis):
         ## duplicated code from download.py
         ## we need a way to avoid this
-        targets = []
-        total_size = total_cnt = 0
-        data_path = config.get_item('persistent', 'data_path')
+        manifest = TargetManifest()
         dirname = 'input' if filegroup == 'inputs' else 'output'
         for f in fileinfo:
-            filepath = os.path.join(data_path, util.path_from_hash(f['hash']))
-            if os.path.exists(filepath): # silently skip missing files
-                targets.append((filepath,
-                                '/'.join([util.sanitize_string_to_filename(analysis['label']), dirname, f['name']]),
-                                'analyses', analysis['_id'], f['size']))
-                total_size += f['size']
-                total_cnt += 1
-        return targets, total_size, total_cnt
+            manifest.append(f['hash'],
+                            '/'.join([util.sanitize_string_to_filename(analysis['label']), dirname, f['name']]),
+                            'analyses', analysis['_id'], f['size'], f.get('modified'))
+        manifest.flush()
+        return manifest
 
 
     def _send_batch(self, ticket):
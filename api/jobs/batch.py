@@ -14,6 +14,11 @@ from . import gears
 
 log = config.log
 
+TARGET_PAGE_SIZE = 1000 # targets whose containers are loaded at once when proposing a batch
+
+# Fields of the target containers needed to propose a batch and list them in the proposal
+TARGET_PROJECTION = {'label': 1, 'files': 1, 'permissions': 1, 'created': 1, 'modified': 1}
+
 BATCH_JOB_TRANSITIONS = {
     # To  <-------  #From
     'failed':       'running',
@@ -42,14 +47,27 @@ def get(batch_id, projection=None, get_jobs=False):
         raise APINotFoundException('Batch job {} not found.'.format(batch_id))
 
     if get_jobs:
-        jobs = []
-        for jid in batch_job.get('jobs', []):
-            job = Job.get(jid)
-            jobs.append(job)
-        batch_job['jobs'] = jobs
+        batch_job['jobs'] = Job.get_many(batch_job.get('jobs', []))
 
     return batch_job
 
+def get_target_pages(storage, target_type, target_ids, collection_id=None, page_size=TARGET_PAGE_SIZE):
+    """
+    Yield the containers of the storage in the hierarchies of the targets of a batch
+    proposal, looked up `page_size` targets at a time. Only the fields in
+    TARGET_PROJECTION are loaded, and containers shared by targets are yielded once.
+    """
+
+    kwargs = {'projection': TARGET_PROJECTION}
+    if collection_id:
+        kwargs['collection_id'] = collection_id
+    seen = set()
+    for i in xrange(0, len(target_ids), page_size):
+        containers = storage.get_all_for_targets(target_type, target_ids[i:i + page_size], **kwargs)
+        containers = [c for c in containers if c['_id'] not in seen]
+        seen.update(c['_id'] for c in containers)
+        yield containers
+
 def find_matching_conts(gear, containers, container_type):
     """
     Give a gear and a list of containers, find files that:
@@ -146,13 +164,16 @@ def run(batch_job):
     tags = proposal.get('tags', [])
     tags.append('batch')
 
-    if gear.get('category') == 'analysis':
-        analysis_base = proposal.get('analysis', {})
-        if not analysis_base.get('label'):
-            time_now = datetime.datetime.utcnow()
-            analysis_base['label'] = {'label': '{} {}'.format(gear_name, time_now)}
-        an_storage = AnalysisStorage()
-        acq_storage = AcquisitionStorage()
+    if gear.get('category') != 'analysis':
+        return run_jobs(batch_job, proposed_inputs, proposed_destinations, gear_id, config_, tags, origin)
+
+    # Analysis gears create an analysis container for every job
+    analysis_base = proposal.get('analysis', {})
+    if not analysis_base.get('label'):
+        time_now = datetime.datetime.utcnow()
+        analysis_base['label'] = {'label': '{} {}'.format(gear_name, time_now)}
+    an_storage = AnalysisStorage()
+    acq_storage = AcquisitionStorage()
 
     jobs = []
     job_ids = []
@@ -170,26 +191,18 @@ def run(batch_job):
         job_map = copy.deepcopy(job_defaults)
         job_map['inputs'] = inputs
 
-        if gear.get('category') == 'analysis':
+        analysis = copy.deepcopy(analysis_base)
 
-            analysis = copy.deepcopy(analysis_base)
-
-            # Create analysis
-            acquisition_id = inputs.values()[0].get('id')
-            session_id = acq_storage.get_container(acquisition_id, projection={'session': 1}).get('session')
-            analysis['job'] = job_map
-            result = an_storage.create_el(analysis, 'sessions', session_id, origin, None)
-
-            analysis = an_storage.get_el(result.inserted_id)
-            an_storage.inflate_job_info(analysis)
-            job = analysis.get('job')
-            job_id = bson.ObjectId(job.id_)
-
-        else:
-
-            job = Queue.enqueue_job(job_map, origin)
-            job_id = job.id_
+        # Create analysis
+        acquisition_id = inputs.values()[0].get('id')
+        session_id = acq_storage.get_container(acquisition_id, projection={'session': 1}).get('session')
+        analysis['job'] = job_map
+        result = an_storage.create_el(analysis, 'sessions', session_id, origin, None)
 
+        analysis = an_storage.get_el(result.inserted_id)
+        an_storage.inflate_job_info(analysis)
+        job = analysis.get('job')
+        job_id = bson.ObjectId(job.id_)
 
         jobs.append(job)
         job_ids.append(job_id)
@@ -199,29 +212,46 @@ def run(batch_job):
         job_map = copy.deepcopy(job_defaults)
         job_map['destination'] = dest
 
-        if gear.get('category') == 'analysis':
+        analysis = copy.deepcopy(analysis_base)
 
-            analysis = copy.deepcopy(analysis_base)
+        # Create analysis
+        analysis['job'] = job_map
+        result = an_storage.create_el(analysis, 'sessions', bson.ObjectId(dest['id']), origin, None)
 
-            # Create analysis
-            analysis['job'] = job_map
-            result = an_storage.create_el(analysis, 'sessions', bson.ObjectId(dest['id']), origin, None)
+        analysis = an_storage.get_el(result.inserted_id)
+        an_storage.inflate_job_info(analysis)
+        job = analysis.get('job')
+        job_id = bson.ObjectId(job.id_)
 
-            analysis = an_storage.get_el(result.inserted_id)
-            an_storage.inflate_job_info(analysis)
-            job = analysis.get('job')
-            job_id = bson.ObjectId(job.id_)
+        jobs.append(job)
+        job_ids.append(job_id)
 
-        else:
+    update(batch_job['_id'], {'state': 'running', 'jobs': job_ids})
+    return jobs
+
+def run_jobs(batch_job, proposed_inputs, proposed_destinations, gear_id, config_, tags, origin):
+    """
+    Enqueue the jobs of a batch of a utility gear in bulk, returns jobs enqueued.
 
-            job = Queue.enqueue_job(job_map, origin)
-            job_id = job.id_
+    The batch is only marked running, with the list of all its jobs, once every job
+    was inserted. If enqueuing fails the inserted jobs are cancelled and the batch is
+    left pending.
+    """
 
+    batch_id = str(batch_job.get('_id'))
+    job_maps = []
+    for inputs in proposed_inputs:
+        job_maps.append({'gear_id': gear_id, 'config': copy.deepcopy(config_), 'tags': list(tags),
+                         'batch': batch_id, 'inputs': inputs})
+    for dest in proposed_destinations:
+        job_maps.append({'gear_id': gear_id, 'config': copy.deepcopy(config_), 'tags': list(tags),
+                         'batch': batch_id, 'inputs': {}, 'destination': dest})
 
-        jobs.append(job)
-        job_ids.append(job_id)
+    def progress(inserted, total):
+        log.info('Batch %s: enqueued %d of %d jobs', batch_id, inserted, total)
 
-    update(batch_job['_id'], {'state': 'running', 'jobs': job_ids})
+    jobs = Queue.enqueue_jobs(job_maps, origin, progress=progress)
+    update(batch_job['_id'], {'state': 'running', 'jobs': [job.id_ for job in jobs]})
     return jobs
 
 def cancel(batch_job):
@@ -5,23 +5,100 @@ Gears
 from __future__ import absolute_import
 
 import bson.objectid
+import copy
 import datetime
+import threading
+import time
 from jsonschema import Draft4Validator, ValidationError
 import gears as gear_tools
-import pymongo
 
 from .. import config
-from .jobs import Job
+from .jobs import Job, evict_command_templates
+from .matchers import FileMatcher
 
 from ..web.errors import APIValidationException, APINotFoundException
 
 log = config.log
 
+# The gear registry caches gear documents and their compiled validators in-process.
+# Gears are immutable once inserted, so the registry only needs to be dropped when a gear
+# is added or removed. Writes bump a generation counter in the singletons collection,
+# which other processes check at most every GEAR_REGISTRY_CHECK_INTERVAL seconds.
+GEAR_REGISTRY_CHECK_INTERVAL = 5
+GEAR_REGISTRY_MAX_SIZE = 10000
+
+_GENERATION_ID = 'gears' # singletons document holding the gear registry generation
+
+_registry_lock = threading.Lock()
+_registry = {'generation': None, 'checked': 0}
+
+def _new_registry(generation, checked):
+    return {
+        'generation': generation,
+        'checked':    checked,
+        'by_id':      {},    # gear id -> gear document
+        'latest':     None,  # latest version of every gear, see get_gears
+        'by_name':    None,  # gear name -> latest version
+        'validators': {},    # (gear id, kind) -> compiled validator(s)
+    }
+
+def _get_registry():
+    """Return the registry, dropping it first if gears changed since it was filled"""
+    global _registry # pylint: disable=global-statement
+    now = time.time()
+    registry = _registry
+    if now - registry['checked'] >= GEAR_REGISTRY_CHECK_INTERVAL:
+        doc = config.db.singletons.find_one({'_id': _GENERATION_ID}, ['generation'])
+        generation = doc['generation'] if doc else 0
+        with _registry_lock:
+            if generation != _registry['generation']:
+                _registry = _new_registry(generation, now)
+            else:
+                _registry['checked'] = now
+            registry = _registry
+    return registry
+
+def invalidate_gear_registry():
+    """
+    Drop the gear registry of every process. Call after any write to the gears collection.
+    """
+    global _registry # pylint: disable=global-statement
+    config.db.singletons.update_one({'_id': _GENERATION_ID}, {'$inc': {'generation': 1}}, upsert=True)
+    with _registry_lock:
+        _registry = _new_registry(None, 0)
+
+def _load_latest(registry):
+    if registry['latest'] is None:
+        latest = _aggregate_gears()
+        with _registry_lock:
+            registry['by_name'] = {gear['gear']['name']: gear for gear in latest}
+            registry['latest'] = latest
+    return registry['latest']
+
+def _get_validators(gear, kind, build):
+    """Return the compiled validators of a gear version, building them on first use"""
+    if '_id' not in gear:
+        return build()
+    registry = _get_registry()
+    key = (str(gear['_id']), kind)
+    validators = registry['validators'].get(key)
+    if validators is None:
+        validators = build()
+        with _registry_lock:
+            if len(registry['validators']) > GEAR_REGISTRY_MAX_SIZE:
+                registry['validators'].clear()
+            registry['validators'][key] = validators
+    return validators
+
 def get_gears():
     """
-    Fetch the install-global gears from the database
+    Fetch the install-global gears, the latest version of every gear name
     """
 
+    return copy.deepcopy(_load_latest(_get_registry()))
+
+def _aggregate_gears():
+
     pipe = [
         {'$sort': {
             'gear.name': 1,
@@ -38,32 +115,66 @@ def get_gears():
     return map(lambda x: x['original'], cursor)
 
 def get_gear(_id):
-    return config.db.gears.find_one({'_id': bson.ObjectId(_id)})
+    registry = _get_registry()
+    gear = registry['by_id'].get(str(_id))
+    if gear is None:
+        gear = config.db.gears.find_one({'_id': bson.ObjectId(_id)})
+        if gear is None:
+            return None
+        with _registry_lock:
+            if len(registry['by_id']) > GEAR_REGISTRY_MAX_SIZE:
+                registry['by_id'].clear()
+            registry['by_id'][str(_id)] = gear
+    return copy.deepcopy(gear)
 
 def get_gear_by_name(name):
 
-    # Find a gear from the list by name
-    gear_doc = list(config.db.gears.find({'gear.name': name}).sort('created', pymongo.DESCENDING))
+    # Find the latest version of a gear by name
+    registry = _get_registry()
+    _load_latest(registry)
+    gear = registry['by_name'].get(name)
 
-    if len(gear_doc) == 0 :
+    if gear is None:
         raise APINotFoundException('Unknown gear ' + name)
 
-    return gear_doc[0]
+    return copy.deepcopy(gear)
 
 def get_invocation_schema(gear):
     return gear_tools.derive_invocation_schema(gear['gear'])
 
+def get_input_matchers(gear):
+    """
+    Return a map of the gear's inputs to matchers of the files that suit them.
+    """
+
+    def build():
+        invocation_schema = get_invocation_schema(gear)
+        schemas = {}
+        for x in gear['gear']['inputs']:
+            schema = gear_tools.isolate_file_invocation(invocation_schema, x)
+            schemas[x] = FileMatcher(schema)
+        return schemas
+
+    return _get_validators(gear, 'inputs', build)
+
+def get_config_validator(gear):
+    """
+    Return a validator of job configs against the gear's manifest.
+    """
+
+    def build():
+        invocation = gear_tools.derive_invocation_schema(gear['manifest'])
+        ci = gear_tools.isolate_config_invocation(invocation)
+        return Draft4Validator(ci)
+
+    return _get_validators(gear, 'config', build)
+
 def add_suggest_info_to_files(gear, files):
     """
     Given a list of files, add information to each file that details those that would work well for each input on a gear.
     """
 
-    invocation_schema = get_invocation_schema(gear)
-
-    schemas = {}
-    for x in gear['gear']['inputs']:
-        schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-        schemas[x] = Draft4Validator(schema)
+    schemas = get_input_matchers(gear)
 
     for f in files:
         f['suggested'] = {}
@@ -74,11 +185,7 @@ def add_suggest_info_to_files(gear, files):
 
 def suggest_for_files(gear, files):
 
-    invocation_schema = get_invocation_schema(gear)
-    schemas = {}
-    for x in gear['gear']['inputs']:
-        schema = gear_tools.isolate_file_invocation(invocation_schema, x)
-        schemas[x] = Draft4Validator(schema)
+    schemas = get_input_matchers(gear)
 
     suggested_files = {}
     for input_name, schema in schemas.iteritems():
@@ -91,9 +198,7 @@ def suggest_for_files(gear, files):
 
 def validate_gear_config(gear, config_):
     if len(gear.get('manifest', {}).get('config', {})) > 0:
-        invocation = gear_tools.derive_invocation_schema(gear['manifest'])
-        ci = gear_tools.isolate_config_invocation(invocation)
-        validator = Draft4Validator(ci)
+        validator = get_config_validator(gear)
 
         try:
             validator.validate(config_)
@@ -137,6 +242,7 @@ def insert_gear(doc):
     doc['modified'] = now
 
     result = config.db.gears.insert(doc)
+    invalidate_gear_registry()
 
     if config.get_item('queue', 'prefetch'):
         log.info('Queuing prefetch job for gear ' + doc['gear']['name'])
@@ -168,6 +274,9 @@ def remove_gear(_id):
     if result.deleted_count != 1:
         raise Exception("Deleted failed " + str(result.raw_result))
 
+    invalidate_gear_registry()
+    evict_command_templates(str(_id))
+
 def upsert_gear(doc):
     check_for_gear_insertion(doc)
 
@@ -10,6 +10,7 @@ from urlparse import urlparse
 
 from . import batch
 from .. import config
+from .. import filestream
 from .. import upload
 from .. import util
 from ..auth import require_drone, require_login, require_admin, has_access
@@ -24,10 +25,10 @@ from ..web.encoder import pseudo_consistent_json_encode
 from ..web.errors import APIPermissionException, APINotFoundException, InputValidationException
 from ..web.request import AccessType
 
-from .gears import validate_gear_config, get_gears, get_gear, get_invocation_schema, remove_gear, upsert_gear, get_gear_by_name, check_for_gear_insertion, add_suggest_info_to_files
+from .gears import validate_gear_config, get_gears, get_gear, get_invocation_schema, remove_gear, upsert_gear, get_gear_by_name, check_for_gear_insertion, add_suggest_info_to_files, invalidate_gear_registry
 from .jobs import Job, JobTicket, Logs
 from .batch import check_state, update
-from .queue import Queue
+from .queue import Queue, MAX_NEXT_JOBS
 from .rules import create_jobs, validate_regexes
 
 
@@ -156,6 +157,7 @@ class GearHandler(base.RequestHandler):
         config.db.gears.update_one({'_id': gear_id}, {'$set': {
             'exchange.rootfs-url': '/api/gears/temp/' + str(gear_id)}
         })
+        invalidate_gear_registry()
 
         return {'_id': str(gear_id)}
 
@@ -163,11 +165,13 @@ class GearHandler(base.RequestHandler):
         """Download gear tarball file"""
         dl_id = kwargs.pop('cid')
         gear = get_gear(dl_id)
-        hash_ = gear['exchange']['rootfs-hash']
-        filepath = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash('v0-' + hash_.replace(':', '-')))
+        hash_ = 'v0-' + gear['exchange']['rootfs-hash'].replace(':', '-')
+        filepath = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(hash_))
 
-        stream = open(filepath, 'rb')
-        set_for_download(self.response, stream=stream, filename='gear.tar')
+        if filestream.check_not_modified(self.request, self.response, filestream.make_etag(hash_)):
+            return
+        set_for_download(self.response, filename='gear.tar')
+        filestream.set_file_body(self.response, self.request.environ, filepath, hash_, os.path.getsize(filepath))
 
     @require_admin
     def post(self, _id):
@@ -348,6 +352,18 @@ class JobsHandler(base.RequestHandler):
         if len(tags) <= 0:
             tags = None
 
+        count = self.get_param('count')
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                raise InputValidationException('count must be an integer')
+            if count < 1 or count > MAX_NEXT_JOBS:
+                raise InputValidationException('count must be between 1 and {}'.format(MAX_NEXT_JOBS))
+            if peek:
+                raise InputValidationException('count can not be used with peek')
+            return Queue.start_jobs(tags=tags, count=count)
+
         job = Queue.start_job(tags=tags, peek=peek)
 
         if job is None:
@@ -357,8 +373,13 @@ class JobsHandler(base.RequestHandler):
 
     @require_admin
     def reap_stale(self):
-        count = Queue.scan_for_orphans()
-        return { 'orphaned': count }
+        return Queue.scan_for_orphans()
+
+    @require_admin
+    def heartbeat(self):
+        payload = self.request.json
+        validate_data(payload, 'job-heartbeat.json', 'input', 'POST')
+        return {'not_running': Queue.heartbeat(payload['ids'], profiles=payload.get('profile'))}
 
 class JobHandler(base.RequestHandler):
     """Provides /Jobs/<jid> routes."""
@@ -463,28 +484,43 @@ class JobHandler(base.RequestHandler):
                     job.inputs[x].check_access(self.uid, 'ro')
                 # Unlike jobs-add, explicitly not checking write access to destination.
 
+    def _log_range(self):
+        """Return the offset and tail params of the log routes"""
+        try:
+            offset = int(self.get_param('offset', 0))
+            tail = self.get_param('tail')
+            tail = int(tail) if tail is not None else None
+        except ValueError:
+            raise InputValidationException('offset and tail must be integers')
+        if offset < 0 or (tail is not None and tail < 0):
+            raise InputValidationException('offset and tail must not be negative')
+        return offset, tail
+
     def get_logs(self, _id):
         """Get a job's logs"""
 
         self._log_read_check(_id)
-        return Logs.get(_id)
+        offset, tail = self._log_range()
+        return Logs.get(_id, offset=offset, tail=tail)
 
     def get_logs_text(self, _id):
         """Get a job's logs in raw text"""
 
         self._log_read_check(_id)
+        offset, tail = self._log_range()
         filename = 'job-' + _id + '-logs.txt'
 
         set_for_download(self.response, filename=filename)
-        for output in Logs.get_text_generator(_id):
+        for output in Logs.get_text_generator(_id, offset=offset, tail=tail):
             self.response.write(output)
 
     def get_logs_html(self, _id):
         """Get a job's logs in html"""
 
         self._log_read_check(_id)
+        offset, tail = self._log_range()
 
-        for output in Logs.get_html_generator(_id):
+        for output in Logs.get_html_generator(_id, offset=offset, tail=tail):
             self.response.write(output)
 
         return
@@ -637,40 +673,45 @@ class BatchHandler(base.RequestHandler):
 
         if not file_inputs:
             # Grab sessions rather than acquisitions
-            containers = SessionStorage().get_all_for_targets(container_type, objectIds)
+            pages = batch.get_target_pages(SessionStorage(), container_type, objectIds)
 
         else:
             # Get acquisitions associated with targets
-            containers = AcquisitionStorage().get_all_for_targets(container_type, objectIds, collection_id=collection_id)
-
-        if not containers:
-            self.abort(404, 'Could not find necessary containers from targets.')
+            pages = batch.get_target_pages(AcquisitionStorage(), container_type, objectIds, collection_id=collection_id)
 
         improper_permissions = []
-        perm_checked_conts = []
+        has_conts = False
+        has_perm_checked_conts = False
+        results = {'matched': [], 'not_matched': [], 'ambiguous': []}
+
+        for containers in pages:
+            has_conts = has_conts or bool(containers)
+            perm_checked_conts = []
+
+            # Make sure user has read-write access, add those to acquisition list
+            for c in containers:
+                if self.superuser_request or has_access(self.uid, c, 'rw'):
+                    c.pop('permissions')
+                    perm_checked_conts.append(c)
+                else:
+                    improper_permissions.append(c['_id'])
+            has_perm_checked_conts = has_perm_checked_conts or bool(perm_checked_conts)
+
+            if not file_inputs:
+                # All containers become matched destinations
+                results['matched'].extend({'id': str(x['_id']), 'type': 'session'} for x in containers)
 
-        # Make sure user has read-write access, add those to acquisition list
-        for c in containers:
-            if self.superuser_request or has_access(self.uid, c, 'rw'):
-                c.pop('permissions')
-                perm_checked_conts.append(c)
             else:
-                improper_permissions.append(c['_id'])
+                # Look for file matches in each acquisition
+                page_results = batch.find_matching_conts(gear, perm_checked_conts, 'acquisition')
+                for key in results:
+                    results[key].extend(page_results[key])
 
-        if not perm_checked_conts:
+        if not has_conts:
+            self.abort(404, 'Could not find necessary containers from targets.')
+        if not has_perm_checked_conts:
             self.abort(403, 'User does not have write access to targets.')
 
-        if not file_inputs:
-            # All containers become matched destinations
-
-            results = {
-                'matched': [{'id': str(x['_id']), 'type': 'session'} for x in containers]
-            }
-
-        else:
-            # Look for file matches in each acquisition
-            results = batch.find_matching_conts(gear, perm_checked_conts, 'acquisition')
-
         matched = results['matched']
         batch_proposal = {}
 
@@ -3,17 +3,65 @@ Jobs
 """
 
 import bson
+import collections
 import copy
 import datetime
+import gzip
+import itertools
+import json
+import os
+import pymongo
+import pymongo.errors
 import string
+import threading
+
+from backports import tempfile
 
 from ..types import Origin
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 
 from .. import config
-from ..util import render_template
+from .. import files
+from .. import util
+from . import scheduler
+from . import stats
+from ..util import compile_template, render_template
 from ..web.errors import APINotFoundException
 
+log = config.log
+
+LOG_BUCKET_STATEMENTS = 1000 # log statements per job log bucket
+LOG_BUCKET_BYTES = 1024 * 1024 # message bytes per job log bucket, exceeded by at most one statement
+LOG_ARCHIVE_STATES = ['complete', 'failed', 'cancelled'] # states of jobs whose logs are archived
+LOG_ARCHIVE_MIN_AGE = 3600 # seconds since a job finished before its logs are archived
+COMMAND_TEMPLATE_CACHE_MAX_SIZE = 1000 # compiled gear command templates kept in memory
+
+_command_templates = {}
+_command_templates_lock = threading.Lock()
+
+
+def get_command_template(gear_id, command):
+    """
+    Return the compiled template of a gear command. Templates are cached by gear id and
+    command string, so a gear re-added with a different command is compiled again.
+    """
+    key = (gear_id, command)
+    template = _command_templates.get(key)
+    if template is None:
+        template = compile_template(command)
+        with _command_templates_lock:
+            if len(_command_templates) >= COMMAND_TEMPLATE_CACHE_MAX_SIZE:
+                _command_templates.clear()
+            _command_templates[key] = template
+    return template
+
+
+def evict_command_templates(gear_id):
+    """Drop the cached command templates of a gear"""
+    with _command_templates_lock:
+        for key in [key for key in _command_templates if key[0] == gear_id]:
+            del _command_templates[key]
+
 
 class Job(object):
     def __init__(self, gear_id, inputs, destination=None, tags=None,
@@ -21,7 +69,8 @@ class Job(object):
                  modified=None, state='pending', request=None,
                  id_=None, config_=None, origin=None,
                  saved_files=None, produced_metadata=None, batch=None,
-                 failed_output_accepted=False, profile=None):
+                 failed_output_accepted=False, profile=None,
+                 priority=None, vtime=None, share=None, log_archive=None):
         """
         Creates a job.
 
@@ -52,6 +101,13 @@ class Job(object):
             The gear configuration for this job.
         failed_output_accepted: bool (optional)
             Flag indicating whether output was accepted for a failed job.
+        priority: integer (optional)
+            Jobs with a higher priority are started first. Defaults to 0, or to the batch priority for batch jobs.
+        vtime: float (optional)
+        share: string (optional)
+            Fair share virtual start time and share key, assigned on insert. See scheduler.
+        log_archive: map (optional)
+            Reference to the compressed log of a finished job. See Logs.
         """
 
         # TODO: validate inputs against the manifest
@@ -73,6 +129,8 @@ class Job(object):
             modified = time_now
         if profile is None:
             profile = {}
+        if priority is None:
+            priority = scheduler.get_default_priority(batch)
 
         if destination is None and inputs is not None:
             # Grab an arbitrary input's container
@@ -108,6 +166,10 @@ class Job(object):
         self.batch              = batch
         self.failed_output_accepted = failed_output_accepted
         self.profile = profile
+        self.priority = priority
+        self.vtime = vtime
+        self.share = share
+        self.log_archive = log_archive
 
 
     def intention_equals(self, other_job):
@@ -167,7 +229,11 @@ class Job(object):
             produced_metadata=d.get('produced_metadata'),
             batch=d.get('batch'),
             failed_output_accepted=d.get('failed_output_accepted', False),
-            profile=d.get('profile', {})
+            profile=d.get('profile', {}),
+            priority=d.get('priority'),
+            vtime=d.get('vtime'),
+            share=d.get('share'),
+            log_archive=d.get('log_archive')
         )
 
     @classmethod
@@ -178,6 +244,50 @@ class Job(object):
 
         return cls.load(doc)
 
+    @classmethod
+    def get_many(cls, ids, ignore_missing=False):
+        """
+        Fetch several jobs with a single query, returned in the order of ids.
+        Missing jobs are None with ignore_missing, otherwise they raise a 404.
+        """
+
+        ids = [bson.ObjectId(_id) for _id in ids]
+        docs = {doc['_id']: doc for doc in config.db.jobs.find({'_id': {'$in': ids}})} if ids else {}
+
+        jobs = []
+        for _id in ids:
+            doc = docs.get(_id)
+            if doc is None and not ignore_missing:
+                raise APINotFoundException('Job {} not found'.format(_id))
+            jobs.append(cls.load(doc) if doc is not None else None)
+        return jobs
+
+    @classmethod
+    def follow_retries(cls, jobs):
+        """
+        Return the jobs with every failed job replaced by its latest retry, if it has one.
+        Retry chains are followed one step at a time for all jobs, with one query per step.
+        """
+
+        latest = list(jobs)
+        failed = collections.defaultdict(list) # failed job id -> indexes of the jobs it is the latest of
+        for i, job in enumerate(latest):
+            if job.state == 'failed' and job.id_ is not None:
+                failed[job.id_].append(i)
+        while failed:
+            next_failed = collections.defaultdict(list)
+            for doc in config.db.jobs.find({'previous_job_id': {'$in': failed.keys()}}):
+                indexes = failed.pop(doc['previous_job_id'], None)
+                if indexes is None:
+                    continue # the job was retried more than once, keep the first retry
+                retry = cls.load(doc)
+                for i in indexes:
+                    latest[i] = retry
+                if retry.state == 'failed':
+                    next_failed[retry.id_].extend(indexes)
+            failed = next_failed
+        return latest
+
     def map(self):
         """
         Flatten struct to map
@@ -207,6 +317,8 @@ class Job(object):
             d.pop('request')
         if d['failed_output_accepted'] is False:
             d.pop('failed_output_accepted')
+        if d['log_archive'] is None:
+            d.pop('log_archive')
 
         return d
 
@@ -231,10 +343,53 @@ class Job(object):
         if self.id_ is not None:
             raise Exception('Cannot insert job that has already been inserted')
 
+        if self.vtime is None:
+            self.share = scheduler.get_share(self)
+            self.vtime = scheduler.assign_vtimes(self.share)[0]
+
         result = config.db.jobs.insert_one(self.mongo())
         self.id_ = result.inserted_id
+        stats.record([self.tags], to_state=self.state)
         return result.inserted_id
 
+    @staticmethod
+    def insert_many(jobs):
+        """
+        Insert several jobs with a single write, reserving the virtual start times of
+        each share at once. Returns the inserted ids in the order of the jobs.
+        """
+
+        if any(job.id_ is not None for job in jobs):
+            raise Exception('Cannot insert job that has already been inserted')
+        if not jobs:
+            return []
+
+        by_share = collections.defaultdict(list)
+        new_jobs = [job for job in jobs if job.vtime is None]
+        for job, share in zip(new_jobs, scheduler.get_shares(new_jobs)):
+            job.share = share
+            by_share[share].append(job)
+        for share, share_jobs in by_share.iteritems():
+            for job, vtime in zip(share_jobs, scheduler.assign_vtimes(share, len(share_jobs))):
+                job.vtime = vtime
+
+        docs = [job.mongo() for job in jobs]
+        try:
+            config.db.jobs.insert_many(docs)
+        except pymongo.errors.BulkWriteError as e:
+            # The write is ordered, the jobs before the failing one were inserted
+            Job._inserted(jobs[:e.details.get('nInserted', 0)], docs)
+            raise
+        return Job._inserted(jobs, docs)
+
+    @staticmethod
+    def _inserted(jobs, docs):
+        for job, doc in zip(jobs, docs):
+            job.id_ = doc['_id']
+        for state in set(job.state for job in jobs):
+            stats.record([job.tags for job in jobs if job.state == state], to_state=state)
+        return [job.id_ for job in jobs]
+
     def save(self):
         self.modified = datetime.datetime.utcnow()
         update = self.mongo()
@@ -293,7 +448,8 @@ class Job(object):
         command_base = 'env; rm -rf output; mkdir -p output; '
         if gear['gear'].get('command') is not None:
 
-            command = render_template(gear['gear']['command'], self.config['config'])
+            template = get_command_template(str(gear.get('_id')), gear['gear']['command'])
+            command = render_template(template, self.config['config'])
 
             r['target']['command'] = ['bash', '-c', command_base + command ]
         else:
@@ -399,39 +555,177 @@ class JobTicket(object):
 
 
 class Logs(object):
+    """
+    Job logs are stored as a sequence of bucket documents per job in job_log_buckets:
+
+        {'job': <job id>, 'seq': 3, 'start': 3000, 'count': 1000, 'size': 81234, 'logs': [{'fd': 1, 'msg': '...'}, ...]}
+
+    `start` is the offset of the bucket's first log statement in the job's log. Appends
+    only touch the tail bucket and are guarded by its statement count, so concurrent
+    appends can't interleave. A new bucket is started once the tail holds
+    LOG_BUCKET_STATEMENTS statements or LOG_BUCKET_BYTES bytes of messages.
+
+    Once a job has finished, `archive` moves its log into a gzip compressed file of JSON
+    lines in the CAS, referenced from the job's `log_archive` with its statement count.
+    Buckets are marked `archived` before they are read, which makes them full: later
+    statements go to new buckets, numbered after them, that are kept when the archived
+    buckets are removed. Reads serve the archive first and then any buckets appended
+    after the archival.
+    """
 
     @staticmethod
-    def get(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def _full(bucket):
+        return bucket['archived'] or bucket['count'] >= LOG_BUCKET_STATEMENTS or bucket['size'] >= LOG_BUCKET_BYTES
+
+    @staticmethod
+    def _chunk(doc, count=0, size=0):
+        """Return the leading statements of doc that fit into a bucket of the given count and size"""
+        chunk = []
+        for stanza in doc:
+            if chunk and (count >= LOG_BUCKET_STATEMENTS or size >= LOG_BUCKET_BYTES):
+                break
+            chunk.append(stanza)
+            count += 1
+            size += len(stanza.get('msg', ''))
+        return chunk
+
+    @staticmethod
+    def _new_bucket(_id, tail, chunk):
+        return {
+            'job': _id,
+            'seq': tail['seq'] + 1 if tail else 0,
+            'start': tail['start'] + tail['count'] if tail else 0,
+            'count': len(chunk),
+            'size': sum(len(stanza.get('msg', '')) for stanza in chunk),
+            'logs': chunk,
+            'archived': False,
+        }
+
+    @staticmethod
+    def _append(tail, chunk):
+        """Return the update appending a chunk to a tail bucket, if it wasn't appended to concurrently"""
+        return (
+            {'_id': tail['_id'], 'count': tail['count'], 'archived': False},
+            {'$push': {'logs': {'$each': chunk}},
+             '$inc': {'count': len(chunk), 'size': sum(len(stanza.get('msg', '')) for stanza in chunk)}}
+        )
+
+    @staticmethod
+    def _tail(_id):
+        return config.db.job_log_buckets.find_one({'job': _id}, ['seq', 'start', 'count', 'size', 'archived'], sort=[('seq', pymongo.DESCENDING)])
+
+    @staticmethod
+    def _tails(ids):
+        """Return the tail buckets of several jobs as a job id -> bucket map"""
+        pipeline = [
+            {'$match': {'job': {'$in': list(ids)}}},
+            {'$sort': {'job': 1, 'seq': -1}},
+            {'$group': {
+                '_id': '$job',
+                'bucket': {'$first': '$_id'},
+                'seq': {'$first': '$seq'},
+                'start': {'$first': '$start'},
+                'count': {'$first': '$count'},
+                'size': {'$first': '$size'},
+                'archived': {'$first': '$archived'},
+            }},
+        ]
+        tails = {}
+        for doc in config.db.job_log_buckets.aggregate(pipeline):
+            job_id = doc['_id']
+            doc['_id'] = doc.pop('bucket')
+            tails[job_id] = doc
+        return tails
+
+    @staticmethod
+    def _get_archive(_id):
+        if not bson.ObjectId.is_valid(_id):
+            return None
+        job = config.db.jobs.find_one({'_id': bson.ObjectId(_id)}, ['log_archive'])
+        return job.get('log_archive') if job else None
+
+    @staticmethod
+    def _range(_id, offset=0, tail=None):
+        """
+        Return the offset of the first requested log statement of a job and a generator of
+        the statements from there on, or of the last `tail` statements if given. Returns
+        None if the job has no logs.
+        """
+        archive = Logs._get_archive(_id)
+        archived = archive['count'] if archive else 0
+        query = {'job': _id}
+        if archive and archive.get('buckets'):
+            query['_id'] = {'$nin': archive['buckets']} # archived, but not removed yet
+
+        first = config.db.job_log_buckets.find_one(query, ['seq', 'start'], sort=[('seq', pymongo.ASCENDING)])
+        last = config.db.job_log_buckets.find_one(query, ['seq', 'start', 'count'], sort=[('seq', pymongo.DESCENDING)])
+        if archive is None and last is None:
+            return None
+
+        # Buckets appended after archival continue the archived log
+        base = first['start'] - archived if first else 0
+        if tail is not None:
+            total = last['start'] + last['count'] - base if last else archived
+            offset = max(0, total - tail)
+        return offset, Logs._statements(query, archive, offset, base)
+
+    @staticmethod
+    def _statements(query, archive, offset, base):
+        if archive and offset < archive['count']:
+            for stanza in Logs._archived_statements(archive, offset):
+                yield stanza
+
+        first = config.db.job_log_buckets.find_one(dict(query, start={'$lte': offset + base}), ['seq'], sort=[('seq', pymongo.DESCENDING)])
+        cursor = config.db.job_log_buckets.find(dict(query, seq={'$gte': first['seq'] if first else 0}), sort=[('seq', pymongo.ASCENDING)])
+        for bucket in cursor:
+            for stanza in bucket['logs'][max(0, offset + base - bucket['start']):]:
+                yield stanza
 
-        if log is None:
-            return { '_id': _id, 'logs': [] }
+    @staticmethod
+    def _archived_statements(archive, offset=0):
+        path = os.path.join(config.get_item('persistent', 'data_path'), util.path_from_hash(archive['hash']))
+        with gzip.open(path, 'rb') as f:
+            for line in itertools.islice(f, offset, None):
+                yield json.loads(line)
+
+    @staticmethod
+    def get(_id, offset=0, tail=None):
+        """
+        Return the log statements of a job from offset on, or the last `tail` statements,
+        with the offset of the first one. Poll with offset + the number of statements
+        returned to read new statements only.
+        """
+        logs = Logs._range(_id, offset, tail)
+
+        if logs is None:
+            return { '_id': _id, 'offset': offset if tail is None else 0, 'logs': [] }
         else:
-            return log
+            offset, stanzas = logs
+            return { '_id': _id, 'offset': offset, 'logs': list(stanzas) }
 
     @staticmethod
-    def get_text_generator(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def get_text_generator(_id, offset=0, tail=None):
+        logs = Logs._range(_id, offset, tail)
 
-        if log is None:
+        if logs is None:
             yield '<span class="fd--1">No logs were found for this job.</span>'
         else:
-            for stanza in log['logs']:
+            for stanza in logs[1]:
                 msg = stanza['msg']
                 yield msg
 
     @staticmethod
-    def get_html_generator(_id):
-        log = config.db.job_logs.find_one({'_id': _id})
+    def get_html_generator(_id, offset=0, tail=None):
+        logs = Logs._range(_id, offset, tail)
 
-        if log is None:
+        if logs is None:
             yield '<span class="fd--1">No logs were found for this job.</span>'
 
         else:
             open_span = False
             last = None
 
-            for stanza in log['logs']:
+            for stanza in logs[1]:
                 fd = stanza['fd']
                 msg = stanza['msg']
 
@@ -455,9 +749,158 @@ class Logs(object):
         if len(doc) <= 0:
             return
 
-        log = config.db.job_logs.find_one({'_id': _id})
+        tail = Logs._tail(_id)
+        while doc:
+            if tail is None or Logs._full(tail):
+                chunk = Logs._chunk(doc)
+                bucket = Logs._new_bucket(_id, tail, chunk)
+                try:
+                    config.db.job_log_buckets.insert_one(bucket)
+                except pymongo.errors.DuplicateKeyError: # Race
+                    tail = Logs._tail(_id)
+                    continue
+                del bucket['logs']
+                tail = bucket
+            else:
+                chunk = Logs._chunk(doc, tail['count'], tail['size'])
+                result = config.db.job_log_buckets.update_one(*Logs._append(tail, chunk))
+                if result.modified_count != 1: # Race
+                    tail = Logs._tail(_id)
+                    continue
+                tail['count'] += len(chunk)
+                tail['size'] += sum(len(stanza.get('msg', '')) for stanza in chunk)
+            doc = doc[len(chunk):]
 
-        if log is None: # Race
-            config.db.job_logs.insert_one({'_id': _id, 'logs': []})
+    @staticmethod
+    def add_many(docs):
+        """
+        Add log statements to several jobs with a single write, given a job id -> statements
+        map. Statements that don't fit into the tail bucket of their job, or lose a race with
+        a concurrent append, are added one job at a time.
+        """
 
-        config.db.job_logs.update({'_id': _id}, {'$push':{'logs':{'$each':doc}}})
+        docs = {_id: doc for _id, doc in docs.iteritems() if len(doc) > 0}
+        if not docs:
+            return
+
+        tails = Logs._tails(docs.keys())
+        requests = []
+        expected = {} # job id -> (seq, position, statements) of the write
+        one_by_one = []
+        for _id, doc in docs.iteritems():
+            tail = tails.get(_id)
+            if tail is None or Logs._full(tail):
+                chunk = Logs._chunk(doc)
+                bucket = Logs._new_bucket(_id, tail, chunk)
+                requests.append(pymongo.InsertOne(bucket))
+                expected[_id] = (bucket['seq'], 0, chunk)
+            else:
+                chunk = Logs._chunk(doc, tail['count'], tail['size'])
+                requests.append(pymongo.UpdateOne(*Logs._append(tail, chunk)))
+                expected[_id] = (tail['seq'], tail['count'], chunk)
+            if len(chunk) < len(doc):
+                requests.pop()
+                del expected[_id]
+                one_by_one.append(_id)
+
+        if requests:
+            try:
+                result = config.db.job_log_buckets.bulk_write(requests)
+                complete = result.inserted_count + result.modified_count == len(requests)
+            except pymongo.errors.BulkWriteError:
+                complete = False
+            if not complete:
+                # Find the writes that lost a race by their statements
+                query = {'$or': [{'job': _id, 'seq': seq} for _id, (seq, _, _) in expected.iteritems()]}
+                buckets = {(b['job'], b['seq']): b['logs'] for b in config.db.job_log_buckets.find(query, ['job', 'seq', 'logs'])}
+                for _id, (seq, position, chunk) in expected.iteritems():
+                    if buckets.get((_id, seq), [])[position:position + len(chunk)] != chunk:
+                        one_by_one.append(_id)
+
+        for _id in one_by_one:
+            Logs.add(_id, docs[_id])
+
+    @staticmethod
+    def archive(_id):
+        """
+        Move the log of a finished job into a gzip compressed file of JSON lines in the CAS,
+        referenced from the job's log_archive, and remove its buckets. Logs appended after
+        an earlier archival are merged into a new archive. Returns True if the log was
+        archived.
+
+        Every step can be repeated after an interruption: the archive file only depends on
+        the log, the reference is only set if the job's archive didn't change concurrently,
+        and it lists the archived buckets until they are removed.
+        """
+        job = config.db.jobs.find_one({'_id': bson.ObjectId(_id)}, ['state', 'log_archive'])
+        if job is None or job['state'] not in LOG_ARCHIVE_STATES:
+            return False
+
+        archive = job.get('log_archive')
+        if archive and archive.get('buckets'):
+            Logs._remove_archived_buckets(_id, archive)
+            archive = {'hash': archive['hash'], 'count': archive['count']}
+
+        # Freeze the buckets to archive, concurrent appends go to new buckets from here on
+        config.db.job_log_buckets.update_many({'job': _id, 'archived': False}, {'$set': {'archived': True}})
+        buckets = [b['_id'] for b in config.db.job_log_buckets.find({'job': _id, 'archived': True}, ['_id'], sort=[('seq', pymongo.ASCENDING)])]
+        if not buckets:
+            return False
+
+        data_path = config.get_item('persistent', 'data_path')
+        count = 0
+        with tempfile.TemporaryDirectory(prefix='.tmp', dir=data_path) as tempdir_path:
+            path = os.path.join(tempdir_path, 'log.gz')
+            with files.HashingFile(path, files.DEFAULT_HASH_ALG) as f:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+                    cursor = config.db.job_log_buckets.find({'_id': {'$in': buckets}}, ['logs'], sort=[('seq', pymongo.ASCENDING)])
+                    statements = itertools.chain(
+                        Logs._archived_statements(archive) if archive else [],
+                        (stanza for bucket in cursor for stanza in bucket['logs'])
+                    )
+                    for stanza in statements:
+                        gz.write(json.dumps(stanza, sort_keys=True) + '\n')
+                        count += 1
+            hash_ = f.get_formatted_hash()
+            files.move_file(path, os.path.join(data_path, util.path_from_hash(hash_)))
+
+        query = {'_id': job['_id']}
+        if archive:
+            query['log_archive.hash'] = archive['hash']
+        else:
+            query['log_archive'] = {'$exists': False}
+        new_archive = {'hash': hash_, 'count': count, 'buckets': buckets}
+        result = config.db.jobs.update_one(query, {'$set': {'log_archive': new_archive}})
+        if result.modified_count != 1:
+            log.info('Log of job %s was archived concurrently', _id)
+            return False
+
+        Logs._remove_archived_buckets(_id, new_archive)
+        return True
+
+    @staticmethod
+    def _remove_archived_buckets(_id, archive):
+        config.db.job_log_buckets.delete_many({'_id': {'$in': archive['buckets']}})
+        config.db.jobs.update_one(
+            {'_id': bson.ObjectId(_id), 'log_archive.hash': archive['hash']},
+            {'$unset': {'log_archive.buckets': ''}}
+        )
+
+    @staticmethod
+    def archive_finished(min_age=LOG_ARCHIVE_MIN_AGE):
+        """
+        Archive the logs of the jobs that finished at least min_age seconds ago and resume
+        interrupted archivals. Returns the number of archived logs.
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=min_age)
+        job_ids = set(doc['_id'] for doc in config.db.job_log_buckets.aggregate([{'$group': {'_id': '$job'}}]))
+        job_ids.update(str(doc['_id']) for doc in config.db.jobs.find({'log_archive.buckets': {'$exists': True}}, ['_id']))
+        job_ids = [bson.ObjectId(job_id) for job_id in job_ids if bson.ObjectId.is_valid(job_id)]
+
+        archived = 0
+        for i in xrange(0, len(job_ids), 1000):
+            query = {'_id': {'$in': job_ids[i:i + 1000]}, 'state': {'$in': LOG_ARCHIVE_STATES}, 'modified': {'$lt': cutoff}}
+            for job in config.db.jobs.find(query, ['_id']):
+                if Logs.archive(str(job['_id'])):
+                    archived += 1
+        return archived
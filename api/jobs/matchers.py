@@ -0,0 +1,121 @@
+"""
+Matching of files against the inputs of a gear.
+
+Every file input of a gear has a JSON schema the files suited to it validate against.
+These schemas are nearly always a handful of constraints on file fields, such as
+
+    {'type': 'object', 'properties': {'type': {'enum': ['dicom']}, 'name': {'pattern': '\\.zip$'}}}
+
+FileMatcher compiles such schemas to plain Python predicates, and only falls back to a
+jsonschema validator for schemas using other keywords. Results are memoized on the
+values of the file fields the schema looks at, so files of the same shape (eg. every
+dicom of a project) are matched once.
+"""
+
+import json
+import re
+
+from jsonschema import Draft4Validator
+
+MATCH_CACHE_MAX_SIZE = 10000
+
+# Keywords that don't constrain the instance
+_ANNOTATIONS = set(['title', 'description', '$schema'])
+
+# Top level keywords of schemas whose result only depends on the listed properties
+_FIELD_KEYWORDS = set(['type', 'properties', 'required']) | _ANNOTATIONS
+
+# Draft 4 types, as checked by jsonschema
+_TYPES = {
+    'array':   lambda v: isinstance(v, list),
+    'boolean': lambda v: isinstance(v, bool),
+    'integer': lambda v: isinstance(v, (int, long)) and not isinstance(v, bool),
+    'null':    lambda v: v is None,
+    'number':  lambda v: isinstance(v, (int, long, float)) and not isinstance(v, bool),
+    'object':  lambda v: isinstance(v, dict),
+    'string':  lambda v: isinstance(v, basestring),
+}
+
+
+def compile_schema(schema):
+    """
+    Return a predicate of instances equivalent to validating against the schema,
+    or None if the schema uses keywords that are not supported.
+    """
+
+    if not isinstance(schema, dict):
+        return None
+
+    checks = []
+    for keyword, arg in schema.iteritems():
+        if keyword in _ANNOTATIONS:
+            continue
+
+        elif keyword == 'enum' and isinstance(arg, list):
+            checks.append(lambda v, enum=arg: v in enum)
+
+        elif keyword == 'pattern':
+            regex = re.compile(arg)
+            checks.append(lambda v, regex=regex: not isinstance(v, basestring) or regex.search(v) is not None)
+
+        elif keyword == 'type':
+            types = arg if isinstance(arg, list) else [arg]
+            if any(t not in _TYPES for t in types):
+                return None
+            type_checks = [_TYPES[t] for t in types]
+            checks.append(lambda v, type_checks=type_checks: any(check(v) for check in type_checks))
+
+        elif keyword == 'required' and isinstance(arg, list):
+            checks.append(lambda v, required=arg: not isinstance(v, dict) or all(k in v for k in required))
+
+        elif keyword == 'properties' and isinstance(arg, dict):
+            properties = {}
+            for key, subschema in arg.iteritems():
+                properties[key] = compile_schema(subschema)
+                if properties[key] is None:
+                    return None
+            checks.append(lambda v, properties=properties: not isinstance(v, dict) or
+                          all(check(v[k]) for k, check in properties.iteritems() if k in v))
+
+        elif keyword == 'items' and isinstance(arg, dict):
+            check_item = compile_schema(arg)
+            if check_item is None:
+                return None
+            checks.append(lambda v, check_item=check_item: not isinstance(v, list) or all(check_item(x) for x in v))
+
+        else:
+            return None
+
+    return lambda v: all(check(v) for check in checks)
+
+
+class FileMatcher(object):
+    """
+    Tells whether files suit a gear input, given the input's file schema.
+    Offers the is_valid method of jsonschema validators.
+    """
+
+    def __init__(self, schema):
+        self.check = compile_schema(schema)
+        self.validator = Draft4Validator(schema) if self.check is None else None
+        if set(schema) <= _FIELD_KEYWORDS:
+            self.fields = sorted(set(schema.get('properties', {})) | set(schema.get('required', [])))
+        else:
+            self.fields = None
+        self._results = {}
+
+    def shape(self, file_):
+        """Return a key of the file values the result depends on"""
+        if self.fields is not None and isinstance(file_, dict):
+            return tuple((k, json.dumps(file_[k], sort_keys=True, default=str)) for k in self.fields if k in file_)
+        return json.dumps(file_, sort_keys=True, default=str)
+
+    def is_valid(self, file_):
+        key = self.shape(file_)
+        result = self._results.get(key)
+        if result is None:
+            result = self.check(file_) if self.check is not None else self.validator.is_valid(file_)
+            if len(self._results) > MATCH_CACHE_MAX_SIZE:
+                self._results.clear()
+            self._results[key] = result
+        return result
@@ -1,14 +1,17 @@
 """
-A simple FIFO queue for jobs.
+A priority and fair share queue for jobs, see scheduler for the order jobs are started in.
 """
 
 import bson
 import copy
+import json
 import pymongo
 import datetime
 
 from .. import config
-from .jobs import Job, Logs, JobTicket
+from . import scheduler
+from . import stats
+from .jobs import Job, Logs
 from .gears import get_gear, validate_gear_config, fill_gear_default_values
 from ..dao.containerutil import create_filereference_from_dictionary, create_containerreference_from_dictionary, create_containerreference_from_filereference
 from ..web.errors import InputValidationException
@@ -24,6 +27,11 @@ JOB_STATES = [
     'cancelled' # Job has been cancelled (via a bulk job cancellation)
 ]
 
+CLAIM_ATTEMPTS = 3 # rounds of claiming candidates when claiming several jobs at once
+MAX_NEXT_JOBS = 100 # maximum number of jobs claimed by a single /jobs/next request
+ORPHAN_PAGE_SIZE = 500 # stale jobs reaped at once when scanning for orphans
+ENQUEUE_CHUNK_SIZE = 1000 # jobs inserted with a single write when enqueuing in bulk
+
 JOB_STATES_ALLOWED_MUTATE = [
     'pending',
     'running',
@@ -77,6 +85,9 @@ class Queue(object):
         if result.modified_count != 1:
             raise Exception('Job modification not saved')
 
+        if 'state' in mutation and mutation['state'] != job.state:
+            stats.record([job.tags], job.state, mutation['state'])
+
         # If the job did not succeed, check to see if job should be retried.
         if 'state' in mutation and mutation['state'] == 'failed' and retry_on_explicit_fail():
             job.state = 'failed'
@@ -104,29 +115,108 @@ class Queue(object):
             found = Job.load(check)
             raise Exception('Job ' + job.id_ + ' has already been retried as ' + str(found.id_))
 
-        new_job = copy.deepcopy(job)
-        new_job.id_ = None
-        new_job.previous_job_id = job.id_
+        return Queue.retry_many([job], force=force)[job.id_]
 
-        new_job.state = 'pending'
-        new_job.attempt += 1
+    @staticmethod
+    def retry_many(jobs, force=False):
+        """
+        Retry several failed jobs with a single insert, with the same rules as retry. Jobs
+        that exceeded their attempts, are not failed or were already retried are skipped.
+        Returns a map of job id -> retried job id, None for the skipped jobs.
+        """
+
+        retries = {job.id_: None for job in jobs}
+        candidates = []
+        for job in jobs:
+            if job.attempt >= max_attempts() and not force:
+                log.info('Permanently failed job %s (after %d attempts)', job.id_, job.attempt)
+            elif job.state != 'failed':
+                log.warning('Not retrying job %s, it is %s', job.id_, job.state)
+            else:
+                candidates.append(job)
+
+        # Best-hope attempt at not retrying jobs twice, see retry
+        query = {'previous_job_id': {'$in': [job.id_ for job in candidates]}}
+        retried = {doc['previous_job_id']: doc['_id'] for doc in config.db.jobs.find(query, ['previous_job_id'])}
 
         now = datetime.datetime.utcnow()
-        new_job.created = now
-        new_job.modified = now
+        new_jobs = []
+        for job in candidates:
+            if job.id_ in retried:
+                log.warning('Job %s has already been retried as %s', job.id_, retried[job.id_])
+                continue
 
-        new_id = new_job.insert()
-        log.info('respawned job %s as %s (attempt %d)', job.id_, new_id, new_job.attempt)
+            new_job = copy.deepcopy(job)
+            new_job.id_ = None
+            new_job.previous_job_id = job.id_
+
+            new_job.state = 'pending'
+            new_job.attempt += 1
+            new_job.vtime = None # queue the retry behind the share's current jobs
+
+            new_job.created = now
+            new_job.modified = now
+            new_jobs.append(new_job)
+
+        Job.insert_many(new_jobs)
+
+        batch_requests = []
+        for new_job in new_jobs:
+            retries[new_job.previous_job_id] = new_job.id_
+            log.info('respawned job %s as %s (attempt %d)', new_job.previous_job_id, new_job.id_, new_job.attempt)
+
+            # If job is part of batch job run, update batch jobs list
+            if new_job.batch:
+                batch_requests.append(pymongo.UpdateOne(
+                    {'jobs': new_job.previous_job_id},
+                    {'$pull': {'jobs': new_job.previous_job_id}, '$push': {'jobs': new_job.id_}}
+                ))
+        if batch_requests:
+            result = config.db.batch.bulk_write(batch_requests)
+            if result.modified_count:
+                log.info('updated %d batch job lists with retried jobs', result.modified_count)
+
+        return retries
+
+    @staticmethod
+    def heartbeat(job_ids, profiles=None):
+        """
+        Refresh the timestamp of several running jobs at once, setting the given profile
+        fields ({job_id: {field: value}}) of some of them. Returns the ids of the jobs that
+        are not running anymore.
+        """
 
-        # If job is part of batch job run, update batch jobs list
-        result = config.db.batch.update_one(
-            {'jobs': job.id_},
-            {'$pull': {'jobs': job.id_}, '$push': {'jobs': new_id}}
-        )
-        if result.modified_count == 1:
-            log.info('updated batch job list, replacing {} with {}'.format(job.id_, new_id))
+        profiles = profiles or {}
+        try:
+            ids = set(bson.ObjectId(_id) for _id in job_ids)
+            profiles = {bson.ObjectId(_id): profile for _id, profile in profiles.iteritems()}
+        except bson.errors.InvalidId as e:
+            raise InputValidationException(str(e))
+        for _id, profile in profiles.iteritems():
+            if _id not in ids:
+                raise InputValidationException('Job {} has a profile but no heartbeat'.format(_id))
+            for key in profile:
+                if key.startswith('$') or '.' in key:
+                    raise InputValidationException('Invalid profile field {}'.format(key))
+        if not ids:
+            return []
 
-        return new_id
+        now = datetime.datetime.utcnow()
+        query = {'_id': {'$in': list(ids)}, 'state': 'running'}
+        requests = [pymongo.UpdateMany(query, {'$set': {'modified': now}})]
+        for _id, profile in profiles.iteritems():
+            update = {'profile.' + key: value for key, value in profile.iteritems()}
+            if update:
+                requests.append(pymongo.UpdateOne({'_id': _id, 'state': 'running'}, {'$set': update}))
+
+        result = config.db.jobs.bulk_write(requests)
+        # Every job matched the heartbeat, and the ones with a profile matched their update
+        if result.matched_count == len(ids) + len(requests) - 1:
+            return []
+
+        # Some jobs were not running, tell which
+        running = set(doc['_id'] for doc in config.db.jobs.find(query, ['_id']))
+        return sorted(str(_id) for _id in ids - running)
 
     @staticmethod
     def enqueue_job(job_map, origin, perm_check_uid=None):
@@ -144,8 +234,53 @@ class Queue(object):
 
         """
 
-        # gear and config manifest check
-        gear_id = job_map.get('gear_id')
+        gear = Queue._get_runnable_gear(job_map.get('gear_id'))
+        job = Queue._prepare_job(gear, job_map, origin, perm_check_uid)
+        job.insert()
+        return job
+
+    @staticmethod
+    def enqueue_jobs(job_maps, origin, perm_check_uid=None, chunk_size=ENQUEUE_CHUNK_SIZE, progress=None):
+        """
+        Create and insert the jobs of several proposed job payloads, see enqueue_job.
+
+        Every job is validated and built before any is inserted, with each gear and
+        distinct config checked once. Jobs are then inserted in ordered chunks of
+        chunk_size, calling progress(inserted, total) after each chunk. If an insert
+        fails, the jobs inserted so far are cancelled before the error is raised, so no
+        part of the jobs is left to run.
+        """
+
+        gears = {}
+        valid_configs = set()
+        jobs = []
+        for job_map in job_maps:
+            gear_id = job_map.get('gear_id')
+            if gear_id not in gears:
+                gears[gear_id] = Queue._get_runnable_gear(gear_id)
+            jobs.append(Queue._prepare_job(gears[gear_id], job_map, origin, perm_check_uid, valid_configs=valid_configs))
+
+        try:
+            for i in xrange(0, len(jobs), chunk_size):
+                Job.insert_many(jobs[i:i + chunk_size])
+                if progress is not None:
+                    progress(min(i + chunk_size, len(jobs)), len(jobs))
+        except Exception:
+            inserted = [job for job in jobs if job.id_ is not None]
+            log.error('Bulk enqueue failed, cancelling the %d jobs already inserted', len(inserted))
+            for job in inserted:
+                try:
+                    Queue.mutate(job, {'state': 'cancelled'})
+                except Exception: # pylint: disable=broad-except
+                    log.warning('Could not cancel job %s', job.id_)
+            raise
+
+        return jobs
+
+    @staticmethod
+    def _get_runnable_gear(gear_id):
+        """Return the gear of a proposed job, checking it can run"""
+
         if not gear_id:
             raise InputValidationException('Job must specify gear')
 
@@ -157,8 +292,25 @@ class Queue(object):
         if gear.get('gear', {}).get('custom', {}).get('flywheel', {}).get('invalid', False):
             raise InputValidationException('Gear marked as invalid, will not run!')
 
+        return gear
+
+    @staticmethod
+    def _prepare_job(gear, job_map, origin, perm_check_uid=None, valid_configs=None):
+        """
+        Build the Job of a proposed job payload for the given gear, without inserting it.
+        Configs already in valid_configs are not validated again, and valid configs are
+        added to it.
+        """
+
+        # config manifest check
         config_ = fill_gear_default_values(gear, job_map.get('config', {}))
-        validate_gear_config(gear, config_)
+        if valid_configs is None:
+            validate_gear_config(gear, config_)
+        else:
+            config_key = (str(gear['_id']), json.dumps(config_, sort_keys=True))
+            if config_key not in valid_configs:
+                validate_gear_config(gear, config_)
+                valid_configs.add(config_key)
 
         # Translate maps to FileReferences
         inputs = {}
@@ -174,6 +326,13 @@ class Queue(object):
         attempt_n       = job_map.get('attempt_n', 1)
         previous_job_id = job_map.get('previous_job_id', None)
         batch           = job_map.get('batch', None) # A batch id if this job is part of a batch run
+        priority        = job_map.get('priority', None)
+
+        if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool)):
+            raise InputValidationException('Job priority must be an integer')
+        # Only superuser requests may queue jobs ahead of the default priority
+        if perm_check_uid and priority > scheduler.DEFAULT_PRIORITY:
+            raise InputValidationException('Only superusers can enqueue jobs with a priority above {}'.format(scheduler.DEFAULT_PRIORITY))
 
         # Add destination container, or select one
         destination = None
@@ -249,79 +408,117 @@ class Queue(object):
         if gear_name not in tags:
             tags.append(gear_name)
 
-        job = Job(str(gear['_id']), inputs, destination=destination, tags=tags, config_=config_, attempt=attempt_n, previous_job_id=previous_job_id, origin=origin, batch=batch)
-        job.insert()
-        return job
+        return Job(str(gear['_id']), inputs, destination=destination, tags=tags, config_=config_, attempt=attempt_n, previous_job_id=previous_job_id, origin=origin, batch=batch, priority=priority)
 
     @staticmethod
     def start_job(tags=None, peek=False):
         """
         Atomically change a 'pending' job to 'running' and returns it. Updates timestamp.
-        Will return None if there are no jobs to offer. Searches for jobs in FIFO order.
+        Will return None if there are no jobs to offer. Searches for jobs in scheduler order.
 
         Potential jobs must match at least one tag, if provided.
+
+        With peek, the next job is returned with its request but left pending.
         """
 
+        if not peek:
+            jobs = Queue.start_jobs(tags=tags, count=1)
+            return jobs[0] if jobs else None
+
         query = { 'state': 'pending' }
         if tags is not None:
             query['tags'] = {'$in': tags }
 
-        modification = { '$set': {
-            'state': 'running',
-            'modified': datetime.datetime.utcnow()
-        }}
-
-        if peek:
-            # placeholder noop
-            modification = {'$setOnInsert': {'1': 1}}
-
-        # Search ordering by FIFO
-        result = config.db.jobs.find_one_and_update(
-            query,
-            modification,
-            sort=[('modified', 1)],
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+        result = config.db.jobs.find_one(query, sort=scheduler.SORT)
 
         if result is None:
             return None
 
         job = Job.load(result)
 
-        if peek:
-            gear = get_gear(job.gear_id)
-            for key in gear['gear']['inputs']:
-                if gear['gear']['inputs'][key] == 'api-key':
-                    # API-key gears cannot be peeked
-                    return None
+        gear = get_gear(job.gear_id)
+        for key in gear['gear']['inputs']:
+            if gear['gear']['inputs'][key] == 'api-key':
+                # API-key gears cannot be peeked
+                return None
 
         # Return if there is a job request already (probably prefetch)
         if job.request is not None:
             log.info('Job ' + job.id_ + ' already has a request, so not generating')
             return job
 
-        # Create a new request formula
-        request = job.generate_request(get_gear(job.gear_id))
+        job.generate_request(gear)
+        return job
 
-        if peek:
-            job.request = request
-            return job
+    @staticmethod
+    def start_jobs(tags=None, count=1):
+        """
+        Atomically change up to `count` 'pending' jobs to 'running' and return them in
+        scheduler order, with their requests generated. Returns an empty list if there are no
+        jobs to offer.
 
-        # Save and return
-        result = config.db.jobs.find_one_and_update(
-            {
-                '_id': bson.ObjectId(job.id_)
-            },
-            { '$set': {
-                'request': request }
-            },
-            return_document=pymongo.collection.ReturnDocument.AFTER
-        )
+        Candidates are claimed with a single update tagged with a unique claim id, so jobs
+        raced away by a concurrent engine are simply not part of this claim. Claiming is
+        retried until enough jobs were claimed or there are no more candidates.
 
-        if result is None:
-            raise Exception('Marked job as running but could not generate and save formula')
+        Potential jobs must match at least one tag, if provided.
+        """
+
+        query = { 'state': 'pending' }
+        if tags is not None:
+            query['tags'] = {'$in': tags }
 
-        return Job.load(result)
+        claim = bson.ObjectId()
+        claimed = []
+        for _ in xrange(CLAIM_ATTEMPTS):
+            candidates = [doc['_id'] for doc in config.db.jobs.find(query, ['_id'], sort=scheduler.SORT, limit=count - len(claimed))]
+            if not candidates:
+                break
+            config.db.jobs.update_many(
+                {'_id': {'$in': candidates}, 'state': 'pending'},
+                {'$set': {'state': 'running', 'modified': datetime.datetime.utcnow(), 'claim': claim}}
+            )
+            won = set(doc['_id'] for doc in config.db.jobs.find({'_id': {'$in': candidates}, 'claim': claim}, ['_id']))
+            claimed.extend(_id for _id in candidates if _id in won)
+            if len(claimed) >= count:
+                break
+
+        if not claimed:
+            return []
+
+        docs = {doc['_id']: doc for doc in config.db.jobs.find({'_id': {'$in': claimed}})}
+        gears = {}
+        jobs = []
+        requests = []
+        try:
+            for _id in claimed:
+                job = Job.load(docs[_id])
+                update = {'$unset': {'claim': ''}}
+                if job.request is None:
+                    # Create a new request formula
+                    if job.gear_id not in gears:
+                        gears[job.gear_id] = get_gear(job.gear_id)
+                    job.generate_request(gears[job.gear_id])
+                    update['$set'] = {'request': job.request}
+                else:
+                    log.info('Job ' + job.id_ + ' already has a request, so not generating')
+                requests.append(pymongo.UpdateOne({'_id': _id}, update))
+                jobs.append(job)
+        except Exception:
+            # Fail the job without a request, and give the others back to the queue
+            log.exception('Could not generate the request of job %s', _id)
+            config.db.jobs.update_one({'_id': _id}, {'$set': {'state': 'failed'}, '$unset': {'claim': ''}})
+            config.db.jobs.update_many(
+                {'_id': {'$in': [other for other in claimed if other != _id]}},
+                {'$set': {'state': 'pending'}, '$unset': {'claim': ''}}
+            )
+            stats.record([docs[_id].get('tags', [])], 'pending', 'failed')
+            raise
+
+        config.db.jobs.bulk_write(requests)
+        stats.record([job.tags for job in jobs], 'pending', 'running')
+        scheduler.advance(max(job.vtime for job in jobs))
+        return jobs
 
     @staticmethod
     def search(containers, states=None, tags=None):
@@ -360,6 +557,9 @@ class Queue(object):
     def get_statistics(tags=None, last=None, unique=False, all_flag=False):
         """
         Return a variety of interesting information about the job queue.
+
+        State counts and unique tags are read from the job stats counters, except for
+        state counts of several tags which are counted from the jobs.
         """
 
         if all_flag:
@@ -373,15 +573,17 @@ class Queue(object):
         if tags is not None and len(tags) > 0:
             match = { 'tags': {'$in': tags } } # match only jobs with given tags
 
-        # Count jobs by state, mapping the mongo result to a useful object
-        result = list(config.db.jobs.aggregate([{'$match': match }, {'$group': {'_id': '$state', 'count': {'$sum': 1}}}]))
-        by_state = {s: 0 for s in JOB_STATES}
-        by_state.update({r['_id']: r['count'] for r in result})
+        by_state = stats.get_counts(tags)
+        if by_state is None:
+            # Count jobs by state, mapping the mongo result to a useful object
+            result = list(config.db.jobs.aggregate([{'$match': match }, {'$group': {'_id': '$state', 'count': {'$sum': 1}}}]))
+            by_state = {s: 0 for s in JOB_STATES}
+            by_state.update({r['_id']: r['count'] for r in result})
         results['states'] = by_state
 
         # List unique tags
         if unique:
-            results['unique'] = sorted(config.db.jobs.distinct('tags'))
+            results['unique'] = stats.get_tags()
 
         # List recently modified jobs for each state
         if last is not None:
@@ -393,13 +595,14 @@ class Queue(object):
     def get_pending(tags=None):
         """
         Returns the same format as get_statistics, but only the pending number.
-        Designed to be as efficient as possible for frequent polling :(
+        Designed to be as efficient as possible for frequent polling.
         """
 
-        match = { } # match all jobs
-        if tags is not None and len(tags) > 0:
-            match = { 'tags': {'$in': tags } } # match only jobs with given tags
+        by_state = stats.get_counts(tags)
+        if by_state is not None:
+            return {'states': {'pending': by_state['pending']}}
 
+        match = { 'tags': {'$in': tags } } # match only jobs with given tags
         return {
             'states': {
                 'pending': config.db.jobs.count({'$and': [match, {'state': 'pending'}]})
@@ -407,47 +610,67 @@ class Queue(object):
         }
 
     @staticmethod
-    def scan_for_orphans():
+    def scan_for_orphans(page_size=ORPHAN_PAGE_SIZE):
         """
         Scan the queue for orphaned jobs, mark them as failed, and possibly retry them.
         Should be called periodically.
+
+        Stale jobs are reaped a page at a time: jobs with a completion ticket are left
+        alone, the rest are marked failed with a single update tagged with a unique reap
+        id (so jobs that sent a heartbeat in the meantime are not part of it), and are then
+        logged and retried in bulk.
+
+        Returns a summary with the number of orphaned, retried and skipped jobs.
         """
 
-        orphaned = 0
+        summary = {'orphaned': 0, 'retried': 0, 'skipped': 0}
         query = {
             'state': 'running',
             'modified': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(seconds=100)},
         }
 
+        last_id = None
         while True:
-            orphan_candidate = config.db.jobs.find_one(query)
-            if orphan_candidate is None:
+            page_query = dict(query, _id={'$gt': last_id}) if last_id else query
+            candidates = [doc['_id'] for doc in config.db.jobs.find(page_query, ['_id'], sort=[('_id', 1)], limit=page_size)]
+            if not candidates:
                 break
+            last_id = candidates[-1]
 
-            # If the job is currently attempting to complete, do not orphan.
-            ticket = JobTicket.find(orphan_candidate['_id'])
-            if ticket is not None and len(ticket) > 0:
+            # If a job is currently attempting to complete, do not orphan.
+            ticketed = set(doc['job'] for doc in config.db.job_tickets.find({'job': {'$in': [str(_id) for _id in candidates]}}, ['job']))
+            reap_ids = [_id for _id in candidates if str(_id) not in ticketed]
+            summary['skipped'] += len(candidates) - len(reap_ids)
+            if not reap_ids:
                 continue
 
-            # CAS this job, since it does not have a ticket
-            select = { '_id': orphan_candidate['_id'] }
-
-            doc = config.db.jobs.find_one_and_update(
-                dict(query, **select),
-                {
-                    '$set': {
-                        'state': 'failed', },
-                },
-                return_document=pymongo.collection.ReturnDocument.AFTER
+            # CAS these jobs, since they do not have a ticket
+            reap = bson.ObjectId()
+            config.db.jobs.update_many(
+                dict(query, _id={'$in': reap_ids}),
+                {'$set': {'state': 'failed', 'reap': reap}}
             )
-
-            if doc is None:
-                log.info('Job %s was heartbeat during a ticket lookup and thus not orhpaned', orphan_candidate['_id'])
-            else:
-                orphaned += 1
-                j = Job.load(doc)
-                Logs.add(j.id_, [{'msg':'The job did not report in for a long time and was canceled.', 'fd':-1}])
-                new_id = Queue.retry(j)
-                Logs.add(j.id_, [{'msg': 'Retried job as ' + str(new_id) if new_id else 'Job retries exceeded maximum allowed', 'fd':-1}])
-
-        return orphaned
+            jobs = [Job.load(doc) for doc in config.db.jobs.find({'reap': reap}, {'reap': 0})]
+            config.db.jobs.update_many({'reap': reap}, {'$unset': {'reap': ''}})
+
+            if len(jobs) < len(reap_ids):
+                log.info('%d jobs were heartbeat during a ticket lookup and thus not orphaned', len(reap_ids) - len(jobs))
+            summary['orphaned'] += len(jobs)
+            summary['skipped'] += len(reap_ids) - len(jobs)
+            stats.record([j.tags for j in jobs], 'running', 'failed')
+
+            Logs.add_many({j.id_: [{'msg':'The job did not report in for a long time and was canceled.', 'fd':-1}] for j in jobs})
+            retries = Queue.retry_many(jobs)
+            messages = {}
+            for j in jobs:
+                if retries[j.id_]:
+                    messages[j.id_] = 'Retried job as ' + str(retries[j.id_])
+                elif j.attempt >= max_attempts():
+                    messages[j.id_] = 'Job retries exceeded maximum allowed'
+                else:
+                    # Skipped by retry_many, as a retry of the job exists already
+                    messages[j.id_] = 'Job was already retried'
+            Logs.add_many({job_id: [{'msg': msg, 'fd':-1}] for job_id, msg in messages.iteritems()})
+            summary['retried'] += sum(1 for new_id in retries.itervalues() if new_id)
+
+        return summary
@@ -0,0 +1,151 @@
+"""
+Order in which pending jobs are handed to engines.
+
+Jobs are claimed by descending `priority`, then by ascending `vtime`, a virtual start
+time that shares the queue fairly between users (or groups, see the `queue.fair_share`
+setting), then FIFO. Claim queries are served by the (state, priority, vtime,
+modified) index, or by the (state, tags, priority, vtime, modified) one when filtered
+by tags, so their cost does not grow with the length of the queue.
+
+Virtual start times follow start-time fair queuing. Every share has a virtual clock
+in the `job_shares` collection that advances by 1 / weight for every job it enqueues,
+and is never behind the system virtual time, the vtime of the most recently claimed
+job. A user enqueuing 50,000 jobs thus only pushes their own clock far ahead, and
+the jobs of anyone else are interleaved with them as soon as they are enqueued.
+Shares have a weight of 1 unless changed in their `job_shares` document.
+
+Batch jobs get the `queue.batch_priority` priority (lower than the default 0) unless
+a priority is given explicitly.
+"""
+
+import collections
+
+import bson
+import pymongo
+
+from .. import config
+from ..dao import containerutil
+
+log = config.log
+
+DEFAULT_PRIORITY = 0
+FAIR_SHARE_MODES = ['user', 'group', 'none']
+
+# Sort order of pending jobs, see initialize_db for the matching index
+SORT = [('priority', pymongo.DESCENDING), ('vtime', pymongo.ASCENDING), ('modified', pymongo.ASCENDING)]
+
+_SYSTEM_ID = 'job_queue' # singletons document holding the system virtual time
+
+
+def get_default_priority(batch=None):
+    """Return the priority of a job that didn't ask for one"""
+    if batch:
+        return int(config.get_item('queue', 'batch_priority'))
+    return DEFAULT_PRIORITY
+
+
+def get_share(job):
+    """Return the key of the fair share a job is accounted to"""
+    return get_shares([job])[0]
+
+
+def get_shares(jobs):
+    """
+    Return the keys of the fair shares several jobs are accounted to. In group mode the
+    groups of all destinations are resolved at once, see resolve_groups.
+    """
+    mode = config.get_item('queue', 'fair_share')
+    if mode not in FAIR_SHARE_MODES:
+        log.warning('Unknown fair share mode %s, sharing by user', mode)
+        mode = 'user'
+
+    if mode == 'none':
+        return ['all'] * len(jobs)
+
+    groups = {}
+    if mode == 'group':
+        groups = resolve_groups(set(_ref(job.destination) for job in jobs if job.destination))
+
+    shares = []
+    for job in jobs:
+        group = groups.get(_ref(job.destination)) if job.destination else None
+        if group is not None:
+            shares.append('group:' + group)
+        else:
+            # not in the group hierarchy (eg. a collection), share by origin
+            origin = job.origin or {}
+            shares.append('{}:{}'.format(origin.get('type'), origin.get('id')))
+    return shares
+
+
+def _ref(container):
+    return (container.type, str(container.id))
+
+
+# Container types from the bottom of the hierarchy up, with the field holding their parent
+_LEVELS = [('analysis', 'parent'), ('acquisition', 'session'), ('session', 'project'), ('project', 'group')]
+
+
+def resolve_groups(containers):
+    """
+    Given a set of (container type, id) pairs, return a map of them to the id of the
+    group they are in. Containers are resolved level by level, with one query per
+    level for all of them. Containers outside of the group hierarchy are left out.
+    """
+    groups = {}
+    below = collections.defaultdict(list) # ancestor (type, id) -> the given containers under it
+    for ref in containers:
+        if ref[0] == 'group':
+            groups[ref] = ref[1]
+        else:
+            below[ref].append(ref)
+
+    for cont_type, parent_field in _LEVELS:
+        level = {cont_id: refs for (type_, cont_id), refs in below.items() if type_ == cont_type}
+        ids = [bson.ObjectId(cont_id) for cont_id in level if bson.ObjectId.is_valid(cont_id)]
+        if not ids:
+            continue
+        for doc in config.db[containerutil.pluralize(cont_type)].find({'_id': {'$in': ids}}, [parent_field]):
+            parent = doc.get(parent_field)
+            if not parent:
+                continue
+            refs = level[str(doc['_id'])]
+            if parent_field == 'group':
+                for ref in refs:
+                    groups[ref] = parent
+            elif cont_type == 'analysis':
+                # Like hierarchy.get_parent_tree, only analyses of sessions are in a group
+                if parent.get('type') == 'session':
+                    below[('session', str(parent['id']))].extend(refs)
+            else:
+                below[(parent_field, str(parent))].extend(refs)
+    return groups
+
+
+def get_system_vtime():
+    doc = config.db.singletons.find_one({'_id': _SYSTEM_ID}, ['vtime'])
+    return doc['vtime'] if doc else 0.0
+
+
+def assign_vtimes(share, count=1):
+    """Reserve and return the virtual start times of `count` new jobs of a share"""
+    doc = config.db.job_shares.find_one_and_update(
+        {'_id': share},
+        {'$max': {'vtime': get_system_vtime()}, '$setOnInsert': {'weight': 1.0}},
+        upsert=True,
+        return_document=pymongo.collection.ReturnDocument.AFTER
+    )
+    step = 1.0 / (doc.get('weight') or 1.0)
+    doc = config.db.job_shares.find_one_and_update(
+        {'_id': share},
+        {'$inc': {'vtime': count * step}},
+        return_document=pymongo.collection.ReturnDocument.AFTER
+    )
+    start = doc['vtime'] - count * step
+    return [start + i * step for i in xrange(count)]
+
+
+def advance(vtime):
+    """Move the system virtual time forward to the vtime of a claimed job"""
+    if vtime is not None:
+        config.db.singletons.update_one({'_id': _SYSTEM_ID}, {'$max': {'vtime': vtime}}, upsert=True)
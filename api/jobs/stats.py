@@ -0,0 +1,108 @@
+"""
+Counters of jobs by state, for the job queue statistics.
+
+The `job_stats` collection holds one document for all jobs and one per job tag:
+
+    {'_id': 'all', 'pending': 12, 'running': 3, 'failed': 1, 'complete': 340, 'cancelled': 2}
+    {'_id': 'tag:dicom-mr-classifier', 'pending': 4, 'running': 1, ...}
+
+Counters are kept up to date incrementally with $inc deltas where jobs are inserted and
+change state (Job.insert, Queue.mutate, Queue.start_jobs and the orphan scan), so the
+statistics can be read without scanning the jobs collection. `rebuild` recomputes
+everything from the jobs and is used for backfilling and reconciliation.
+"""
+
+import collections
+
+import pymongo
+
+from .. import config
+
+log = config.log
+
+ALL = 'all'
+STATES = ['pending', 'running', 'failed', 'complete', 'cancelled']
+
+
+def _key(tag):
+    return 'tag:' + tag
+
+
+def record(tags_list, from_state=None, to_state=None):
+    """
+    Count a state change of several jobs, given the list of tags of every job. Pass no
+    from_state for inserted jobs.
+    """
+    deltas = collections.defaultdict(collections.Counter)
+    for tags in tags_list:
+        for key in [ALL] + [_key(tag) for tag in set(tags)]:
+            if from_state is not None:
+                deltas[key][from_state] -= 1
+            if to_state is not None:
+                deltas[key][to_state] += 1
+
+    requests = []
+    for key, counter in deltas.iteritems():
+        inc = {state: delta for state, delta in counter.iteritems() if delta}
+        if inc:
+            requests.append(pymongo.UpdateOne({'_id': key}, {'$inc': inc}, upsert=True))
+    if requests:
+        config.db.job_stats.bulk_write(requests)
+
+
+def get_counts(tags=None):
+    """
+    Return the number of jobs by state, of all jobs or of the jobs with the given tag.
+    Returns None for several tags, as jobs with more than one of them can't be told apart.
+    """
+    if tags and len(tags) > 1:
+        return None
+    doc = config.db.job_stats.find_one({'_id': _key(tags[0]) if tags else ALL}) or {}
+    return {state: doc.get(state, 0) for state in STATES}
+
+
+def get_tags():
+    """Return the sorted list of tags jobs have"""
+    tags = []
+    for doc in config.db.job_stats.find({'_id': {'$regex': '^tag:'}}):
+        if any(doc.get(state) for state in STATES):
+            tags.append(doc['_id'][len('tag:'):])
+    return sorted(tags)
+
+
+def compute_all():
+    """Return the expected counters as {_id: {state: count}} computed from the jobs"""
+    expected = collections.defaultdict(dict)
+    for r in config.db.jobs.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+        expected[ALL][r['_id']] = r['count']
+    pipeline = [
+        {'$project': {'state': 1, 'tags': 1}},
+        {'$unwind': '$tags'},
+        {'$group': {'_id': {'tag': '$tags', 'state': '$state'}, 'count': {'$sum': 1}}},
+    ]
+    for r in config.db.jobs.aggregate(pipeline):
+        expected[_key(r['_id']['tag'])][r['_id']['state']] = r['count']
+    return expected
+
+
+def rebuild(dry_run=False):
+    """
+    Recompute all counters, fix the documents that differ from the expected values and
+    remove the ones of tags no job has anymore. Returns the number of documents that were
+    (or with dry_run, would be) fixed or removed.
+    """
+    expected = compute_all()
+    requests = []
+    for doc in config.db.job_stats.find({}):
+        counts = expected.pop(doc['_id'], None)
+        if counts is None:
+            requests.append(pymongo.DeleteOne({'_id': doc['_id']}))
+        elif any(doc.get(state, 0) != counts.get(state, 0) for state in set(STATES) | set(counts)):
+            log.info('Fixing job stats %s: %s -> %s', doc['_id'], {s: doc.get(s, 0) for s in STATES}, counts)
+            requests.append(pymongo.ReplaceOne({'_id': doc['_id']}, counts))
+    for key, counts in expected.iteritems():
+        requests.append(pymongo.ReplaceOne({'_id': key}, counts, upsert=True))
+    if requests and not dry_run:
+        for i in xrange(0, len(requests), 1000):
+            config.db.job_stats.bulk_write(requests[i:i + 1000])
+    return len(requests)
@@ -13,7 +13,7 @@ from . import config
 from . import files
 from . import util
 from . import validators
-from .dao import containerutil, hierarchy
+from .dao import containerutil, hierarchy, rollups
 from .dao.containerstorage import SessionStorage, AcquisitionStorage
 from .jobs import rules
 from .jobs.jobs import Job, JobTicket
@@ -763,6 +763,7 @@ class AnalysisJobPlacer(Placer):
                 job.save()
 
             config.db.analyses.update_one(q, u)
+            rollups.update_files('analyses', {'_id': self.id_}, [], self.saved)
             return self.saved
 
 
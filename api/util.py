@@ -24,13 +24,20 @@ settings.configure(
 )
 django.setup()
 
+def compile_template(template):
+    """
+    Compile a django text template, for rendering it repeatedly with render_template.
+    """
+
+    return Template(template)
+
 def render_template(template, context):
     """
     Dead-simple wrapper to call django text templating.
-    Set up your own Template and Context objects if re-using heavily.
+    Takes a template string or a template compiled with compile_template.
     """
 
-    t = Template(template)
+    t = template if isinstance(template, Template) else Template(template)
     c = Context(context)
     return t.render(c)
 
@@ -0,0 +1,159 @@
+"""
+Cached central directory indexes of zip files stored in the CAS.
+
+Listing a zip or extracting one of its members normally means parsing the central
+directory of the file again on every request. Since stored files are content
+addressed, the parsed directory can be kept forever under the file hash: indexes are
+kept in the `zip_indexes` collection and in a small per-process cache.
+
+Members are extracted by seeking straight to their local header and streaming the
+(decompressed) data in chunks, so memory use does not depend on the member size.
+"""
+
+import datetime
+import struct
+import threading
+import zipfile
+import zlib
+
+import bson.errors
+import pymongo.errors
+
+from . import config
+from . import filestream
+
+log = config.log
+
+ZIP_INDEX_CACHE_SIZE = 64           # number of indexes kept in memory per process
+ZIP_INDEX_MAX_MEMBERS = 50000       # larger indexes are not persisted (mongo document size limit)
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _build_index(hash_, filepath):
+    with zipfile.ZipFile(filepath) as zf:
+        members = []
+        for zi in zf.infolist():
+            members.append({
+                'path':          zi.filename,
+                'size':          zi.file_size,
+                'compress_size': zi.compress_size,
+                'compress_type': zi.compress_type,
+                'flag_bits':     zi.flag_bits,
+                'header_offset': zi.header_offset,
+                'crc':           zi.CRC,
+                'timestamp':     datetime.datetime(*zi.date_time),
+                'comment':       zi.comment,
+            })
+        return {'_id': hash_, 'comment': zf.comment, 'members': members, 'created': datetime.datetime.utcnow()}
+
+
+def get_index(hash_, filepath):
+    """
+    Return the central directory index of the zip stored under hash_.
+
+    Raises zipfile.BadZipfile if the file is not a zip.
+    """
+    index = _cache.get(hash_)
+    if index is not None:
+        return index
+
+    index = config.db.zip_indexes.find_one({'_id': hash_})
+    if index is None:
+        index = _build_index(hash_, filepath)
+        if len(index['members']) <= ZIP_INDEX_MAX_MEMBERS:
+            try:
+                config.db.zip_indexes.insert_one(index)
+            except pymongo.errors.DuplicateKeyError:
+                pass # indexed concurrently
+            except bson.errors.InvalidStringData:
+                log.warning('Zip {} has non utf-8 member names or comments, index is not persisted'.format(hash_))
+            except pymongo.errors.DocumentTooLarge:
+                log.warning('Zip {} index exceeds the document size limit, index is not persisted'.format(hash_))
+
+    # Members by path, for member lookups (kept in memory only)
+    index['by_path'] = {m['path']: m for m in index['members']}
+
+    with _cache_lock:
+        if len(_cache) >= ZIP_INDEX_CACHE_SIZE:
+            _cache.clear()
+        _cache[hash_] = index
+    return index
+
+
+def get_zip_info(hash_, filepath):
+    """Return member and comment info for a zip, as served by ?info=true"""
+    index = get_index(hash_, filepath)
+    return {
+        'comment': index['comment'],
+        'members': [
+            {'path': m['path'], 'size': m['size'], 'timestamp': m['timestamp'], 'comment': m['comment']}
+            for m in index['members']
+        ],
+    }
+
+
+def get_member(hash_, filepath, member_path):
+    """
+    Return the index entry of a zip member.
+
+    Raises zipfile.BadZipfile if the file is not a zip, KeyError if there is no such member.
+    """
+    return get_index(hash_, filepath)['by_path'][member_path]
+
+
+def member_chunks(filepath, member, chunk_size=filestream.CHUNK_SIZE):
+    """
+    Return a generator yielding the uncompressed data of a zip member in chunks of at
+    most chunk_size bytes.
+
+    The local header is validated before returning, raising zipfile.BadZipfile if the
+    member can not be extracted.
+    """
+    if member['flag_bits'] & 0x1:
+        raise zipfile.BadZipfile('Encrypted zip members are not supported')
+    if member['compress_type'] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipfile('Unsupported zip compression {}'.format(member['compress_type']))
+
+    f = open(filepath, 'rb')
+    try:
+        f.seek(member['header_offset'])
+        header = f.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size or header[:4] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipfile('Bad local file header for member {}'.format(member['path']))
+        fields = _LOCAL_HEADER.unpack(header)
+        f.seek(fields[-2] + fields[-1], 1) # skip file name and extra field
+    except Exception:
+        f.close()
+        raise
+
+    def chunks():
+        crc = 0
+        with f:
+            compressed = filestream.read_chunks(f, member['compress_size'], chunk_size)
+            if member['compress_type'] == zipfile.ZIP_STORED:
+                for chunk in compressed:
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            else:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                for chunk in compressed:
+                    while chunk:
+                        # limit output size per call so highly compressed data can't blow up memory
+                        data = decompressor.decompress(chunk, chunk_size)
+                        chunk = decompressor.unconsumed_tail
+                        if data:
+                            crc = zlib.crc32(data, crc)
+                            yield data
+                data = decompressor.flush()
+                if data:
+                    crc = zlib.crc32(data, crc)
+                    yield data
+        if crc & 0xFFFFFFFF != member['crc']:
+            log.error('CRC mismatch extracting member {} of {}'.format(member['path'], filepath))
+
+    return chunks()
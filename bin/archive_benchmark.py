@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Measure tar archive streaming throughput with and without member read-ahead.
+
+Writes a number of small files into a CAS layout under --data-path (a temporary
+directory by default) and streams them as a tar archive the way batch downloads do,
+once for every --read-ahead setting. Point --data-path at slow storage (eg. a network
+mount) or add a simulated --latency to every file open to see the effect of read-ahead:
+
+    bin/archive_benchmark.py --files 5000 --size 4096 --data-path /mnt/nfs/bench --read-ahead 0 4 8 16
+    bin/archive_benchmark.py --files 2000 --latency 0.002
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from api import download
+from api import util
+
+
+def create_targets(data_path, count, size):
+    """Write count files of the given size into a CAS layout and return their manifest targets."""
+    targets = []
+    offset = 0
+    for i in xrange(count):
+        content = os.urandom(size)
+        hash_ = 'v0-sha384-' + hashlib.sha384(content).hexdigest()
+        filepath = os.path.join(data_path, util.path_from_hash(hash_))
+        if not os.path.exists(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        target = {'hash': hash_, 'arcpath': 'bench/file{}'.format(i), 'size': size, 'mtime': 0, 'offset': offset}
+        offset += download.tar_member_size(target)
+        targets.append(target)
+    return targets, offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure tar archive streaming throughput')
+    parser.add_argument('--files', type=int, default=2000, help='number of files in the archive')
+    parser.add_argument('--size', type=int, default=16384, help='size of each file in bytes')
+    parser.add_argument('--data-path', help='directory to write the files to (default: temporary directory)')
+    parser.add_argument('--latency', type=float, default=0, help='simulated latency of every file open in seconds')
+    parser.add_argument('--read-ahead', type=int, nargs='+', default=[0, download.READ_AHEAD], help='read-ahead settings to compare')
+    args = parser.parse_args()
+
+    if args.latency:
+        def slow_open(*a, **kw):
+            time.sleep(args.latency)
+            return open(*a, **kw)
+        download.open = slow_open
+
+    data_path = args.data_path or tempfile.mkdtemp(prefix='archive_benchmark_')
+    try:
+        targets, size = create_targets(data_path, args.files, args.size)
+        print 'files:       {}'.format(args.files)
+        print 'bytes:       {}'.format(size)
+        for read_ahead in args.read_ahead:
+            start = time.time()
+            received = 0
+            for data in download.tar_stream(targets, data_path, 0, size - 1, read_ahead=read_ahead):
+                received += len(data)
+            elapsed = time.time() - start
+            print 'read-ahead {:3d}: {:.2f} s, {:.1f} MB/s, {:.0f} files/s'.format(
+                read_ahead, elapsed, received / elapsed / 2**20, args.files / elapsed)
+    finally:
+        if not args.data_path:
+            shutil.rmtree(data_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+Archive the logs of finished jobs into gzip compressed files in the CAS and remove their
+log buckets. Meant to be run periodically; interrupted runs are resumed by the next one.
+"""
+import argparse
+import logging
+import sys
+
+from api import config
+from api.jobs.jobs import Logs, LOG_ARCHIVE_MIN_AGE
+
+
+def main(*argv):
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--min-age', type=int, default=LOG_ARCHIVE_MIN_AGE,
+                    help='only archive the logs of jobs finished at least this many seconds ago')
+    args = ap.parse_args(argv or sys.argv[1:])
+
+    archived = Logs.archive_finished(min_age=args.min_age)
+    logging.info('Archived the logs of %s jobs', archived)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    config.log.setLevel(logging.INFO)
+    main()
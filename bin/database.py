@@ -16,13 +16,15 @@ import time
 from api import config
 from api import util
 from api.dao import containerutil
+from api.dao import rollups
 from api.dao.containerstorage import ProjectStorage
-from api.jobs.jobs import Job
+from api.jobs.jobs import Job, Logs
 from api.jobs import gears
+from api.jobs import stats
 from api.types import Origin
 from api.jobs import batch
 
-CURRENT_DATABASE_VERSION = 44 # An int that is bumped when a new schema change is made
+CURRENT_DATABASE_VERSION = 48 # An int that is bumped when a new schema change is made
 
 def get_db_version():
 
@@ -1410,6 +1412,45 @@ def upgrade_to_44():
             config.db.sessions.update_many(query, update)
 
 
+def upgrade_to_45():
+    """
+    Backfill the file_rollups collection used for download summaries
+    """
+    fixed = rollups.rebuild()
+    logging.info('Created {} file rollup documents'.format(fixed))
+
+
+def upgrade_to_46():
+    """
+    Set the scheduling fields of existing jobs, so that they sort by priority and
+    virtual start time like new ones. Already queued jobs keep their FIFO order
+    ahead of jobs enqueued after the upgrade.
+    """
+    config.db.jobs.update_many({'priority': {'$exists': False}, 'batch': {'$exists': True}},
+                               {'$set': {'priority': int(config.get_item('queue', 'batch_priority'))}})
+    config.db.jobs.update_many({'priority': {'$exists': False}}, {'$set': {'priority': 0}})
+    config.db.jobs.update_many({'vtime': {'$exists': False}}, {'$set': {'vtime': 0.0}})
+
+
+def upgrade_to_47():
+    """
+    Backfill the job_stats counters used for job queue statistics
+    """
+    fixed = stats.rebuild()
+    logging.info('Created {} job stats documents'.format(fixed))
+
+
+def upgrade_to_48():
+    """
+    Move job logs from one document per job in job_logs to buckets in job_log_buckets
+    """
+    for doc in config.db.job_logs.find({}):
+        # Start over with jobs partially moved by an interrupted upgrade
+        config.db.job_log_buckets.delete_many({'job': doc['_id']})
+        Logs.add(doc['_id'], doc['logs'])
+        config.db.job_logs.delete_one({'_id': doc['_id']})
+
+
 ###
 ### BEGIN RESERVED UPGRADE SECTION
 ###
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure download throughput of a running API instance.
+
+Downloads the same URL from several concurrent clients and reports the aggregate
+throughput, eg. to compare the core.download_offload modes:
+
+    bin/download_benchmark.py https://localhost:8443/api/projects/<id>/files/<name> \\
+        --header 'Authorization: scitran-user <key>' --concurrency 8 --requests 64
+"""
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+
+def download(session, url, headers, verify):
+    """Download url, discarding the body, and return the number of bytes received."""
+    received = 0
+    r = session.get(url, headers=headers, stream=True, verify=verify)
+    r.raise_for_status()
+    for chunk in r.iter_content(chunk_size=2**20):
+        received += len(chunk)
+    return received
+
+
+def worker(url, headers, verify, count, results, lock):
+    session = requests.Session()
+    for _ in xrange(count):
+        start = time.time()
+        received = download(session, url, headers, verify)
+        with lock:
+            results.append((received, time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure download throughput')
+    parser.add_argument('url', help='URL to download')
+    parser.add_argument('--header', action='append', default=[], help='extra request header, eg. "Authorization: scitran-user <key>"')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=16, help='total number of downloads')
+    parser.add_argument('--insecure', action='store_true', help='skip TLS certificate verification')
+    args = parser.parse_args()
+
+    headers = dict(h.split(':', 1) for h in args.header)
+    headers = {k.strip(): v.strip() for k, v in headers.iteritems()}
+
+    per_worker = max(1, args.requests / args.concurrency)
+    results = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(args.url, headers, not args.insecure, per_worker, results, lock))
+               for _ in xrange(args.concurrency)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    if not results:
+        print 'No downloads completed'
+        return 1
+
+    total = sum(r[0] for r in results)
+    latencies = sorted(r[1] for r in results)
+    print 'downloads:   {}'.format(len(results))
+    print 'concurrency: {}'.format(args.concurrency)
+    print 'bytes:       {}'.format(total)
+    print 'elapsed:     {:.2f} s'.format(elapsed)
+    print 'throughput:  {:.1f} MB/s'.format(total / elapsed / 2**20)
+    print 'latency p50: {:.3f} s'.format(latencies[len(latencies) / 2])
+    print 'latency max: {:.3f} s'.format(latencies[-1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
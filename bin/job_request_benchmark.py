@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measure the cost of generating job requests, as done for every job claimed by /jobs/next.
+
+Generates the requests of a number of jobs of a gear with a complex command template,
+once compiling the command for every job and once with the compiled command template
+cache used by the queue:
+
+    bin/job_request_benchmark.py --jobs 5000 --options 40
+"""
+import argparse
+import sys
+import time
+
+import bson
+
+from api.dao.containerutil import ContainerReference
+from api.jobs import jobs
+
+
+def create_gear(options):
+    """Return a gear with a command template using loops, conditions and filters over its config."""
+    command = (
+        './run'
+        '{% for i in inputs %} --input {{ i|lower }}{% endfor %}'
+        '{% if verbose %} --verbose{% endif %}'
+        + ''.join(' {{% if option{0} %}}--option{0} {{{{ option{0}|default:"none"|cut:" " }}}}{{% endif %}}'.format(i)
+                  for i in xrange(options))
+    )
+    return {
+        '_id': bson.ObjectId(),
+        'gear': {'name': 'benchmark', 'command': command, 'environment': {}},
+        'exchange': {'rootfs-url': 'https://localhost/gear.tar', 'rootfs-hash': 'sha384:0'},
+    }
+
+
+def create_job(gear, options):
+    config = {'inputs': ['A', 'B', 'C'], 'verbose': True}
+    config.update(('option{}'.format(i), 'value {}'.format(i)) for i in xrange(options))
+    return jobs.Job(str(gear['_id']), {}, destination=ContainerReference('acquisition', str(bson.ObjectId())),
+                    config_={'config': config, 'inputs': {}}, id_=str(bson.ObjectId()), priority=0, vtime=0)
+
+
+def measure(job_list, gear, cached):
+    start = time.time()
+    for job in job_list:
+        if not cached:
+            jobs.evict_command_templates(str(gear['_id']))
+        job.generate_request(gear)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure job request generation cost')
+    parser.add_argument('--jobs', type=int, default=2000, help='number of job requests to generate')
+    parser.add_argument('--options', type=int, default=20, help='number of config options used by the command template')
+    args = parser.parse_args()
+
+    gear = create_gear(args.options)
+    job_list = [create_job(gear, args.options) for _ in xrange(args.jobs)]
+
+    print 'jobs:        {}'.format(args.jobs)
+    print 'command:     {} characters'.format(len(gear['gear']['command']))
+    for label, cached in [('compiled', False), ('cached', True)]:
+        elapsed = measure(job_list, gear, cached)
+        print '{:12} {:.2f} s, {:.0f} requests/s'.format(label + ':', elapsed, args.jobs / elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
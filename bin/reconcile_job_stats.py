@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Recompute the job queue statistics counters from the jobs and fix any counter documents
+that drifted, eg. after jobs were modified or removed outside of the API.
+"""
+import argparse
+import logging
+import sys
+
+from api import config
+from api.jobs import stats
+
+
+def main(*argv):
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--dry-run', action='store_true', help='only report the number of counters to fix')
+    args = ap.parse_args(argv or sys.argv[1:])
+
+    fixed = stats.rebuild(dry_run=args.dry_run)
+    if args.dry_run:
+        logging.info('%s job stats documents need fixing', fixed)
+    else:
+        logging.info('Fixed %s job stats documents', fixed)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    config.log.setLevel(logging.INFO)
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+Recompute the file rollups used by the download summary from the container files and
+fix any rollup documents that drifted, eg. after containers were restored together with
+their parents or modified outside of the API.
+"""
+import argparse
+import logging
+import sys
+
+from api import config
+from api.dao import rollups
+
+
+def main(*argv):
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--dry-run', action='store_true', help='only report the number of rollups to fix')
+    args = ap.parse_args(argv or sys.argv[1:])
+
+    fixed = rollups.rebuild(dry_run=args.dry_run)
+    if args.dry_run:
+        logging.info('%s file rollup documents need fixing', fixed)
+    else:
+        logging.info('Fixed %s file rollup documents', fixed)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    config.log.setLevel(logging.INFO)
+    main()
@@ -15,12 +15,14 @@ Undeleting a container without a deleted timestamp doesn't propagate, unless
 `--always-propagate` is specified.
 """
 import argparse
+import copy
 import logging
 import sys
 
 import bson
 
 from api import config
+from api.dao import rollups
 from api.dao.containerutil import pluralize, propagate_changes
 
 
@@ -86,6 +88,7 @@ def undelete(cont_name, cont_id, filename=None, include_parents=False, always_pr
         if 'deleted' in container:
             log.info('Removing "deleted" tag from %s...', cont_str)
             config.db[cont_name].update_one({'_id': cont_id}, unset_deleted)
+            rollups.add_subtree(cont_name, get_container(cont_name, cont_id))
             propagate_query = {'deleted': container['deleted']}
         elif always_propagate:
             propagate_query = {}
@@ -104,8 +107,10 @@ def undelete(cont_name, cont_id, filename=None, include_parents=False, always_pr
                     log.info('Skipping file %s - has no "deleted" tag', file_str)
                     return
                 log.info('Removing "deleted" tag from file %s...', file_str)
+                files_before = copy.deepcopy(container['files'])
                 del f['deleted']
                 config.db[cont_name].update_one({'_id': cont_id}, {'$set': {'files': container['files']}})
+                rollups.update_files(cont_name, container, files_before, container['files'])
                 break
         else:
             raise RuntimeError('Cannot find file {}'.format(file_str))
@@ -0,0 +1,56 @@
+def test_cas_download(data_builder, default_payload, as_public, as_user, as_admin, as_root, as_drone, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {
+        'dicom': {'base': 'file'},
+        'api_key': {'base': 'api-key'}
+    }
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form(('input.csv', 'input content')))
+    as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form(('other.csv', 'other content')))
+    files = {f['name']: f['hash'] for f in as_admin.get('/acquisitions/' + acquisition).json()['files']}
+    input_url = '/cas/' + '/'.join(files['input.csv'].split('-')[1:])
+    other_url = '/cas/' + '/'.join(files['other.csv'].split('-')[1:])
+
+    r = as_admin.post('/jobs/add', json={
+        'gear_id': gear,
+        'inputs': {'dicom': {'type': 'acquisition', 'id': acquisition, 'name': 'input.csv'}},
+        'config': {},
+        'destination': {'type': 'acquisition', 'id': acquisition}
+    })
+    assert r.ok
+    job = r.json()['_id']
+    assert as_root.put('/jobs/' + job, json={'state': 'running'}).ok
+    api_key = as_root.get('/jobs/' + job + '/config.json').json()['inputs']['api_key']['key']
+    as_job_key = as_public
+    as_job_key.headers.update({'Authorization': 'scitran-user ' + api_key})
+
+    # regular users and site admins can't use the endpoint
+    r = as_user.get(input_url)
+    assert r.status_code == 403
+
+    r = as_root.get(input_url)
+    assert r.status_code == 403
+
+    # job keys can download the inputs of their job only
+    r = as_job_key.get(input_url)
+    assert r.ok
+    assert r.content == 'input content'
+    assert 'immutable' in r.headers['Cache-Control']
+    assert r.headers['ETag'] == '"' + files['input.csv'] + '"'
+
+    r = as_job_key.get(input_url, headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+    r = as_job_key.get(other_url)
+    assert r.status_code == 403
+
+    # drones can download any stored file
+    r = as_drone.get(other_url)
+    assert r.ok
+    assert r.content == 'other content'
+
+    r = as_drone.get('/cas/sha384/' + '0' * 96)
+    assert r.status_code == 404
+
+    assert as_root.put('/jobs/' + job, json={'state': 'complete'}).ok
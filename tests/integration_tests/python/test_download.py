@@ -51,6 +51,14 @@ def test_download(data_builder, file_form, as_admin, api_db):
     assert r.ok
     ticket = r.json()['ticket']
 
+    # Verify the ticket only holds a summary and the targets are stored separately
+    ticket_doc = api_db.downloads.find_one({'_id': ticket})
+    assert ticket_doc['target'] is None
+    assert ticket_doc['file_cnt'] == r.json()['file_cnt']
+    chunks = list(api_db.download_targets.find({'ticket': ticket}).sort('seq', 1))
+    assert len(chunks) == ticket_doc['target_chunks']
+    assert sum(len(c['targets']) for c in chunks) == ticket_doc['file_cnt']
+
     # Perform the download
     r = as_admin.get('/download', params={'ticket': ticket})
     assert r.ok
@@ -151,6 +159,147 @@ def test_download(data_builder, file_form, as_admin, api_db):
     r = as_admin.get('/download', params={'ticket': ticket, 'symlinks': 'true'})
     assert r.ok
 
+    # Retrieve ticket for bulk download of files spread over several containers
+    r = as_admin.post('/download', params={'bulk': 'true'}, json={'files': [
+        {'container_name': 'acquisition', 'container_id': acquisition2, 'filename': file_name},
+        {'container_name': 'session', 'container_id': session, 'filename': file_name},
+        {'container_name': 'acquisition', 'container_id': acquisition, 'filename': file_name},
+        {'container_name': 'acquisition', 'container_id': acquisition, 'filename': 'nosuch.csv'},
+        {'container_name': 'acquisition', 'container_id': 'invalid', 'filename': file_name},
+    ]})
+    assert r.ok
+    assert r.json()['file_cnt'] == 3
+
+    # Verify the archive keeps the requested file order
+    r = as_admin.get('/download', params={'ticket': r.json()['ticket']})
+    assert r.ok
+    with tarfile.open(mode='r', fileobj=cStringIO.StringIO(r.content)) as tar:
+        assert [m.name for m in tar.getmembers()] == [
+            'acquisitions/' + acquisition2 + '/' + file_name,
+            'sessions/' + session + '/' + file_name,
+            'acquisitions/' + acquisition + '/' + file_name,
+        ]
+
+
+def test_zip_download(data_builder, file_form, as_admin):
+    project = data_builder.create_project(label='project1')
+    session = data_builder.create_session(label='session1')
+    acquisition = data_builder.create_acquisition(session=session)
+
+    as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form(
+        'test.csv', meta={'name': 'test.csv', 'type': 'csv'}))
+    as_admin.post('/sessions/' + session + '/files', files=file_form(
+        'test.txt', meta={'name': 'test.txt', 'type': 'text'}))
+
+    # Try to create a ticket w/ invalid format and compression
+    payload = {'optional': False, 'nodes': [{'level': 'project', '_id': project}]}
+    r = as_admin.post('/download', params={'format': 'rar'}, json=payload)
+    assert r.status_code == 400
+    r = as_admin.post('/download', params={'format': 'zip', 'compression': 'bzip2'}, json=payload)
+    assert r.status_code == 400
+    r = as_admin.post('/download', params={'compression': 'deflated'}, json=payload)
+    assert r.status_code == 400
+
+    for compression, compress_type in [('stored', zipfile.ZIP_STORED), ('deflated', zipfile.ZIP_DEFLATED)]:
+        r = as_admin.post('/download', params={'format': 'zip', 'compression': compression}, json=payload)
+        assert r.ok
+        assert r.json()['filename'].endswith('.zip')
+        ticket = r.json()['ticket']
+
+        # Symlink downloads are tar only
+        r = as_admin.get('/download', params={'ticket': ticket, 'symlinks': 'true'})
+        assert r.status_code == 400
+
+        r = as_admin.get('/download', params={'ticket': ticket})
+        assert r.ok
+
+        zip_file = zipfile.ZipFile(cStringIO.StringIO(r.content))
+        assert zip_file.testzip() is None
+        infolist = zip_file.infolist()
+        assert sorted(os.path.basename(info.filename) for info in infolist) == ['test.csv', 'test.txt']
+        assert all(info.compress_type == compress_type for info in infolist)
+
+
+def test_dedup_download(data_builder, file_form, as_admin, api_db):
+    project = data_builder.create_project(label='project1')
+    session = data_builder.create_session(label='session1')
+    acquisition = data_builder.create_acquisition(session=session)
+    acquisition2 = data_builder.create_acquisition(session=session)
+
+    # upload the same content to every acquisition and a different file to the session
+    for acq in (acquisition, acquisition2):
+        as_admin.post('/acquisitions/' + acq + '/files', files=file_form(('test.csv', 'same content')))
+    as_admin.post('/sessions/' + session + '/files', files=file_form(('other.csv', 'other content')))
+
+    payload = {'optional': False, 'nodes': [{'level': 'project', '_id': project}]}
+
+    # Try to dedup a zip download
+    r = as_admin.post('/download', params={'format': 'zip', 'dedup': 'true'}, json=payload)
+    assert r.status_code == 400
+
+    r = as_admin.post('/download', json=payload)
+    assert r.ok
+    full_size = r.json()['size']
+
+    r = as_admin.post('/download', params={'dedup': 'true'}, json=payload)
+    assert r.ok
+    assert r.json()['file_cnt'] == 3
+    assert r.json()['size'] == full_size - len('same content')
+    ticket = r.json()['ticket']
+    assert api_db.downloads.find_one({'_id': ticket})['dedup']
+
+    r = as_admin.get('/download', params={'ticket': ticket})
+    assert r.ok
+
+    tar = tarfile.open(mode='r', fileobj=cStringIO.StringIO(r.content))
+    members = tar.getmembers()
+    assert len(members) == 3
+    links = [m for m in members if m.islnk()]
+    assert len(links) == 1
+    assert tar.extractfile(links[0]).read() == 'same content'
+    tar.close()
+
+
+def test_resume_download(data_builder, file_form, as_admin, api_db):
+    project = data_builder.create_project(label='project1')
+    session = data_builder.create_session(label='session1')
+    acquisition = data_builder.create_acquisition(session=session)
+    as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form(('one.csv', 'one' * 1000)))
+    as_admin.post('/sessions/' + session + '/files', files=file_form(('two.csv', 'two' * 1000)))
+
+    r = as_admin.post('/download', json={'optional': False, 'nodes': [{'level': 'project', '_id': project}]})
+    assert r.ok
+    ticket = r.json()['ticket']
+    archive_size = api_db.downloads.find_one({'_id': ticket})['archive_size']
+
+    # the archive is the same for every download of a ticket
+    r = as_admin.get('/download', params={'ticket': ticket})
+    assert r.ok
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert int(r.headers['Content-Length']) == archive_size == len(r.content)
+    archive = r.content
+    etag = r.headers['ETag']
+    r = as_admin.get('/download', params={'ticket': ticket})
+    assert r.content == archive
+
+    # resume from the middle of the first file
+    r = as_admin.get('/download', params={'ticket': ticket}, headers={'Range': 'bytes=1000-', 'If-Range': etag})
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == 'bytes 1000-{}/{}'.format(archive_size - 1, archive_size)
+    assert r.content == archive[1000:]
+
+    r = as_admin.get('/download', params={'ticket': ticket}, headers={'Range': 'bytes=1000-3000'})
+    assert r.status_code == 206
+    assert r.content == archive[1000:3001]
+
+    # stale If-Range sends the whole archive
+    r = as_admin.get('/download', params={'ticket': ticket}, headers={'Range': 'bytes=1000-', 'If-Range': '"other"'})
+    assert r.status_code == 200
+    assert r.content == archive
+
+    r = as_admin.get('/download', params={'ticket': ticket}, headers={'Range': 'bytes={}-'.format(archive_size)})
+    assert r.status_code == 416
+
 
 def test_filelist_download(data_builder, file_form, as_admin):
     session = data_builder.create_session()
@@ -209,6 +358,56 @@ def test_filelist_download(data_builder, file_form, as_admin):
     assert r.ok
 
 
+def test_filelist_conditional_download(data_builder, as_admin, file_form):
+    session = data_builder.create_session()
+    session_files = '/sessions/' + session + '/files'
+    as_admin.post(session_files, files=file_form(('one.csv', '123456789')))
+
+    # file responses carry the stored hash as a strong etag
+    r = as_admin.get(session_files + '/one.csv')
+    assert r.ok
+    etag = r.headers['ETag']
+    assert etag == '"' + as_admin.get('/sessions/' + session).json()['files'][0]['hash'] + '"'
+
+    # unchanged content is not sent again
+    r = as_admin.get(session_files + '/one.csv', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.content == ''
+
+    r = as_admin.get(session_files + '/one.csv', headers={'If-None-Match': '"other"'})
+    assert r.ok
+    assert r.content == '123456789'
+
+    # ranges are only served if the If-Range etag is still current
+    r = as_admin.get(session_files + '/one.csv', params={'view': 'true'},
+                     headers={'Range': 'bytes=0-0', 'If-Range': etag})
+    assert r.status_code == 206
+    assert r.content == '1'
+
+    r = as_admin.get(session_files + '/one.csv', params={'view': 'true'},
+                     headers={'Range': 'bytes=0-0', 'If-Range': '"other"'})
+    assert r.status_code == 200
+    assert r.content == '123456789'
+
+    # zip members are tagged by (hash, member)
+    zip_cont = cStringIO.StringIO()
+    with zipfile.ZipFile(zip_cont, 'w') as zip_file:
+        zip_file.writestr('one.csv', 'abc')
+        zip_file.writestr('two.csv', 'def')
+    zip_cont.seek(0)
+    as_admin.post(session_files, files=file_form(('two.zip', zip_cont)))
+
+    r = as_admin.get(session_files + '/two.zip', params={'member': 'one.csv'})
+    assert r.ok
+    member_etag = r.headers['ETag']
+    r = as_admin.get(session_files + '/two.zip', params={'member': 'two.csv'})
+    assert r.ok
+    assert r.headers['ETag'] != member_etag
+
+    r = as_admin.get(session_files + '/two.zip', params={'member': 'one.csv'}, headers={'If-None-Match': member_etag})
+    assert r.status_code == 304
+
+
 def test_filelist_range_download(data_builder, as_admin, file_form):
     session = data_builder.create_session()
     session_files = '/sessions/' + session + '/files'
@@ -687,3 +886,34 @@ def test_summary(data_builder, as_admin, file_form):
     assert r.ok
     assert len(r.json()) == 1
     assert r.json().get("tabular data", {}).get("count",0) == 1
+
+    # Deleting a file is reflected in the summary of every level above it
+    r = as_admin.delete('/acquisitions/' + acquisition + '/files/' + file_name)
+    assert r.ok
+    r = as_admin.post('/download/summary', json=[{"level":"project", "_id":project}])
+    assert r.json().get("csv", {}).get("count",0) == 3
+    r = as_admin.post('/download/summary', json=[{"level":"session", "_id":session}])
+    assert r.json().get("csv", {}).get("count",0) == 1
+
+    # Changing the type of a file moves it to the new type
+    r = as_admin.put('/sessions/' + session + '/files/' + file_name, json={'type': 'text'})
+    assert r.ok
+    r = as_admin.post('/download/summary', json=[{"level":"project", "_id":project}])
+    assert r.json().get("csv", {}).get("count",0) == 2
+    assert r.json().get("text", {}).get("count",0) == 1
+
+    # Moving a session moves its files to the new project
+    project2 = data_builder.create_project(label='project2')
+    r = as_admin.put('/sessions/' + session2, json={'project': project2})
+    assert r.ok
+    r = as_admin.post('/download/summary', json=[{"level":"project", "_id":project}])
+    assert r.json().get("csv", {}).get("count",0) == 1
+    r = as_admin.post('/download/summary', json=[{"level":"project", "_id":project2}])
+    assert r.json().get("csv", {}).get("count",0) == 1
+
+    # Deleted containers are excluded
+    r = as_admin.delete('/sessions/' + session)
+    assert r.ok
+    r = as_admin.post('/download/summary', json=[{"level":"project", "_id":project}])
+    assert r.json().get("csv", {}).get("count",0) == 1
+    assert r.json().get("text", {}).get("count",0) == 0
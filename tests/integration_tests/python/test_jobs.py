@@ -16,6 +16,9 @@ def test_jobs_access(as_user):
     r = as_user.post('/jobs/reap')
     assert r.status_code == 403
 
+    r = as_user.post('/jobs/heartbeat', json={'ids': []})
+    assert r.status_code == 403
+
     r = as_user.get('/jobs/test-job')
     assert r.status_code == 403
 
@@ -123,6 +126,28 @@ def test_jobs(data_builder, default_payload, as_public, as_user, as_admin, as_ro
     assert r.ok
     assert r.text == 2 * ''.join('<span class="fd-{fd}">{msg}</span>\n'.format(**log) for log in job_logs)
 
+    # get job logs from an offset
+    r = as_admin.get('/jobs/' + job1_id + '/logs', params={'offset': 3})
+    assert r.ok
+    assert r.json()['offset'] == 3
+    assert r.json()['logs'] == job_logs[1:]
+
+    # get the tail of the job logs
+    r = as_admin.get('/jobs/' + job1_id + '/logs', params={'tail': 3})
+    assert r.ok
+    assert r.json()['offset'] == 1
+    assert r.json()['logs'] == job_logs[1:] + job_logs
+
+    r = as_admin.get('/jobs/' + job1_id + '/logs/text', params={'tail': 2})
+    assert r.ok
+    assert r.text == ''.join(log['msg'] for log in job_logs)
+
+    # try to get job logs with invalid offsets
+    r = as_admin.get('/jobs/' + job1_id + '/logs', params={'offset': -1})
+    assert r.status_code == 400
+    r = as_admin.get('/jobs/' + job1_id + '/logs/html', params={'tail': 'last'})
+    assert r.status_code == 400
+
     # get job config
     r = as_root.get('/jobs/' + job1_id + '/config.json')
     assert r.ok
@@ -330,7 +355,7 @@ def test_jobs(data_builder, default_payload, as_public, as_user, as_admin, as_ro
     api_db.jobs.insert_one(job_instance)
     r = as_root.post('/jobs/reap')
     assert r.ok
-    assert r.json().get('orphaned') == 1
+    assert r.json() == {'orphaned': 1, 'retried': 0, 'skipped': 0}
     r = as_admin.get('/jobs/'+str(job_instance['_id'])+'/logs')
     assert r.ok
     assert "The job did not report in for a long time and was canceled." in [log["msg"] for log in r.json()['logs']]
@@ -348,6 +373,101 @@ def test_jobs(data_builder, default_payload, as_public, as_user, as_admin, as_ro
     assert r.ok
 
 
+def test_jobs_next_count(data_builder, default_payload, as_admin, as_root, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {'dicom': {'base': 'file'}}
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    job_data = {
+        'gear_id': gear,
+        'inputs': {'dicom': {'type': 'acquisition', 'id': acquisition, 'name': 'test.zip'}},
+        'config': {},
+        'destination': {'type': 'acquisition', 'id': acquisition},
+        'tags': ['count-tag']
+    }
+    job_ids = []
+    for _ in range(3):
+        r = as_admin.post('/jobs/add', json=job_data)
+        assert r.ok
+        job_ids.append(r.json()['_id'])
+
+    # try invalid counts
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 'many'})
+    assert r.status_code == 400
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 0})
+    assert r.status_code == 400
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 2, 'peek': True})
+    assert r.status_code == 400
+
+    # claim two jobs in FIFO order
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 2})
+    assert r.ok
+    jobs = r.json()
+    assert [j['id'] for j in jobs] == job_ids[:2]
+    assert all(j['state'] == 'running' and j['request'] for j in jobs)
+    assert 'claim' not in as_root.get('/jobs/' + job_ids[0]).json()
+
+    # only one job left to claim
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 2})
+    assert r.ok
+    assert [j['id'] for j in r.json()] == job_ids[2:]
+
+    r = as_root.get('/jobs/next', params={'tags': 'count-tag', 'count': 2})
+    assert r.ok
+    assert r.json() == []
+
+    for job_id in job_ids:
+        assert as_root.put('/jobs/' + job_id, json={'state': 'complete'}).ok
+
+
+def test_jobs_heartbeat(data_builder, default_payload, as_admin, as_root, api_db, file_form):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {'dicom': {'base': 'file'}}
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+
+    job_data = {
+        'gear_id': gear,
+        'inputs': {'dicom': {'type': 'acquisition', 'id': acquisition, 'name': 'test.zip'}},
+        'config': {},
+        'destination': {'type': 'acquisition', 'id': acquisition},
+        'tags': ['heartbeat-tag']
+    }
+    job_ids = [as_admin.post('/jobs/add', json=job_data).json()['_id'] for _ in range(3)]
+    r = as_root.get('/jobs/next', params={'tags': 'heartbeat-tag', 'count': 3})
+    assert r.ok
+    stale = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    api_db.jobs.update_many({'_id': {'$in': [bson.ObjectId(j) for j in job_ids]}}, {'$set': {'modified': stale}})
+
+    # invalid bodies
+    r = as_root.post('/jobs/heartbeat', json={'ids': ['not-an-id']})
+    assert r.status_code == 400
+    r = as_root.post('/jobs/heartbeat', json={'ids': job_ids[:1], 'profile': {job_ids[1]: {'progress': 1}}})
+    assert r.status_code == 400
+    r = as_root.post('/jobs/heartbeat', json={'ids': job_ids[:1], 'profile': {'not-an-id': {'progress': 1}}})
+    assert r.status_code == 400
+
+    # all jobs are running
+    r = as_root.post('/jobs/heartbeat', json={'ids': job_ids, 'profile': {job_ids[0]: {'progress': 0.5}}})
+    assert r.ok
+    assert r.json() == {'not_running': []}
+    assert api_db.jobs.count({'_id': {'$in': [bson.ObjectId(j) for j in job_ids]}, 'modified': stale}) == 0
+    assert api_db.jobs.find_one({'_id': bson.ObjectId(job_ids[0])})['profile'] == {'progress': 0.5}
+
+    # cancelled jobs are reported
+    assert as_root.put('/jobs/' + job_ids[1], json={'state': 'cancelled'}).ok
+    r = as_root.post('/jobs/heartbeat', json={'ids': job_ids + [str(bson.ObjectId())]})
+    assert r.ok
+    assert len(r.json()['not_running']) == 2
+    assert job_ids[1] in r.json()['not_running']
+
+    for job_id in (job_ids[0], job_ids[2]):
+        assert as_root.put('/jobs/' + job_id, json={'state': 'complete'}).ok
+
+
 def test_failed_job_output(data_builder, default_payload, as_user, as_admin, as_drone, api_db, file_form):
     # create gear
     gear_doc = default_payload['gear']['gear']
@@ -70,3 +70,83 @@ def test_43(data_builder, api_db, as_admin, file_form, database):
     assert 'files' in analysis
     assert len(analysis['files']) == 1
     assert 'output' not in analysis['files'][0]
+
+
+def test_45(data_builder, api_db, as_admin, file_form, database):
+    project = data_builder.create_project()
+    session = data_builder.create_session(project=project)
+    acquisition = data_builder.create_acquisition(session=session)
+    as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.csv', meta={'name': 'test.csv', 'type': 'csv'}))
+    as_admin.post('/sessions/' + session + '/files', files=file_form('test.csv', meta={'name': 'test.csv', 'type': 'csv'}))
+
+    summary = as_admin.post('/download/summary', json=[{'level': 'project', '_id': project}]).json()
+    assert summary['csv']['count'] == 2
+
+    # Mimic a database without rollups
+    api_db.file_rollups.delete_many({})
+    assert as_admin.post('/download/summary', json=[{'level': 'project', '_id': project}]).json() == {}
+
+    # Verify upgrade backfills the rollups
+    database.upgrade_to_45()
+    assert as_admin.post('/download/summary', json=[{'level': 'project', '_id': project}]).json() == summary
+
+
+
+def test_46(data_builder, default_payload, api_db, as_admin, as_root, file_form, database):
+    gear_doc = default_payload['gear']['gear']
+    gear_doc['inputs'] = {'dicom': {'base': 'file'}}
+    gear = data_builder.create_gear(gear=gear_doc)
+    acquisition = data_builder.create_acquisition()
+    assert as_admin.post('/acquisitions/' + acquisition + '/files', files=file_form('test.zip')).ok
+    r = as_admin.post('/jobs/add', json={
+        'gear_id': gear,
+        'inputs': {'dicom': {'type': 'acquisition', 'id': acquisition, 'name': 'test.zip'}},
+        'config': {},
+        'tags': ['upgrade-46']
+    })
+    assert r.ok
+    job_id = bson.ObjectId(r.json()['_id'])
+
+    # Mimic a job queued before scheduling fields existed
+    api_db.jobs.update_one({'_id': job_id}, {'$unset': {'priority': '', 'vtime': '', 'share': ''}})
+
+    # Verify upgrade sets the scheduling fields
+    database.upgrade_to_46()
+    job = api_db.jobs.find_one({'_id': job_id})
+    assert job['priority'] == 0
+    assert job['vtime'] == 0
+
+    r = as_root.get('/jobs/next', params={'tags': 'upgrade-46'})
+    assert r.ok
+    assert r.json()['id'] == str(job_id)
+    assert as_root.put('/jobs/' + str(job_id), json={'state': 'complete'}).ok
+
+
+
+def test_47(data_builder, api_db, as_admin, database):
+    # Mimic a database without job stats
+    api_db.job_stats.delete_many({})
+    assert as_admin.get('/jobs/stats', params={'all': '1'}).json()['unique'] == []
+
+    # Verify upgrade backfills the counters
+    database.upgrade_to_47()
+    stats = as_admin.get('/jobs/stats', params={'all': '1'}).json()
+    assert stats['states'] == {state: api_db.jobs.count({'state': state}) for state in stats['states']}
+    assert stats['unique'] == sorted(api_db.jobs.distinct('tags'))
+
+
+def test_48(data_builder, api_db, as_admin, database, mocker):
+    job_id = str(bson.ObjectId())
+    logs = [{'fd': 1, 'msg': 'line {}\n'.format(i)} for i in range(25)]
+
+    # Mimic old-style job logs
+    api_db.job_logs.insert_one({'_id': job_id, 'logs': logs})
+
+    # Verify upgrade moves the logs into buckets
+    mocker.patch('api.jobs.jobs.LOG_BUCKET_STATEMENTS', 10)
+    database.upgrade_to_48()
+    assert api_db.job_logs.find_one({'_id': job_id}) is None
+    buckets = list(api_db.job_log_buckets.find({'job': job_id}, sort=[('seq', 1)]))
+    assert [(b['seq'], b['start'], b['count']) for b in buckets] == [(0, 0, 10), (1, 10, 10), (2, 20, 5)]
+    assert sum((b['logs'] for b in buckets), []) == logs
+    api_db.job_log_buckets.delete_many({'job': job_id})
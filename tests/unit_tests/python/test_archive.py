@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import cStringIO
+import os
+import zipfile
+import zlib
+
+from api import archive
+
+
+def chunked(data, size=1000):
+    for i in xrange(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_ordered_imap():
+    assert list(archive.ordered_imap(lambda x: x * 2, xrange(100), ahead=3)) == range(0, 200, 2)
+
+
+def test_deflate_chunks_concatenate():
+    data = os.urandom(5000) + 'a' * 5000
+    stream = ''.join(archive.deflate_chunk(chunk) for chunk in chunked(data)) + archive._DEFLATE_END
+    assert zlib.decompress(stream, -zlib.MAX_WBITS) == data
+
+
+def test_zip_stream():
+    data = os.urandom(5000) + 'a' * 5000
+    for compression in archive.ZIP_COMPRESSIONS:
+        members = [
+            archive.ZipMember('dir/data.bin', chunked(data), mtime=1500000000, context=1),
+            archive.ZipMember(u'dir/é.txt', chunked('hello'), context=2),
+            archive.ZipMember('data.gz', chunked(data), context=3),
+            archive.ZipMember('empty', chunked(''), context=4),
+        ]
+        done = []
+        stream = ''.join(archive.ZipStream(compression).iter_bytes(members, lambda m: done.append(m.context)))
+        assert done == [1, 2, 3, 4]
+
+        zf = zipfile.ZipFile(cStringIO.StringIO(stream))
+        assert zf.testzip() is None
+        assert [i.filename for i in zf.infolist()] == ['dir/data.bin', u'dir/é.txt', 'data.gz', 'empty']
+        assert zf.read('dir/data.bin') == data
+        assert zf.read('data.gz') == data
+        assert zf.read('empty') == ''
+        assert zf.getinfo('dir/data.bin').date_time == (2017, 7, 14, 2, 40, 0)
+        deflated = compression == archive.ZIP_DEFLATED
+        assert zf.getinfo('dir/data.bin').compress_type == (zipfile.ZIP_DEFLATED if deflated else zipfile.ZIP_STORED)
+        assert zf.getinfo('data.gz').compress_type == zipfile.ZIP_STORED
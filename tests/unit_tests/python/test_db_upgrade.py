@@ -28,11 +28,11 @@ def test_get_db_version_from_config():
 
 
 @pytest.fixture(scope='function')
-def database_mock_setup():
-    setattr(config.db.singletons, 'update_one', Mock())
+def database_mock_setup(mocker):
+    mocker.patch.object(config.db.singletons, 'update_one')
     for i in range(1, CDV):
         script_name = 'upgrade_to_{}'.format(i)
-        setattr(database, script_name, Mock())
+        mocker.patch.object(database, script_name)
 
 @patch('database.get_db_version', Mock(return_value=0))
 def test_all_upgrade_scripts_ran(database_mock_setup):
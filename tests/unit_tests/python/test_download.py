@@ -0,0 +1,103 @@
+import cStringIO
+import datetime
+import os
+import tarfile
+
+from api import download
+from api import util
+
+
+def test_tar_layout():
+    stream = cStringIO.StringIO()
+    with tarfile.open(mode='w|', fileobj=stream) as tar:
+        tarinfo = tarfile.TarInfo(name='a' * 150)
+        tarinfo.size = 700
+        tar.addfile(tarinfo, cStringIO.StringIO('x' * 700))
+    target = {'arcpath': 'a' * 150, 'size': 700, 'mtime': 0}
+    member_size = download.tar_member_size(target)
+    assert member_size + len(download.tar_trailer(member_size)) == len(stream.getvalue())
+
+
+def test_archivestream_ranges(mocker, tmpdir, api_db):
+    data_path = str(tmpdir)
+    mocker.patch('api.config.get_item', return_value=data_path)
+    contents = ['first file', 'second file' * 1000, '']
+    hashes = []
+    for i, content in enumerate(contents):
+        hash_ = 'v0-sha384-{:02d}ab'.format(i)
+        filepath = os.path.join(data_path, util.path_from_hash(hash_))
+        os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'w') as f:
+            f.write(content)
+        hashes.append(hash_)
+
+    manifest = download.TargetManifest(dedup=True)
+    modified = datetime.datetime(2017, 1, 1)
+    for i, hash_ in enumerate(hashes + hashes[:1]):
+        manifest.append(hash_, 'dir/file{}'.format(i), 'sessions', 'id', len(contents[i % 3]), modified)
+    ticket = manifest.create_ticket('127.0.0.1', {}, 'test.tar')
+
+    handler = object.__new__(download.Download)
+    handler.log_user_access = mocker.MagicMock()
+    handler._refresh_ticket = mocker.MagicMock()
+
+    archive = ''.join(handler.archivestream(ticket, data_path))
+    assert len(archive) == ticket['archive_size']
+    assert ''.join(handler.archivestream(ticket, data_path)) == archive
+    assert handler.log_user_access.call_count == 8
+
+    with tarfile.open(mode='r', fileobj=cStringIO.StringIO(archive)) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == ['dir/file0', 'dir/file1', 'dir/file2', 'dir/file3']
+        assert members[3].islnk() and members[3].linkname == 'dir/file0'
+        assert tar.extractfile(members[1]).read() == contents[1]
+        assert all(m.mtime == 1483228800 for m in members)
+
+    for first, last in [(0, 0), (100, 600), (511, 11000), (len(archive) - 10, len(archive) - 1)]:
+        assert ''.join(handler.archivestream(ticket, data_path, first, last)) == archive[first:last + 1]
+
+
+def make_targets(data_path):
+    targets = []
+    offset = 0
+    for i in range(20):
+        hash_ = 'v0-sha384-{:02d}cd'.format(i)
+        filepath = os.path.join(data_path, util.path_from_hash(hash_))
+        os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'w') as f:
+            f.write(str(i) * i * 100)
+        target = {'hash': hash_, 'arcpath': 'file{}'.format(i), 'size': i * len(str(i)) * 100, 'mtime': 0, 'offset': offset}
+        offset += download.tar_member_size(target)
+        targets.append(target)
+    return targets, offset
+
+
+def test_tar_stream_read_ahead(tmpdir):
+    data_path = str(tmpdir)
+    targets, offset = make_targets(data_path)
+    streamed = []
+    serial = ''.join(download.tar_stream(targets, data_path, 0, offset - 1, read_ahead=0))
+    ahead = ''.join(download.tar_stream(targets, data_path, 0, offset - 1, streamed.append, read_ahead=4))
+    assert serial == ahead
+    assert len(ahead) == offset
+    assert streamed == targets
+    assert ''.join(download.tar_stream(targets, data_path, 3000, 9000, read_ahead=4)) == ahead[3000:9001]
+
+
+def test_tar_stream_disconnect(mocker, tmpdir):
+    data_path = str(tmpdir)
+    targets, offset = make_targets(data_path)
+    opened = []
+    def tracking_open(*args):
+        f = open(*args)
+        opened.append(f)
+        return f
+    mocker.patch('api.download.open', tracking_open, create=True)
+
+    # The client disconnects while files of the next targets are open
+    stream = download.tar_stream(targets, data_path, 0, offset - 1, read_ahead=4)
+    next(stream)
+    next(stream)
+    stream.close()
+    assert len(opened) > 1
+    assert all(f.closed for f in opened)
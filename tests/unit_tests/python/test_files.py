@@ -29,3 +29,28 @@ def test_tabular_data():
 
 def test_unknown():
     assert files.guess_type_from_filename('example.unknown') == None
+
+def test_find_existing_hashes(mocker, tmpdir):
+    mocker.patch('api.config.get_item', return_value=str(tmpdir))
+    files._cas_check_cache.clear()
+
+    present = ['v0-sha384-01b395a1', 'v0-sha384-01b3ffff', 'v0-sha384-aabbcc00']
+    missing = ['v0-sha384-01b30000', 'v0-sha384-ddeeff00']
+    for hash_ in present:
+        path = tmpdir.join(files.util.path_from_hash(hash_))
+        path.ensure()
+
+    assert files.find_existing_hashes(present + missing) == set(present)
+
+    # directories with many candidates are listed instead
+    files._cas_check_cache.clear()
+    mocker.patch('api.files.CAS_LISTDIR_MIN_HASHES', 2)
+    listdir = mocker.spy(files.os, 'listdir')
+    assert files.find_existing_hashes(present + missing) == set(present)
+    assert listdir.call_count == 1
+
+    # results are cached by hash
+    tmpdir.join(files.util.path_from_hash(present[0])).remove()
+    assert files.find_existing_hashes([present[0]]) == set([present[0]])
+    files._cas_check_cache.clear()
+    assert files.find_existing_hashes([present[0]]) == set()
@@ -0,0 +1,91 @@
+import webob
+
+from api import filestream
+
+
+def test_file_chunks(tmpdir):
+    path = tmpdir.join('file')
+    path.write('0123456789')
+    assert ''.join(filestream.file_chunks(str(path), chunk_size=3)) == '0123456789'
+    assert list(filestream.file_chunks(str(path), offset=2, length=5, chunk_size=3)) == ['234', '56']
+    assert list(filestream.file_chunks(str(path), offset=8, length=5)) == ['89']
+
+
+def test_set_file_body(mocker, tmpdir):
+    path = tmpdir.join('file')
+    path.write('0123456789')
+    settings = {'download_offload': 'none', 'download_offload_prefix': '/_cas/'}
+    mocker.patch('api.config.get_item', side_effect=lambda section, key: settings[key])
+
+    response = webob.Response()
+    filestream.set_file_body(response, {}, str(path), 'v0-sha384-abcd', 10)
+    assert response.body == '0123456789'
+    assert response.headers['Content-Length'] == '10'
+
+    settings['download_offload'] = 'x-accel'
+    response = webob.Response()
+    filestream.set_file_body(response, {}, str(path), 'v0-sha384-abcd', 10)
+    assert response.body == ''
+    assert response.headers['X-Accel-Redirect'].startswith('/_cas/v0/sha384/')
+
+    settings['download_offload'] = 'sendfile'
+    wrapper = mocker.MagicMock(return_value=['0123456789'])
+    response = webob.Response()
+    filestream.set_file_body(response, {'wsgi.file_wrapper': wrapper}, str(path), 'v0-sha384-abcd', 10)
+    assert wrapper.called
+    assert response.headers['Content-Length'] == '10'
+
+
+def test_resolve_ranges():
+    assert filestream.resolve_ranges([(0, 0), (2, None), (-3, None), (-20, None), (5, 20)], 10) == \
+        [(0, 0), (2, 9), (7, 9), (0, 9), (5, 9)]
+
+
+def test_set_range_body(tmpdir):
+    path = tmpdir.join('file')
+    path.write('123456789')
+
+    response = webob.Response()
+    filestream.set_range_body(response, str(path), [(-5, None)], 9, 'text/csv', 'b')
+    assert response.body == '56789'
+    assert response.headers['Content-Range'] == 'bytes 4-8/9'
+    assert response.headers['Content-Length'] == '5'
+
+    response = webob.Response()
+    filestream.set_range_body(response, str(path), [(1, 2), (3, 4)], 9, 'text/csv', 'b')
+    assert response.headers['Content-Length'] == str(len(response.body))
+    assert response.body == '--b\nContent-Type: text/csv\nContent-Range: bytes 1-2/9\n\n23\n' \
+                            '--b\nContent-Type: text/csv\nContent-Range: bytes 3-4/9\n\n45\n'
+
+
+def test_make_etag():
+    assert filestream.make_etag('v0-sha384-abcd') == '"v0-sha384-abcd"'
+    member_etag = filestream.make_etag('v0-sha384-abcd', u'dir/f\xfcle.txt')
+    assert member_etag.startswith('"v0-sha384-abcd-') and member_etag.endswith('"')
+    assert member_etag != filestream.make_etag('v0-sha384-abcd', 'dir/other.txt')
+
+
+def test_check_not_modified():
+    etag = filestream.make_etag('v0-sha384-abcd')
+
+    response = webob.Response()
+    assert not filestream.check_not_modified(webob.Request.blank('/'), response, etag)
+    assert response.headers['ETag'] == etag
+
+    request = webob.Request.blank('/', headers={'If-None-Match': '"other"'})
+    assert not filestream.check_not_modified(request, webob.Response(), etag)
+
+    for header in (etag, '"other", ' + etag, 'W/' + etag, '*'):
+        response = webob.Response()
+        request = webob.Request.blank('/', headers={'If-None-Match': header})
+        assert filestream.check_not_modified(request, response, etag)
+        assert response.status_int == 304
+        assert response.body == ''
+
+
+def test_if_range_matches():
+    etag = filestream.make_etag('v0-sha384-abcd')
+    assert filestream.if_range_matches(webob.Request.blank('/'), etag)
+    assert filestream.if_range_matches(webob.Request.blank('/', headers={'If-Range': etag}), etag)
+    assert not filestream.if_range_matches(webob.Request.blank('/', headers={'If-Range': '"other"'}), etag)
+    assert not filestream.if_range_matches(webob.Request.blank('/', headers={'If-Range': 'W/' + etag}), etag)
@@ -0,0 +1,55 @@
+import bson
+
+from api.jobs import gears
+
+
+def gear_doc(name, version):
+    return {'_id': bson.ObjectId(), 'gear': {'name': name, 'version': version, 'inputs': {}, 'config': {}}}
+
+
+def test_gear_registry(api_db, mocker):
+    api_db.gears.delete_many({})
+    gears.invalidate_gear_registry()
+    old, new = gear_doc('registry-gear', '1'), gear_doc('registry-gear', '2')
+    api_db.gears.insert_many([old, new])
+    aggregate = mocker.patch('api.jobs.gears._aggregate_gears', return_value=[new])
+
+    # The latest versions are aggregated once and then served by name
+    assert gears.get_gear_by_name('registry-gear')['_id'] == new['_id']
+    assert [g['_id'] for g in gears.get_gears()] == [new['_id']]
+    assert aggregate.call_count == 1
+
+    # Returned documents are copies, callers can't change the cached ones
+    assert gears.get_gear(str(old['_id']))['gear']['version'] == '1'
+    gears.get_gear(str(old['_id']))['gear']['version'] = 'x'
+    assert gears.get_gear(str(old['_id']))['gear']['version'] == '1'
+
+    # Writes through the registry drop it
+    gears.invalidate_gear_registry()
+    assert gears.get_gear_by_name('registry-gear')['_id'] == new['_id']
+    assert aggregate.call_count == 2
+
+    # Other processes drop their registry once they see the generation changed
+    assert gears.get_gear(str(old['_id'])) is not None
+    api_db.gears.delete_one({'_id': old['_id']})
+    assert gears.get_gear(str(old['_id'])) is not None
+    api_db.singletons.update_one({'_id': 'gears'}, {'$inc': {'generation': 1}})
+    gears._registry['checked'] = 0
+    assert gears.get_gear(str(old['_id'])) is None
+
+    api_db.gears.delete_many({})
+    gears.invalidate_gear_registry()
+
+
+def test_gear_validator_cache(mocker):
+    derive = mocker.patch('api.jobs.gears.gear_tools.derive_invocation_schema', return_value={})
+    mocker.patch('api.jobs.gears.gear_tools.isolate_config_invocation', return_value={'type': 'object'})
+    gear = {'_id': bson.ObjectId(), 'manifest': {'config': {'speed': {'type': 'integer'}}}}
+
+    validator = gears.get_config_validator(gear)
+    assert gears.validate_gear_config(gear, {})
+    assert gears.get_config_validator(gear) is validator
+    assert derive.call_count == 1
+
+    gears.invalidate_gear_registry()
+    assert gears.get_config_validator(gear) is not validator
@@ -0,0 +1,43 @@
+import bson
+import pytest
+
+from api.jobs import gears
+from api.jobs.jobs import Job
+from api.jobs.queue import Queue
+
+
+def test_enqueue_jobs(api_db, mocker):
+    gear_id = str(api_db.gears.insert_one({
+        'gear': {'name': 'bulk-gear', 'inputs': {}, 'config': {}},
+        'exchange': {'rootfs-url': 'https://localhost/gear.tar', 'rootfs-hash': 'sha384:0'},
+    }).inserted_id)
+    gears.invalidate_gear_registry()
+    validate = mocker.patch('api.jobs.queue.validate_gear_config', return_value=True)
+    job_maps = [{'gear_id': gear_id, 'config': {'speed': 1}, 'tags': ['bulk'], 'batch': 'batch-id',
+                 'destination': {'type': 'acquisition', 'id': str(bson.ObjectId())}} for _ in range(25)]
+    progress = []
+
+    jobs = Queue.enqueue_jobs(job_maps, {'type': 'user', 'id': 'user@example.com'}, chunk_size=10,
+                              progress=lambda inserted, total: progress.append((inserted, total)))
+    assert progress == [(10, 25), (20, 25), (25, 25)]
+    assert validate.call_count == 1
+    assert [job.id_ for job in jobs] == [doc['_id'] for doc in api_db.jobs.find({'tags': 'bulk'}).sort('_id', 1)]
+    assert all(job.tags == ['bulk', 'bulk-gear'] for job in jobs)
+
+    # A failed insert cancels the jobs inserted so far
+    api_db.jobs.delete_many({'tags': 'bulk'})
+    insert_many = Job.insert_many
+    def fail_second_chunk(chunk):
+        if api_db.jobs.count({'tags': 'bulk'}):
+            raise Exception('insert failed')
+        return insert_many(chunk)
+    mocker.patch('api.jobs.queue.Job.insert_many', side_effect=fail_second_chunk)
+
+    with pytest.raises(Exception):
+        Queue.enqueue_jobs(job_maps, {'type': 'user', 'id': 'user@example.com'}, chunk_size=10)
+    assert api_db.jobs.count({'tags': 'bulk'}) == 10
+    assert api_db.jobs.count({'tags': 'bulk', 'state': 'cancelled'}) == 10
+
+    api_db.jobs.delete_many({'tags': 'bulk'})
+    api_db.gears.delete_one({'_id': bson.ObjectId(gear_id)})
+    gears.invalidate_gear_registry()
@@ -0,0 +1,95 @@
+import datetime
+
+import mock
+
+from api.jobs.jobs import Logs
+
+
+def test_log_buckets(mocker, api_db):
+    mocker.patch('api.jobs.jobs.LOG_BUCKET_STATEMENTS', 4)
+    mocker.patch('api.jobs.jobs.LOG_BUCKET_BYTES', 20)
+    logs = [{'fd': 1, 'msg': str(i)} for i in range(10)]
+
+    Logs.add('job', logs[:3])
+    Logs.add('job', logs[3:6])
+    Logs.add_many({'job': logs[6:7], 'other': logs[:1], 'none': []})
+    Logs.add('job', [{'fd': 2, 'msg': 'x' * 30}] + logs[7:])
+    buckets = list(api_db.job_log_buckets.find({'job': 'job'}, sort=[('seq', 1)]))
+    assert [(b['seq'], b['start'], b['count']) for b in buckets] == [(0, 0, 4), (1, 4, 4), (2, 8, 3)]
+    assert api_db.job_log_buckets.count({'job': 'other'}) == 1
+
+    expected = logs[:7] + [{'fd': 2, 'msg': 'x' * 30}] + logs[7:]
+    assert Logs.get('job') == {'_id': 'job', 'offset': 0, 'logs': expected}
+    assert Logs.get('job', offset=5)['logs'] == expected[5:]
+    assert Logs.get('job', offset=20) == {'_id': 'job', 'offset': 20, 'logs': []}
+    assert Logs.get('job', tail=3) == {'_id': 'job', 'offset': 8, 'logs': expected[8:]}
+    assert Logs.get('none', offset=2) == {'_id': 'none', 'offset': 2, 'logs': []}
+    assert ''.join(Logs.get_text_generator('job', offset=7)) == 'x' * 30 + '789'
+    assert list(Logs.get_html_generator('other')) == ['<span class="fd-1">', '0', '</span>\n']
+    api_db.job_log_buckets.delete_many({})
+
+
+def test_log_archive(mocker, tmpdir, api_db):
+    mocker.patch('api.jobs.jobs.LOG_BUCKET_STATEMENTS', 4)
+    mocker.patch('api.config.get_item', return_value=str(tmpdir))
+    job_id = api_db.jobs.insert_one({'state': 'running', 'modified': datetime.datetime(2017, 1, 1)}).inserted_id
+    _id = str(job_id)
+    logs = [{'fd': 1, 'msg': 'line {}\n'.format(i)} for i in range(10)]
+    Logs.add(_id, logs[:6])
+
+    # Logs of unfinished jobs are not archived
+    assert Logs.archive_finished() == 0
+    api_db.jobs.update_one({'_id': job_id}, {'$set': {'state': 'complete'}})
+    assert Logs.archive_finished() == 1
+    assert api_db.job_log_buckets.count({'job': _id}) == 0
+    archive = api_db.jobs.find_one({'_id': job_id})['log_archive']
+    assert archive['count'] == 6 and 'buckets' not in archive
+    assert Logs.get(_id) == {'_id': _id, 'offset': 0, 'logs': logs[:6]}
+    assert Logs.archive_finished() == 0
+
+    # Late logs continue the archived log and are merged into a new archive
+    Logs.add(_id, logs[6:])
+    assert Logs.get(_id, offset=4)['logs'] == logs[4:]
+    assert Logs.get(_id, tail=5) == {'_id': _id, 'offset': 5, 'logs': logs[5:]}
+    assert ''.join(Logs.get_text_generator(_id, offset=8)) == 'line 8\nline 9\n'
+    assert Logs.archive(_id)
+    merged = api_db.jobs.find_one({'_id': job_id})['log_archive']
+    assert merged['count'] == 10 and merged['hash'] != archive['hash']
+    assert Logs.get(_id)['logs'] == logs
+
+    # Interrupted archivals are resumed and don't duplicate statements
+    bucket = api_db.job_log_buckets.insert_one({'job': _id, 'seq': 0, 'start': 0, 'count': 4, 'size': 28, 'logs': logs[6:]}).inserted_id
+    api_db.jobs.update_one({'_id': job_id}, {'$set': {'log_archive.buckets': [bucket]}})
+    assert Logs.get(_id)['logs'] == logs
+    assert Logs.archive_finished() == 0
+    assert api_db.job_log_buckets.count({'job': _id}) == 0
+    assert api_db.jobs.find_one({'_id': job_id})['log_archive'] == {'hash': merged['hash'], 'count': 10}
+    api_db.jobs.delete_one({'_id': job_id})
+
+
+def test_log_archive_concurrent_append(mocker, tmpdir, api_db):
+    mocker.patch('api.jobs.jobs.LOG_BUCKET_STATEMENTS', 4)
+    mocker.patch('api.config.get_item', return_value=str(tmpdir))
+    job_id = api_db.jobs.insert_one({'state': 'complete', 'modified': datetime.datetime(2017, 1, 1)}).inserted_id
+    _id = str(job_id)
+    logs = [{'fd': 1, 'msg': 'line {}\n'.format(i)} for i in range(8)]
+    Logs.add(_id, logs[:3])
+
+    # The archival stops before removing the archived buckets
+    with mock.patch('api.jobs.jobs.Logs._remove_archived_buckets'):
+        assert Logs.archive(_id)
+
+    # Appends don't touch the archived tail bucket, and continue its numbering
+    Logs.add(_id, logs[3:5])
+    Logs.add_many({_id: logs[5:8]})
+    buckets = list(api_db.job_log_buckets.find({'job': _id}, sort=[('seq', 1)]))
+    assert [(b['seq'], b['start'], b['count'], b['archived']) for b in buckets] == \
+        [(0, 0, 3, True), (1, 3, 4, False), (2, 7, 1, False)]
+    assert Logs.get(_id)['logs'] == logs
+
+    # Resuming removes the archived buckets only
+    assert Logs.archive(_id)
+    assert api_db.job_log_buckets.count({'job': _id}) == 0
+    assert api_db.jobs.find_one({'_id': job_id})['log_archive']['count'] == 8
+    assert Logs.get(_id)['logs'] == logs
+    api_db.jobs.delete_one({'_id': job_id})
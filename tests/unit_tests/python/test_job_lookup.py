@@ -0,0 +1,43 @@
+import datetime
+
+import bson
+import pytest
+
+from api.jobs.jobs import Job
+from api.web.errors import APINotFoundException
+
+
+def insert_job(api_db, state='failed', previous_job_id=None):
+    now = datetime.datetime.utcnow()
+    return str(api_db.jobs.insert_one({
+        'gear_id': str(bson.ObjectId()), 'tags': ['lookup'], 'attempt': 1, 'state': state,
+        'created': now, 'modified': now, 'previous_job_id': previous_job_id,
+        'destination': {'type': 'acquisition', 'id': str(bson.ObjectId())},
+    }).inserted_id)
+
+
+def test_get_many(api_db):
+    ids = [insert_job(api_db) for _ in range(3)]
+    missing = str(bson.ObjectId())
+
+    assert [job.id_ for job in Job.get_many(ids[::-1])] == ids[::-1]
+    assert Job.get_many([]) == []
+    assert [job and job.id_ for job in Job.get_many([ids[0], missing], ignore_missing=True)] == [ids[0], None]
+    with pytest.raises(APINotFoundException):
+        Job.get_many([ids[0], missing])
+
+    api_db.jobs.delete_many({'tags': 'lookup'})
+
+
+def test_follow_retries(api_db):
+    # a failed twice and was retried to a3, b failed without retry, c completed
+    a1 = insert_job(api_db)
+    a2 = insert_job(api_db, previous_job_id=a1)
+    a3 = insert_job(api_db, state='running', previous_job_id=a2)
+    b = insert_job(api_db)
+    c = insert_job(api_db, state='complete')
+
+    jobs = Job.follow_retries(Job.get_many([a1, b, c, a2, a1]))
+    assert [job.id_ for job in jobs] == [a3, b, c, a3, a3]
+
+    api_db.jobs.delete_many({'tags': 'lookup'})
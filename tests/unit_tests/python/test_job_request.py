@@ -0,0 +1,30 @@
+import bson
+
+from api.dao.containerutil import ContainerReference
+from api.jobs import jobs
+
+
+def test_command_template_cache():
+    gear = {
+        '_id': bson.ObjectId(),
+        'gear': {'command': './run {% if verbose %}--verbose {% endif %}{{ name }}'},
+        'exchange': {'rootfs-url': 'https://localhost/gear.tar', 'rootfs-hash': 'sha384:0'},
+    }
+    gear_id = str(gear['_id'])
+    destination = ContainerReference('acquisition', str(bson.ObjectId()))
+    job = jobs.Job(gear_id, {}, destination=destination, config_={'config': {'verbose': True, 'name': 'a'}, 'inputs': {}},
+                   id_=str(bson.ObjectId()), priority=0, vtime=0)
+    other = jobs.Job(gear_id, {}, destination=destination, config_={'config': {'verbose': False, 'name': 'b'}, 'inputs': {}},
+                     id_=str(bson.ObjectId()), priority=0, vtime=0)
+
+    assert job.generate_request(gear)['target']['command'][2].endswith('./run --verbose a')
+    template = jobs._command_templates[(gear_id, gear['gear']['command'])]
+    assert other.generate_request(gear)['target']['command'][2].endswith('./run b')
+    assert jobs._command_templates[(gear_id, gear['gear']['command'])] is template
+
+    # A gear with a new command doesn't use the old template
+    gear['gear']['command'] = './run2 {{ name }}'
+    assert job.generate_request(gear)['target']['command'][2].endswith('./run2 a')
+
+    jobs.evict_command_templates(gear_id)
+    assert not [key for key in jobs._command_templates if key[0] == gear_id]
@@ -0,0 +1,28 @@
+from api.jobs import stats
+
+
+def test_record_and_rebuild(api_db):
+    api_db.jobs.delete_many({})
+    api_db.job_stats.delete_many({})
+    api_db.jobs.insert_many([
+        {'state': 'running', 'tags': ['a', 'b']},
+        {'state': 'pending', 'tags': ['a']},
+    ])
+    stats.record([['a', 'b'], ['a']], to_state='pending')
+    stats.record([['a', 'b']], 'pending', 'running')
+
+    assert stats.get_counts() == {'pending': 1, 'running': 1, 'failed': 0, 'complete': 0, 'cancelled': 0}
+    assert stats.get_counts(['b'])['running'] == 1
+    assert stats.get_counts(['a', 'b']) is None
+    assert stats.get_tags() == ['a', 'b']
+    assert stats.rebuild(dry_run=True) == 0
+
+    # Drifted and stale counters are fixed
+    stats.record([['a', 'c']], 'pending', 'complete')
+    assert stats.rebuild(dry_run=True) == 3
+    assert stats.rebuild() == 3
+    assert stats.get_counts(['a']) == {'pending': 1, 'running': 1, 'failed': 0, 'complete': 0, 'cancelled': 0}
+    assert stats.get_tags() == ['a', 'b']
+    assert stats.rebuild() == 0
+    api_db.jobs.delete_many({})
+    api_db.job_stats.delete_many({})
@@ -0,0 +1,45 @@
+from jsonschema import Draft4Validator
+
+from api.jobs import matchers
+
+
+FILES = [
+    {'name': 'scan.dicom.zip', 'type': 'dicom', 'measurements': ['anatomy_t1w'], 'size': 10},
+    {'name': 'scan.nii.gz', 'type': 'nifti', 'measurements': ['functional'], 'size': 20},
+    {'name': 'notes.txt', 'type': None, 'measurements': []},
+    {'name': 'scan2.dicom.zip', 'type': 'dicom', 'size': 30, 'info': {'a': 1}},
+    {'name': 7},
+    {},
+]
+
+SCHEMAS = [
+    {'type': 'object', 'properties': {'type': {'enum': ['dicom']}}},
+    {'type': 'object', 'properties': {'type': {'enum': ['dicom', 'nifti']}, 'name': {'pattern': '\\.nii(\\.gz)?$'}}},
+    {'type': 'object', 'properties': {'measurements': {'type': 'array', 'items': {'enum': ['anatomy_t1w']}}}},
+    {'type': 'object', 'properties': {'size': {'type': 'integer'}}, 'required': ['size']},
+    {'type': 'object', 'properties': {'name': {'type': 'string', 'pattern': '^scan'}}},
+    {'title': 'Input', '$schema': 'http://json-schema.org/draft-04/schema#', 'type': 'object'},
+    # Not compiled, validated with jsonschema
+    {'type': 'object', 'properties': {'size': {'minimum': 15}}},
+    {'type': 'object', 'properties': {'info': {'type': 'object'}}, 'additionalProperties': False},
+]
+
+
+def test_file_matcher():
+    for schema in SCHEMAS:
+        matcher = matchers.FileMatcher(schema)
+        validator = Draft4Validator(schema)
+        for f in FILES * 2:
+            assert matcher.is_valid(f) == validator.is_valid(f), (schema, f)
+
+    assert matchers.FileMatcher(SCHEMAS[0]).check is not None
+    assert matchers.FileMatcher(SCHEMAS[6]).check is None
+
+
+def test_file_matcher_memo():
+    matcher = matchers.FileMatcher(SCHEMAS[0])
+    assert matcher.is_valid({'name': 'a.zip', 'type': 'dicom'})
+    assert matcher.is_valid({'name': 'b.zip', 'type': 'dicom', 'size': 1})
+    assert not matcher.is_valid({'name': 'c.txt', 'type': 'text'})
+    # Files are told apart by the fields the schema looks at only
+    assert len(matcher._results) == 2
@@ -0,0 +1,47 @@
+import bson
+
+from api.dao import rollups
+
+
+def test_file_stats():
+    stats = rollups.file_stats([
+        {'type': 'dicom', 'size': 10},
+        {'type': 'dicom', 'size': 5},
+        {'size': 1},
+        {'type': 'dicom', 'size': 100, 'deleted': True},
+    ])
+    assert stats == {'dicom': [2, 15], None: [1, 1]}
+
+
+def test_update_files_and_rebuild(api_db):
+    api_db.file_rollups.delete_many({})
+    project, session, acquisition = bson.ObjectId(), bson.ObjectId(), bson.ObjectId()
+    api_db.sessions.insert_one({'_id': session, 'project': project})
+    acq = {'_id': acquisition, 'session': session}
+
+    files = [{'name': 'a', 'type': 'dicom', 'size': 10}]
+    rollups.update_files('acquisition', acq, [], files)
+    assert rollups.get_summary([('projects', project)]) == {'dicom': {'count': 1, 'size': 10}}
+
+    files_after = [{'name': 'a', 'type': 'nifti', 'size': 20}]
+    rollups.update_files('acquisition', acq, files, files_after)
+    assert rollups.get_summary([('sessions', session)]) == {'nifti': {'count': 1, 'size': 20}}
+
+    rollups.remove_subtree('acquisition', acq)
+    assert rollups.get_summary([('projects', project)]) == {}
+    assert rollups.get_summary([('acquisitions', acquisition)]) == {'nifti': {'count': 1, 'size': 20}}
+    rollups.add_subtree('acquisition', acq)
+
+    # rebuild removes the empty dicom documents, then finds nothing to fix
+    api_db.acquisitions.insert_one(dict(acq, files=files_after))
+    assert rollups.rebuild() == 3
+    assert rollups.rebuild() == 0
+
+    # and fixes drifted documents
+    api_db.file_rollups.update_many({'cont': project}, {'$inc': {'count': 1}})
+    assert rollups.rebuild() == 1
+    assert rollups.get_summary([('projects', project)]) == {'nifti': {'count': 1, 'size': 20}}
+
+    api_db.sessions.delete_one({'_id': session})
+    api_db.acquisitions.delete_one({'_id': acquisition})
+    api_db.file_rollups.delete_many({})
@@ -0,0 +1,86 @@
+import datetime
+import itertools
+
+import bson
+
+from api.jobs import scheduler
+
+_enqueued = itertools.count()
+
+
+def enqueue(api_db, share, count, priority=0):
+    start = datetime.datetime(2018, 1, 1)
+    for vtime in scheduler.assign_vtimes(share, count):
+        # Distinct FIFO timestamps, the last tie-break of the claim order
+        modified = start + datetime.timedelta(milliseconds=next(_enqueued))
+        api_db.jobs.insert_one({'_id': bson.ObjectId(), 'state': 'pending', 'tags': ['sched'], 'share': share,
+                                'priority': priority, 'vtime': vtime, 'modified': modified})
+
+
+def claim(api_db, count):
+    """Start the next `count` jobs the way the queue does and return their shares"""
+    shares = []
+    for _ in range(count):
+        job = api_db.jobs.find_one({'state': 'pending', 'tags': 'sched'}, sort=scheduler.SORT)
+        api_db.jobs.update_one({'_id': job['_id']}, {'$set': {'state': 'running'}})
+        scheduler.advance(job['vtime'])
+        shares.append(job['share'])
+    return shares
+
+
+def test_fair_share(api_db):
+    api_db.jobs.delete_many({})
+    api_db.job_shares.delete_many({})
+
+    # A floods the queue, B enqueues later but doesn't wait for all of A's jobs
+    enqueue(api_db, 'user:a', 1000)
+    assert claim(api_db, 10) == ['user:a'] * 10
+    enqueue(api_db, 'user:b', 10)
+    shares = claim(api_db, 20)
+    assert shares.count('user:b') == 10
+    assert shares[:4] == ['user:b', 'user:a'] * 2
+
+    # A weight of 2 gets twice as many jobs started
+    api_db.jobs.delete_many({})
+    api_db.job_shares.insert_one({'_id': 'user:e', 'weight': 2.0, 'vtime': 0})
+    enqueue(api_db, 'user:d', 100)
+    enqueue(api_db, 'user:e', 100)
+    shares = claim(api_db, 60)
+    assert shares.count('user:e') == 40
+
+    # Higher priority jobs are started first, whatever their share
+    enqueue(api_db, 'user:c', 2, priority=10)
+    assert claim(api_db, 2) == ['user:c'] * 2
+    api_db.jobs.delete_many({})
+
+
+def test_default_priority(mocker):
+    mocker.patch('api.config.get_item', return_value='-5')
+    assert scheduler.get_default_priority() == 0
+    assert scheduler.get_default_priority(batch='batch-id') == -5
+
+
+def test_resolve_groups(api_db):
+    project = api_db.projects.insert_one({'group': 'sched-group'}).inserted_id
+    session = api_db.sessions.insert_one({'project': project}).inserted_id
+    acquisition = api_db.acquisitions.insert_one({'session': session}).inserted_id
+    analysis = api_db.analyses.insert_one({'parent': {'type': 'session', 'id': session}}).inserted_id
+    project_analysis = api_db.analyses.insert_one({'parent': {'type': 'project', 'id': project}}).inserted_id
+
+    refs = set([('group', 'other-group'), ('project', str(project)), ('session', str(session)),
+                ('acquisition', str(acquisition)), ('analysis', str(analysis)),
+                ('analysis', str(project_analysis)), ('collection', str(bson.ObjectId())),
+                ('acquisition', str(bson.ObjectId()))])
+    groups = scheduler.resolve_groups(refs)
+    assert groups == {
+        ('group', 'other-group'): 'other-group',
+        ('project', str(project)): 'sched-group',
+        ('session', str(session)): 'sched-group',
+        ('acquisition', str(acquisition)): 'sched-group',
+        ('analysis', str(analysis)): 'sched-group',
+    }
+
+    api_db.projects.delete_one({'_id': project})
+    api_db.sessions.delete_one({'_id': session})
+    api_db.acquisitions.delete_one({'_id': acquisition})
+    api_db.analyses.delete_many({'_id': {'$in': [analysis, project_analysis]}})
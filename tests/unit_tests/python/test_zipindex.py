@@ -0,0 +1,49 @@
+import os
+import zipfile
+
+import pymongo.errors
+import pytest
+
+from api import zipindex
+
+
+def test_zip_member_extraction(api_db, tmpdir):
+    data = os.urandom(50000) + 'a' * 500000
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('stored.bin', data, zipfile.ZIP_STORED)
+        zf.writestr('deflated.bin', data, zipfile.ZIP_DEFLATED)
+        zf.comment = 'comment'
+
+    hash_ = 'v0-sha384-zipindextest'
+    info = zipindex.get_zip_info(hash_, path)
+    assert info['comment'] == 'comment'
+    assert [(m['path'], m['size']) for m in info['members']] == [('stored.bin', len(data)), ('deflated.bin', len(data))]
+    assert api_db.zip_indexes.find_one({'_id': hash_})
+
+    for name in ('stored.bin', 'deflated.bin'):
+        member = zipindex.get_member(hash_, path, name)
+        chunks = list(zipindex.member_chunks(path, member, chunk_size=4096))
+        assert max(len(c) for c in chunks) <= 4096
+        assert ''.join(chunks) == data
+
+    with pytest.raises(KeyError):
+        zipindex.get_member(hash_, path, 'nosuch.bin')
+    assert 'by_path' not in api_db.zip_indexes.find_one({'_id': hash_})
+
+
+def test_zip_index_too_large(api_db, mocker, tmpdir):
+    path = str(tmpdir.join('large.zip'))
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('member.txt', 'data')
+
+    mocker.patch.object(api_db.zip_indexes, 'insert_one', side_effect=pymongo.errors.DocumentTooLarge())
+    hash_ = 'v0-sha384-zipindextoolarge'
+    assert [m['path'] for m in zipindex.get_zip_info(hash_, path)['members']] == ['member.txt']
+    assert zipindex.get_member(hash_, path, 'member.txt')['size'] == 4
+
+    not_zip = str(tmpdir.join('test.txt'))
+    with open(not_zip, 'w') as f:
+        f.write('not a zip')
+    with pytest.raises(zipfile.BadZipfile):
+        zipindex.get_zip_info('v0-sha384-notazip', not_zip)